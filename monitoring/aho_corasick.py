@@ -0,0 +1,101 @@
+from collections import deque
+
+
+class Automaton:
+    """
+    Aho-Corasick multi-pattern matcher.
+    Needles are added one by one and receive consecutive integer ids.
+    After build() a single pass over a text returns every needle it contains
+    as an integer bitmap (bit N is set when needle N was found).
+    """
+
+    def __init__(self):
+        # goto[state] maps a character to the next state; state 0 is the root.
+        self._goto = [{}]
+        self._fail = [0]
+        # out[state] is the bitmap of needles ending in this state (including fail links).
+        self._out = [0]
+        self._needles = {}
+        self._built = False
+
+    def __len__(self):
+        return len(self._needles)
+
+    @property
+    def needle_ids(self):
+        """
+        The mapping of each added needle to its id.
+        """
+        return self._needles
+
+    def add(self, needle):
+        """
+        Adds a needle to the automaton and returns its id.
+        Adding the same needle twice returns the id assigned the first time.
+        """
+        if needle in self._needles:
+            return self._needles[needle]
+        if self._built:
+            raise RuntimeError("Cannot add needles after the automaton has been built")
+
+        needle_id = len(self._needles)
+        self._needles[needle] = needle_id
+
+        state = 0
+        for ch in needle:
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(0)
+                self._goto[state][ch] = next_state
+            state = next_state
+        self._out[state] |= 1 << needle_id
+        return needle_id
+
+    def build(self):
+        """
+        Computes failure links breadth-first and merges the outputs of each
+        state's failure chain so that search() never has to walk it.
+        """
+        queue = deque()
+        for state in self._goto[0].values():
+            self._fail[state] = 0
+            queue.append(state)
+
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail_target = self._goto[fail].get(ch, 0)
+                self._fail[next_state] = fail_target if fail_target != next_state else 0
+                self._out[next_state] |= self._out[self._fail[next_state]]
+
+        self._built = True
+        return self
+
+    def search(self, text):
+        """
+        Scans the text once and returns the bitmap of all needles found in it.
+        An empty automaton (no needles) always returns 0.
+        """
+        if not self._needles:
+            return 0
+
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        # The root output is non-zero only for the empty needle, which every text contains.
+        hits = out[0]
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                hits |= out[state]
+        return hits
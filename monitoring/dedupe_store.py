@@ -0,0 +1,159 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+# Configure basic logging to output messages with level INFO or higher.
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DB_FILE = os.path.join(BASE_DIR, "alert_dedupe.db")
+# Fields of a log entry identifying "the same alert"; nested fields are dotted.
+DEFAULT_KEY_FIELDS = ("rule.id", "user", "cmdline")
+# An alert with the same key is suppressed for this many seconds after it was sent.
+DEFAULT_WINDOW = 3600.0
+DEFAULT_MAX_ENTRIES = 10000
+# Expired rows are purged from the database after this many new alerts.
+PURGE_EVERY = 100
+
+
+def normalize_cmdline(cmdline):
+    """
+    Normalizes a command line for deduplication: case and runs of whitespace
+    do not make two PowerShell command lines different.
+    """
+    return " ".join(str(cmdline).lower().split())
+
+
+def dedupe_key(logs, key_fields=DEFAULT_KEY_FIELDS):
+    """
+    Builds the dedupe key of a log entry from the configured fields.
+    Dotted names address nested fields (e.g. "rule.id"); the cmdline is normalized.
+    """
+    values = []
+    for field in key_fields:
+        value = logs
+        for part in field.split("."):
+            value = value.get(part) if isinstance(value, dict) else None
+        if field == "cmdline" and value is not None:
+            value = normalize_cmdline(value)
+        values.append("" if value is None else str(value))
+    return hashlib.sha256("\0".join(values).encode("utf-8", errors="replace")).hexdigest()
+
+
+class DedupeStore:
+    """
+    Remembers recently sent alerts so that the same alert is not sent again within
+    the time window, even after a restart.
+    Keys live in an in-memory LRU bounded by max_entries, with entries expiring after
+    the window. Every sent alert is also written to a SQLite database, from which the
+    still unexpired keys are loaded on start-up.
+    Hits (suppressed duplicates), misses (alerts let through), expirations and
+    evictions are counted; see stats().
+    """
+
+    def __init__(self, db_file=DEFAULT_DB_FILE, window=DEFAULT_WINDOW,
+                 max_entries=DEFAULT_MAX_ENTRIES, key_fields=DEFAULT_KEY_FIELDS):
+        self.db_file = db_file
+        self.window = window
+        self.max_entries = max_entries
+        self.key_fields = tuple(key_fields)
+        # Maps each key to the time its alert was sent, least recently used first.
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._since_purge = 0
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self._open_db()
+
+    def _open_db(self):
+        """
+        Opens the database and loads the keys that have not expired yet.
+        Without a usable database, deduplication works in memory only.
+        """
+        try:
+            self._db = sqlite3.connect(self.db_file, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS sent_alerts (key TEXT PRIMARY KEY, sent_at REAL NOT NULL)")
+            rows = self._db.execute(
+                "SELECT key, sent_at FROM sent_alerts WHERE sent_at > ? ORDER BY sent_at DESC LIMIT ?",
+                (time.time() - self.window, self.max_entries)
+            ).fetchall()
+            self._db.commit()
+        except sqlite3.Error as e:
+            logger.warning("Alert dedupe database unavailable, deduplicating in memory only: %s", e)
+            if self._db is not None:
+                self._db.close()
+            self._db = None
+            return
+        # Oldest first, so the LRU order matches the send order.
+        for key, sent_at in reversed(rows):
+            self._entries[key] = sent_at
+        logger.info("Loaded %d recent alert keys from %s", len(self._entries), self.db_file)
+
+    def _persist(self, key, sent_at):
+        if self._db is None:
+            return
+        try:
+            self._db.execute("INSERT OR REPLACE INTO sent_alerts (key, sent_at) VALUES (?, ?)", (key, sent_at))
+            self._since_purge += 1
+            if self._since_purge >= PURGE_EVERY:
+                self._since_purge = 0
+                self._db.execute("DELETE FROM sent_alerts WHERE sent_at <= ?", (sent_at - self.window,))
+            self._db.commit()
+        except sqlite3.Error as e:
+            logger.warning("Could not persist alert dedupe key: %s", e)
+
+    def check(self, logs):
+        """
+        Returns True if an alert with the same key was sent within the window (a hit).
+        Otherwise records the alert as sent now and returns False (a miss).
+        The window starts when an alert is sent, so a repeating alert is sent again
+        once per window rather than being suppressed forever.
+        """
+        key = dedupe_key(logs, self.key_fields)
+        now = time.time()
+        with self._lock:
+            sent_at = self._entries.get(key)
+            if sent_at is not None:
+                if now - sent_at < self.window:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True
+                self.expired += 1
+
+            self.misses += 1
+            self._entries[key] = now
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+            self._persist(key, now)
+            return False
+
+    def stats(self):
+        """
+        Returns the dedupe counters and the current number of keys held in memory.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "evicted": self.evicted,
+                "entries": len(self._entries),
+            }
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,459 @@
+import re
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from metrics import counter, gauge
+
+# Configure basic logging to output messages with level INFO or higher.
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Number of distinct command lines and scripts kept normalized.
+NORMALIZE_CACHE_SIZE = 1024
+# Folding rounds per text; each round folds one level of nested concatenations and formats.
+MAX_FOLD_ROUNDS = 16
+
+SCRIPTS_NORMALIZED = counter("scripts_normalized_total", "Command lines and scripts tokenized by the deobfuscation normalizer (memo cache misses)")
+NORMALIZE_CACHE_ENTRIES = gauge("normalize_cache_entries", "Normalized command lines and scripts in the memo cache")
+
+# PowerShell also accepts the typographic quotes as string delimiters.
+SINGLE_QUOTES = "'‘’‚‛"
+DOUBLE_QUOTES = "\"“”„"
+# Escape sequences of double-quoted strings (Windows PowerShell 5.1); any other escaped
+# character stands for itself.
+DOUBLE_QUOTED_ESCAPES = {"0": "\0", "a": "\a", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v"}
+ESCAPED_CHARACTERS = {character: "`" + escape for escape, character in DOUBLE_QUOTED_ESCAPES.items()}
+
+TOKEN = re.compile(
+    rf"(?P<comment><#.*?#>|(?<![^\s;(){{}}|&])#[^\r\n]*)"
+    rf"|(?P<here>@[{SINGLE_QUOTES}{DOUBLE_QUOTES}][ \t]*\r?\n.*?\r?\n[{SINGLE_QUOTES}{DOUBLE_QUOTES}]@)"
+    rf"|(?P<single>[{SINGLE_QUOTES}](?:[^{SINGLE_QUOTES}]|[{SINGLE_QUOTES}]{{2}})*[{SINGLE_QUOTES}])"
+    rf"|(?P<double>[{DOUBLE_QUOTES}](?:[^{DOUBLE_QUOTES}`]|`.|[{DOUBLE_QUOTES}]{{2}})*[{DOUBLE_QUOTES}])"
+    r"|(?P<escape>`\r?\n|`.|\^\r?\n|\^.?)"
+    r"|(?P<space>\s+)"
+    r"|(?P<op>[(),+&.])"
+    rf"|(?P<word>[^\s(),+&.`^#<@{SINGLE_QUOTES}{DOUBLE_QUOTES}]+|.)",
+    re.DOTALL,
+)
+DOUBLED_SINGLE_QUOTE = re.compile(rf"[{SINGLE_QUOTES}]{{2}}")
+DOUBLE_QUOTED_ESCAPE = re.compile(rf"`(.)|[{DOUBLE_QUOTES}]{{2}}", re.DOTALL)
+# Backticks in an expandable string that only escape an ordinary character.
+ESCAPED_CHARACTER = re.compile("[" + "".join(DOUBLE_QUOTED_ESCAPES.values()) + '"`$]')
+REDUNDANT_BACKTICK = re.compile(rf"`([^0abfnrtv$`{DOUBLE_QUOTES}])")
+VARIABLE = re.compile(r"(?<!`)\$")
+FORMAT_ITEM = re.compile(r"\{\{|\}\}|\{(\d+)\}|[{}]")
+MEMBER_NAME = re.compile(r"[\w-]+")
+# Word operators binding a neighbouring string at least as tightly as "+" does.
+TIGHT_WORD_OPERATORS = ("-f", "-not", "-bnot", "-split", "-join")
+# Characters in a word that start a new statement or pipeline ("$x=", "|", ";").
+STATEMENT_SEPARATORS = re.compile(r"[;|{}=]")
+# The parameter of powershell.exe (or cmd.exe) whose arguments are run as a script.
+COMMAND_PARAMETERS = ("-command", "/c")
+# Texts with none of these markers, or with folding markers but no FOLDING_HINT, cannot
+# change, so they are not even hashed. Substring tests are far faster than a regex search.
+OBFUSCATION_MARKERS = ("`", "^", "<#", "  ", "\t", "\r", "\n") + tuple(SINGLE_QUOTES[1:] + DOUBLE_QUOTES[1:])
+FOLDING_MARKERS = ("+", "&", ".(", ". (", ".'", '."', "((") + tuple("-" + f + after for f in "fF" for after in " '\"(")
+FOLDING_HINT = re.compile(
+    rf"[{SINGLE_QUOTES}{DOUBLE_QUOTES})]\s*(?:\+|-f\b)|\+\s*\(*\s*[{SINGLE_QUOTES}{DOUBLE_QUOTES}]"
+    rf"|(?:[&.]|\(\s*\()\s*\(*\s*[{SINGLE_QUOTES}{DOUBLE_QUOTES}]",
+    re.IGNORECASE,
+)
+
+# Token kinds. String tokens carry their value, or None if the string expands variables.
+STRING, SPACE, OP, WORD = "string", "space", "op", "word"
+# Parsing modes of a statement: not started yet, an expression, or a command's arguments.
+START, EXPRESSION, ARGUMENTS = "start", "expression", "arguments"
+
+
+def quote(value, double=False):
+    """
+    Returns a PowerShell string literal of value.
+    """
+    if double:
+        return '"' + ESCAPED_CHARACTER.sub(lambda match: ESCAPED_CHARACTERS.get(match.group(), "`" + match.group()),
+                                           value) + '"'
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _double_quoted(body):
+    """
+    Returns the value of a double-quoted string body, or None if it expands variables.
+    """
+    if VARIABLE.search(body):
+        return None
+
+    def unescape(match):
+        if match.group(1) is None:
+            return '"'
+        return DOUBLE_QUOTED_ESCAPES.get(match.group(1), match.group(1))
+    return DOUBLE_QUOTED_ESCAPE.sub(unescape, body)
+
+
+def tokenize(text):
+    """
+    Splits PowerShell (or cmd.exe) text into (kind, text, value) tokens, already stripped
+    of what does not change its meaning: comments, backtick and caret escapes outside of
+    strings, redundant escapes inside them and repeated whitespace. Adjacent words are
+    joined, so "I`nv`oke" becomes a single word again.
+    """
+    tokens = []
+    for match in TOKEN.finditer(text):
+        kind = match.lastgroup
+        token = match.group()
+        if kind == "comment" or kind == "space":
+            if tokens and tokens[-1][0] == SPACE:
+                continue
+            tokens.append((SPACE, " ", None))
+            continue
+        if kind == "single":
+            value = DOUBLED_SINGLE_QUOTE.sub("'", token[1:-1])
+            tokens.append((STRING, quote(value), value))
+            continue
+        if kind == "double":
+            value = _double_quoted(token[1:-1])
+            if value is None:
+                tokens.append((STRING, '"' + REDUNDANT_BACKTICK.sub(r"\1", token[1:-1]) + '"', None))
+            else:
+                tokens.append((STRING, quote(value, double=True), value))
+            continue
+        if kind == "here":
+            # Here-strings are kept as they are; only single-quoted ones are literals.
+            literal = token[1] in SINGLE_QUOTES
+            tokens.append((STRING, token, token.split("\n", 1)[1].rsplit("\n", 1)[0].rstrip("\r") if literal else None))
+            continue
+        if kind == "escape":
+            token = token[1:]
+            if not token.strip():
+                # A line continuation (or an escaped space) separates words.
+                if tokens and tokens[-1][0] == SPACE:
+                    continue
+                tokens.append((SPACE, " ", None))
+                continue
+            kind = "word"
+        if kind == "op":
+            tokens.append((OP, token, None))
+        elif tokens and tokens[-1][0] == WORD:
+            tokens[-1] = (WORD, tokens[-1][1] + token, None)
+        else:
+            tokens.append((WORD, token, None))
+    return tokens
+
+
+def _is_literal(token):
+    return token is not None and token[0] == STRING and token[2] is not None
+
+
+def _is_op(token, op):
+    return token is not None and token[0] == OP and token[1] == op
+
+
+def _is_format_operator(token):
+    return token is not None and token[0] == WORD and token[1].lower() == "-f"
+
+
+def _is_member_access(token):
+    """
+    Returns True if token makes the next one a member or command name (".", "::", "&").
+    """
+    return token is not None and (token[1] in (".", "&") if token[0] == OP else token[1].endswith("::"))
+
+
+def _next(tokens, index):
+    """
+    Returns the index of the first non-space token at or after index, or len(tokens).
+    """
+    while index < len(tokens) and tokens[index][0] == SPACE:
+        index += 1
+    return index
+
+
+def _last(tokens):
+    """
+    Returns the last non-space token of a list, or None.
+    """
+    for token in reversed(tokens):
+        if token[0] != SPACE:
+            return token
+    return None
+
+
+def _at(tokens, index):
+    return tokens[index] if index < len(tokens) else None
+
+
+def _is_tight_operator(token):
+    """
+    Returns True if token is an operator that binds a neighbouring string at least as
+    tightly as "+": the arithmetic operators (+ - * / %), -f and the unary ones.
+    """
+    if token is None or token[0] == STRING:
+        return False
+    if token[0] == OP:
+        return token[1] == "+"
+    return token[0] == WORD and (token[1][-1] in "-*/%!" or token[1].lower() in TIGHT_WORD_OPERATORS)
+
+
+def _binds_right(token):
+    """
+    Returns True if token is an operator that takes the string before it away from a
+    preceding "+" (* / % and -f), as in 'a' + 'b' * 3.
+    """
+    return token is not None and token[0] == WORD and (token[1][0] in "*/%" or _is_format_operator(token))
+
+
+def _member_follows(tokens, index):
+    """
+    Returns True if a member access or index directly follows the token before index
+    (as in 'abc'.Length or 'abc'[0]), which binds tighter than any operator folded here.
+    """
+    token = _at(tokens, index)
+    return token is not None and (_is_op(token, ".") or (token[0] == WORD and token[1].startswith("[")))
+
+
+def _is_command_parameter(word):
+    """
+    Returns True for -c, -Command and the other prefixes of -Command, and for /c.
+    """
+    word = word.lower()
+    return word == "/c" or (len(word) > 1 and "-command".startswith(word))
+
+
+def _argument_mode(tokens):
+    """
+    Returns for each token whether it is in argument mode, i.e. an argument of a command
+    such as Write-Host 'a' + 'b', where "+" is just another argument and nothing is
+    concatenated. A statement starting with a bare word is a command; one starting with
+    a string, a variable, a number or an operator is an expression, and so is everything
+    in parentheses. The arguments of -Command run as a script and start a new statement.
+    """
+    modes = [START]
+    arguments = []
+    for token in tokens:
+        arguments.append(modes[-1] == ARGUMENTS)
+        kind, text = token[0], token[1]
+        if kind == OP:
+            if text == "(":
+                modes.append(START)
+            elif text == ")":
+                if len(modes) > 1:
+                    modes.pop()
+                if modes[-1] == START:
+                    modes[-1] = EXPRESSION
+            elif modes[-1] == START:
+                # "&" and "." invoke a command; "+" and "," start an expression.
+                modes[-1] = ARGUMENTS if text in "&." else EXPRESSION
+        elif kind == STRING:
+            if modes[-1] == START:
+                modes[-1] = EXPRESSION
+        elif kind == WORD:
+            separators = list(STATEMENT_SEPARATORS.finditer(text))
+            if separators:
+                modes[-1] = START
+                text = text[separators[-1].end():]
+            if not text:
+                continue
+            if modes[-1] == START:
+                modes[-1] = EXPRESSION if text[0] in "$[-0123456789" else ARGUMENTS
+            elif modes[-1] == ARGUMENTS and _is_command_parameter(text):
+                modes[-1] = START
+    return arguments
+
+
+def _unwrap_parentheses(tokens):
+    """
+    Replaces a parenthesized string literal by the literal where the parentheses do not
+    delimit method arguments: next to + and -f, after another "(", "," or at the start,
+    and as a member or command name (".('Download'+'String')", "&('IEX')").
+    """
+    out = []
+    changed = False
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        if _is_op(token, "("):
+            inner = _next(tokens, index + 1)
+            close = _next(tokens, inner + 1)
+            if _is_literal(_at(tokens, inner)) and _is_op(_at(tokens, close), ")"):
+                before = _last(out)
+                after = _at(tokens, _next(tokens, close + 1))
+                if (before is None or _is_member_access(before) or _is_format_operator(before)
+                        or (before[0] == OP and before[1] in "(,+")
+                        or _is_op(after, "+") or _is_format_operator(after)):
+                    out.append(tokens[inner])
+                    index = close + 1
+                    changed = True
+                    continue
+        out.append(token)
+        index += 1
+    return out, changed
+
+
+def format_string(template, values):
+    """
+    Applies the -f operator with plain "{index}" items. Returns None for alignment or
+    format specifiers, and for indexes without a value.
+    """
+    def item(match):
+        if match.group() in ("{{", "}}"):
+            return match.group()[0]
+        if match.group(1) is None:
+            raise ValueError(match.group())
+        return values[int(match.group(1))]
+    try:
+        return FORMAT_ITEM.sub(item, template)
+    except (ValueError, IndexError):
+        return None
+
+
+def _format_arguments(tokens, index):
+    """
+    Parses the string literals right of a -f operator, as a comma list that may be
+    parenthesized. Returns (values, index after them), or None if one is not a literal.
+    """
+    index = _next(tokens, index)
+    parenthesized = _is_op(_at(tokens, index), "(")
+    if parenthesized:
+        index = _next(tokens, index + 1)
+    values = []
+    while True:
+        token = _at(tokens, index)
+        if not _is_literal(token) or _member_follows(tokens, index + 1):
+            return None
+        values.append(token[2])
+        after = _next(tokens, index + 1)
+        if not _is_op(_at(tokens, after), ","):
+            break
+        index = _next(tokens, after + 1)
+    if parenthesized:
+        if not _is_op(_at(tokens, after), ")"):
+            return None
+        return values, after + 1
+    return values, index + 1
+
+
+def _fold_formats(tokens):
+    """
+    Folds "'{1}{0}' -f 'voke','In'" into 'Invoke'.
+    """
+    in_arguments = _argument_mode(tokens)
+    out = []
+    changed = False
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        operator = _next(tokens, index + 1)
+        before = _last(out)
+        if (_is_literal(token) and not in_arguments[index] and _is_format_operator(_at(tokens, operator))
+                and not _is_member_access(before) and not _is_op(before, ",")):
+            arguments = _format_arguments(tokens, operator + 1)
+            if arguments is not None:
+                value = format_string(token[2], arguments[0])
+                if value is not None:
+                    out.append((STRING, quote(value, token[1].startswith('"')), value))
+                    index = arguments[1]
+                    changed = True
+                    continue
+        out.append(token)
+        index += 1
+    return out, changed
+
+
+def _fold_concatenations(tokens):
+    """
+    Folds "'In' + 'vo' + 'ke'" into 'Invoke'. Operands must be string literals that no
+    tighter operator competes for: 5 - 'a' + 'b' and 'a' + 'b' * 3 are left alone, and
+    so are command arguments (Write-Host 'a' + 'b').
+    """
+    in_arguments = _argument_mode(tokens)
+    out = []
+    changed = False
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        before = _last(out)
+        if (_is_literal(token) and not in_arguments[index] and not _is_member_access(before)
+                and not _is_tight_operator(before)
+                and not _is_op(before, ",") and not _member_follows(tokens, index + 1)):
+            value = token[2]
+            end = index
+            while True:
+                plus = _next(tokens, end + 1)
+                operand = _next(tokens, plus + 1)
+                if not (_is_op(_at(tokens, plus), "+") and _is_literal(_at(tokens, operand))
+                        and not _member_follows(tokens, operand + 1)
+                        and not _binds_right(_at(tokens, _next(tokens, operand + 1)))):
+                    break
+                value += tokens[operand][2]
+                end = operand
+            if end != index:
+                out.append((STRING, quote(value, token[1].startswith('"')), value))
+                index = end + 1
+                changed = True
+                continue
+        out.append(token)
+        index += 1
+    return out, changed
+
+
+def _unquote_names(tokens):
+    """
+    Turns string literals used as member or command names into plain names:
+    ".'DownloadString'(" becomes ".DownloadString(" and "& 'IEX'" becomes "& IEX".
+    """
+    out = []
+    for token in tokens:
+        if _is_literal(token) and MEMBER_NAME.fullmatch(token[2]) and _is_member_access(_last(out)):
+            token = (WORD, token[2], None)
+        out.append(token)
+    return out
+
+
+def deobfuscate(text):
+    """
+    Returns the canonical form of a command line or script: comments, backtick and caret
+    escapes removed, concatenations and -f formats of string literals folded, and
+    whitespace outside of strings collapsed to single spaces. Casing is kept, since
+    contains-style matching ignores it anyway while regexes and |cased modifiers may not.
+    """
+    tokens = tokenize(text)
+    for _ in range(MAX_FOLD_ROUNDS):
+        tokens, unwrapped = _unwrap_parentheses(tokens)
+        tokens, formatted = _fold_formats(tokens)
+        tokens, concatenated = _fold_concatenations(tokens)
+        if not (unwrapped or formatted or concatenated):
+            break
+    return "".join(token[1] for token in _unquote_names(tokens)).strip()
+
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+NORMALIZE_CACHE_ENTRIES.set_function(_cache.__len__)
+
+
+def normalize_script(text):
+    """
+    Returns the canonical form of a command line or script (see deobfuscate), or None if
+    it is the text itself. Results are memoized by a hash of the content, for the last
+    NORMALIZE_CACHE_SIZE distinct texts, so a recurring script is only normalized once.
+    """
+    if not text:
+        return None
+    if not any(marker in text for marker in OBFUSCATION_MARKERS) and not (
+            any(marker in text for marker in FOLDING_MARKERS) and FOLDING_HINT.search(text)):
+        return None
+    key = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    canonical = deobfuscate(text)
+    if canonical == text:
+        canonical = None
+    SCRIPTS_NORMALIZED.inc()
+    with _cache_lock:
+        _cache[key] = canonical
+        if len(_cache) > NORMALIZE_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return canonical
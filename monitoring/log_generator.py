@@ -1,11 +1,24 @@
 import os
 import json
+import time
+import queue
 import logging
+import threading
 from logging.handlers import RotatingFileHandler
 import getpass
 from datetime import datetime
-import base64
 from notification_generator import send_notification
+from payload_decoder import parse_powershell_arguments, decode_encoded_command, read_script
+from server_config import load_config
+from scheduler import get_upload_scheduler
+from metrics import counter, gauge, histogram
+
+# orjson is an optional, much faster JSON encoder; the standard json module is used without it.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Set up the base directory and the logs folder.
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 LOG_DIR = os.path.join(BASE_DIR, "logs")
@@ -15,11 +28,208 @@ os.makedirs(LOG_DIR, exist_ok=True)
 USERNAME = getpass.getuser()
 SHARED_LOG_FILE = os.path.join(LOG_DIR, "threats.log")
 
+# Threat log writer tuning.
+WRITER_QUEUE_SIZE = 10000
+# Maximum number of records written (and flushed) together.
+MAX_WRITE_BATCH = 512
+# Default seconds between fsyncs of the threat log ("log_fsync_interval" in server_config.json).
+DEFAULT_FSYNC_INTERVAL = 1.0
+
+# Status and error messages go to the application log; the threat log only gets entries.
+status_logger = logging.getLogger(__name__)
+
+GENERATE_LOG_SECONDS = histogram("generate_log_seconds", "Time generate_log takes on the monitor thread, including send_notification")
+LOG_ENTRIES_WRITTEN = counter("log_entries_written_total", "Threat log lines written")
+LOG_WRITE_BATCH_SECONDS = histogram("log_write_batch_seconds", "Time to write and flush one batch of threat log lines")
+LOG_FSYNC_SECONDS = histogram("log_fsync_seconds", "Duration of threat log fsyncs")
+LOG_WRITER_QUEUE_DEPTH = gauge("log_writer_queue_depth", "Threat log entries waiting to be written")
+
+
+def encode_entry(entry):
+    """
+    Encodes a log entry as one JSON line, using orjson when it is installed.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(entry).decode("utf-8")
+        except TypeError:
+            # orjson rejects some types (e.g. non-string keys) that json handles.
+            pass
+    return json.dumps(entry)
+
+
+class ThreatLogWriter:
+    """
+    Writes threat log lines to the shared log file from a background thread.
+    Callers only enqueue entries (dicts are JSON-encoded by the writer thread, strings
+    are written as they are). The thread drains the queue in batches, writes a batch
+    with one flush and fsyncs the file at most once per fsync_interval (group commit),
+    so bursts of alerts no longer cost a disk flush per record on the monitor thread.
+    The file is still one JSON entry per line and rotates like RotatingFileHandler
+    (5MB, 5 backups), which is what sftp_uploader expects.
+    """
+
+    def __init__(self, filename=SHARED_LOG_FILE, max_bytes=5 * 1024 * 1024, backup_count=5,
+                 fsync_interval=DEFAULT_FSYNC_INTERVAL, queue_size=WRITER_QUEUE_SIZE, announce=True,
+                 on_written=None):
+        self.filename = filename
+        self.fsync_interval = fsync_interval
+        # Whether each written batch is announced on the console.
+        self.announce = announce
+        # Called with every batch written and flushed (e.g. to trigger an early upload).
+        self.on_written = on_written
+        # The handler only provides the file stream and the rotation (doRollover).
+        self._file = RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count,
+                                         encoding="utf-8")
+        # Bounded, so a stalled disk slows detection down instead of exhausting memory.
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._last_fsync = time.monotonic()
+        self._unsynced = False
+        self.written = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="ThreatLogWriterThread", daemon=True)
+        self._thread.start()
+        return self
+
+    def write(self, entry):
+        """
+        Queues a log entry (dict) or a preformatted line (str) for writing.
+        Blocks if the queue is full.
+        """
+        self._queue.put(entry)
+
+    def stop(self, timeout=10):
+        """
+        Writes everything still queued, fsyncs the file and stops the writer thread.
+        """
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            status_logger.warning("Threat log writer did not finish within %s seconds", timeout)
+        self._thread = None
+
+    def _next_batch(self):
+        """
+        Blocks for the next entry, then takes whatever else is already queued.
+        Returns the batch and whether the stop sentinel was seen.
+        """
+        batch = [self._queue.get()]
+        while len(batch) < MAX_WRITE_BATCH:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if None in batch:
+            return [entry for entry in batch if entry is not None], True
+        return batch, False
+
+    def _write_batch(self, batch):
+        handler = self._file
+        if handler.stream is None:
+            handler.stream = handler._open()
+        for entry in batch:
+            line = (entry if isinstance(entry, str) else encode_entry(entry)) + "\n"
+            # Same size check as RotatingFileHandler.shouldRollover, without a LogRecord,
+            # counting bytes since tell() is a byte offset.
+            size = len(line.encode(handler.encoding or "utf-8"))
+            if handler.maxBytes > 0 and handler.stream.tell() + size >= handler.maxBytes:
+                # Make sure the rotated file is complete on disk before it is renamed.
+                self._sync()
+                handler.doRollover()
+            handler.stream.write(line)
+        handler.stream.flush()
+        self._unsynced = True
+        self.written += len(batch)
+
+    def _sync(self):
+        stream = self._file.stream
+        if stream is not None and self._unsynced:
+            stream.flush()
+            with LOG_FSYNC_SECONDS.time():
+                os.fsync(stream.fileno())
+        self._unsynced = False
+        self._last_fsync = time.monotonic()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            try:
+                if batch:
+                    with LOG_WRITE_BATCH_SECONDS.time():
+                        self._write_batch(batch)
+                    LOG_ENTRIES_WRITTEN.inc(len(batch))
+                    if self.announce and len(batch) == 1:
+                        print("Threat detected! Log entry created.")
+                    elif self.announce:
+                        print(f"Threat detected! {len(batch)} log entries created.")
+                    if self.on_written is not None:
+                        try:
+                            self.on_written(batch)
+                        except Exception:
+                            status_logger.exception("Threat log on_written callback failed")
+                if stopping or time.monotonic() - self._last_fsync >= self.fsync_interval:
+                    self._sync()
+            except OSError as e:
+                status_logger.error("Failed to write threat log entries: %s", e)
+            except Exception:
+                # The writer must keep draining the queue, or write() blocks once it is full.
+                status_logger.exception("Unexpected error in the threat log writer")
+        self._file.close()
+
+
+class ThreatLogHandler(logging.Handler):
+    """
+    Logging handler feeding the ThreatLogger's messages to the threat log writer.
+    """
+
+    def emit(self, record):
+        try:
+            get_log_writer().write(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_log_writer():
+    """
+    Returns the shared threat log writer, starting its thread on first use.
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            fsync_interval = float(load_config().get("log_fsync_interval", DEFAULT_FSYNC_INTERVAL))
+            # Urgent detections make the uploader ship the log early.
+            _writer = ThreatLogWriter(
+                fsync_interval=fsync_interval,
+                on_written=get_upload_scheduler().notify_written
+            ).start()
+            LOG_WRITER_QUEUE_DEPTH.set_function(_writer._queue.qsize)
+        return _writer
+
+
+def stop_log_writer(timeout=10):
+    """
+    Flushes and fsyncs queued threat log entries and stops the writer, if it was started.
+    """
+    global _writer
+    with _writer_lock:
+        writer, _writer = _writer, None
+    if writer is not None:
+        writer.stop(timeout)
+
 
 def setup_logger():
     """
-    Sets up a rotating file logger that writes threat logs in JSON format.
-    Log file rotates when it reaches 5MB, keeping 5 backups.
+    Sets up the threat logger. Its messages are written to the shared log file by the
+    threat log writer, which rotates the file when it reaches 5MB, keeping 5 backups.
     Ensures only one handler is attached to avoid duplicate logs.
     """
     logger = logging.getLogger("ThreatLogger")
@@ -27,14 +237,8 @@ def setup_logger():
 
     # Only configure the logger once.
     if not getattr(logger, "_is_configured", False):
-        # Create a file handler with rotation to manage large log files.
-        handler = RotatingFileHandler(
-            SHARED_LOG_FILE,
-            maxBytes=5 * 1024 * 1024,  # 5MB
-            backupCount=5,
-            encoding="utf-8"
-        )
-        # Define a simple formatter that outputs only the message (JSON string).
+        handler = ThreatLogHandler()
+        # Define a simple formatter that outputs only the message.
         formatter = logging.Formatter('%(message)s')
         handler.setFormatter(formatter)
         logger.addHandler(handler)
@@ -53,44 +257,40 @@ logger = setup_logger()
 def extract_executed_code(cmdline_parts):
     """
     Extracts the actual executed PowerShell code from command-line arguments.
-    Handles different cases:
+    Handles different cases (parameter names may be abbreviated, e.g. -c, -enc, -f):
       - "-Command": Inline PowerShell code provided directly.
       - "-EncodedCommand": Base64 encoded Unicode command which is decoded.
       - "-File": A script file is specified; its contents are read from disk.
+    Decoded commands and script contents come from the caches of payload_decoder,
+    so a payload already decoded for rule matching is not decoded or read again.
     Returns a string with the executed code or an error message if extraction fails.
     """
     if not cmdline_parts:
         return "N/A"
 
     try:
-        if "-Command" in cmdline_parts:
-            idx = cmdline_parts.index("-Command")
-            # Concatenate all parts after "-Command" as the inline command.
-            return " ".join(cmdline_parts[idx + 1:])
-        elif "-EncodedCommand" in cmdline_parts:
-            idx = cmdline_parts.index("-EncodedCommand")
-            encoded = cmdline_parts[idx + 1]
+        arguments = parse_powershell_arguments(cmdline_parts)
+        if arguments["command"] is not None:
+            # All parts after "-Command" form the inline command.
+            return arguments["command"]
+        elif arguments["encoded"] is not None:
             try:
                 # Decode the Base64 string and then decode it from UTF-16LE to get the original code.
-                decoded = base64.b64decode(encoded).decode("utf-16le")
-                return decoded
-            except Exception as e:
-                logger.exception("Failed to decode encoded command")
+                return decode_encoded_command(arguments["encoded"])
+            except ValueError as e:
+                status_logger.warning("Failed to decode encoded command: %s", e)
                 return f"[Failed to decode encoded command: {str(e)}]"
-        elif "-File" in cmdline_parts:
-            idx = cmdline_parts.index("-File")
-            script_path = cmdline_parts[idx + 1]
-            if os.path.isfile(script_path):
-                try:
-                    with open(script_path, "r", encoding="utf-8", errors="ignore") as f:
-                        return f.read()
-                except Exception as e:
-                    logger.exception("Error reading script file")
-                    return f"[Error reading script file: {script_path} - {str(e)}]"
-            else:
+        elif arguments["file"] is not None:
+            script_path = arguments["file"]
+            try:
+                return read_script(script_path)
+            except FileNotFoundError:
                 return f"[Script file not found: {script_path}]"
+            except OSError as e:
+                status_logger.warning("Error reading script file %s: %s", script_path, e)
+                return f"[Error reading script file: {script_path} - {str(e)}]"
     except Exception as e:
-        logger.exception("Failed to extract executed code from cmdline")
+        status_logger.exception("Failed to extract executed code from cmdline")
         return f"[Failed to extract executed code: {str(e)}]"
 
     return "N/A"
@@ -98,7 +298,7 @@ def extract_executed_code(cmdline_parts):
 
 def generate_log(rule, proc):
     """
-    Creates a JSON-formatted threat log entry and writes it to the shared log file.
+    Creates a JSON-formatted threat log entry and queues it for the shared log file.
     The log includes:
       - Timestamp in ISO 8601 format.
       - User information.
@@ -106,21 +306,38 @@ def generate_log(rule, proc):
       - The extracted executed PowerShell code.
       - Information about the matching rule.
     """
+    with GENERATE_LOG_SECONDS.time():
+        _generate_log(rule, proc)
+
+
+def build_log_entry(rule, proc):
+    """
+    Builds the threat log entry of a process matching a rule.
+    Live processes get the current time and user, and their parent and grandparent
+    ("ancestry", see process_ancestry). Replayed events (see replay.py) may carry their own
+    "timestamp" and "user" in proc.info, and script block events their code as "script"
+    instead of a command line.
+    """
+    info = proc.info
     # Get the current timestamp in ISO 8601 format.
-    current_time = datetime.now().isoformat()
+    current_time = info.get("timestamp") or datetime.now().isoformat()
 
     # Extract command-line parts from the process info.
-    cmdline_parts = proc.info.get("cmdline", [])
+    cmdline_parts = info.get("cmdline", [])
     cmdline_str = " ".join(cmdline_parts) if cmdline_parts else "N/A"
-    # Extract the actual code executed via PowerShell from the command-line.
-    executed_code = extract_executed_code(cmdline_parts)
+    if cmdline_parts or not info.get("script"):
+        # Extract the actual code executed via PowerShell from the command-line.
+        executed_code = extract_executed_code(cmdline_parts)
+    else:
+        # A script block event carries the executed code itself.
+        executed_code = info["script"]
 
     # Build the log entry as a dictionary.
     log_entry = {
         "timestamp": current_time,
-        "user": USERNAME,
-        "process": proc.info.get("name", "Unknown"),
-        "pid": proc.info.get("pid", "Unknown"),
+        "user": info.get("user") or USERNAME,
+        "process": info.get("name", "Unknown"),
+        "pid": info.get("pid", "Unknown"),
         "cmdline": cmdline_str,
         "executed_code": executed_code,
         "rule": {
@@ -132,17 +349,23 @@ def generate_log(rule, proc):
             "references": rule.get("references", [])
         }
     }
+    if info.get("ancestry"):
+        # Parent first: pid, name, exe and user of each ancestor.
+        log_entry["ancestry"] = info["ancestry"]
+    return log_entry
 
-    # Write the JSON-formatted log entry to the shared log file.
+
+def _generate_log(rule, proc):
+    """
+    Builds the log entry of generate_log, queues it and sends the notification.
+    """
+    log_entry = build_log_entry(rule, proc)
+
+    # Queue the log entry for the writer thread, which encodes it as JSON and
+    # appends it to the shared log file.
     try:
-        logger.info(json.dumps(log_entry))
-        print(f"Threat detected! Log entry created at {current_time}")
+        get_log_writer().write(log_entry)
         # Send the log entry to the telegram bot for notification.
         send_notification(log_entry, rule.get("level", "medium"))
-    except OSError as e:
-        logger.error("Failed to write log entry: %s", e)
-    except json.JSONDecodeError as e:
-        logger.error("Failed to encode log entry to JSON: %s", e)
-
-    except Exception as e:
-        logger.exception("Failed to write log entry")
+    except Exception:
+        status_logger.exception("Failed to write log entry")
@@ -1,5 +1,4 @@
 import threading
-import time
 import logging
 import logging.handlers
 import signal
@@ -7,9 +6,15 @@ import sys
 import getpass
 
 from process_monitor import monitor_system
-from sftp_uploader import upload_files, init_sftp
-from rules_loader import load_rules
-from server_config import get_server_ip_and_port
+from sftp_uploader import upload_files, init_sftp, close_connections, pending_upload_bytes, load_checkpoint
+from rules_loader import refresh_rules
+from rules_watcher import RulesWatcher
+from server_config import get_server_endpoints, load_config
+from upload_endpoints import create_endpoint_pool
+from notification_generator import get_chat_ids, stop_dispatcher, close_dedupe_store
+from log_generator import stop_log_writer
+from metrics import create_metrics_exporter
+from scheduler import get_upload_scheduler
 
 # Global event for graceful shutdown
 stop_event = threading.Event()
@@ -31,32 +36,34 @@ def setup_logging():
     logging.basicConfig(level=logging.INFO, handlers=[file_handler, stream_handler])
     logging.info("Logging is set up with TimedRotatingFileHandler.")
 
-def continuous_monitoring(rules, stop_event):
+def continuous_monitoring(rules, stop_event, rules_watcher=None):
     """
     Continuously monitor processes.
     The monitor_system() function must accept stop_event as a parameter
     and check its state in its loop to exit gracefully.
+    Rule sets reloaded by rules_watcher are swapped in without restarting.
     """
     try:
-        monitor_system(rules, stop_event)
+        monitor_system(rules, stop_event, rules_watcher=rules_watcher)
     except Exception as e:
         logging.error("Error in continuous_monitoring: %s", e, exc_info=True)
 
-def continuous_upload(server_ip, stop_event, upload_interval=30, server_port=22):
+def continuous_upload(endpoints, stop_event, scheduler):
     """
-    Periodically run the upload_files() function.
-    After each upload iteration, wait for upload_interval seconds (or break early if stop_event is set).
+    Periodically run the upload_files() function against the logsink endpoint pool.
+    After each upload iteration, wait until the scheduler says the next one is due:
+    after "upload_max_interval" seconds, or earlier (but not before "upload_min_interval")
+    for a large backlog or an urgent detection. Breaks early if stop_event is set.
     """
+    scheduler.set_backlog_function(lambda: pending_upload_bytes(load_checkpoint()))
     while not stop_event.is_set():
         try:
-            upload_files(server_ip, server_port)
+            upload_files(endpoints)
         except Exception as e:
             logging.error("Error in continuous_upload: %s", e, exc_info=True)
-        # Wait upload_interval seconds in small increments to check stop_event regularly.
-        for _ in range(upload_interval):
-            if stop_event.is_set():
-                break
-            time.sleep(1)
+        scheduler.uploaded()
+        if not scheduler.wait(stop_event):
+            break
 
 def graceful_exit(signum, frame):
     """Handle graceful shutdown when receiving termination signals."""
@@ -65,34 +72,62 @@ def graceful_exit(signum, frame):
 
 def main():
     setup_logging()
+    # Fail at startup, not at the first detection, if no Telegram chat is configured.
+    get_chat_ids()
 
     # Register signal handlers for graceful shutdown
     signal.signal(signal.SIGINT, graceful_exit)
     signal.signal(signal.SIGTERM, graceful_exit)
 
     logging.info("Loading rules...")
-    rules = load_rules()
+    rules, rule_files, _ = refresh_rules()
     if not rules:
         logging.warning("No rules loaded. Exiting.")
         sys.exit(0)
+    # Watch the rules directory so edited rules apply without restarting the agent
+    # (set "rules_watcher" to "off" in server_config.json to disable).
+    rules_watcher = RulesWatcher(rules, rule_files)
+    watch_rules = load_config().get("rules_watcher", "auto") != "off"
 
-    server_ip, server_port = get_server_ip_and_port()
+    # Logsink endpoints ("servers", or "server_ip"/"server_port"), with failover between them.
+    endpoints = create_endpoint_pool(get_server_endpoints(), load_config())
     logging.info("Initializing SFTP (UUID generation and remote directory creation)...")
     user = getpass.getuser()
     # One-time SFTP init: generate or load UUID and create remote user dir
-    init_sftp(user, server_ip, server_port)
+    init_sftp(user, endpoints)
 
     logging.info("Starting continuous monitoring and periodic upload tasks...")
     # Create threads for monitoring and uploading
-    monitor_thread = threading.Thread(target=continuous_monitoring, args=(rules, stop_event), name="MonitorThread")
-    uploader_thread = threading.Thread(target=continuous_upload, args=(server_ip, stop_event, 30, server_port), name="UploaderThread")
+    monitor_thread = threading.Thread(target=continuous_monitoring, args=(rules, stop_event, rules_watcher), name="MonitorThread")
+    uploader_thread = threading.Thread(target=continuous_upload, args=(endpoints, stop_event, get_upload_scheduler()), name="UploaderThread")
+    rules_thread = threading.Thread(target=rules_watcher.run, args=(stop_event,), name="RulesWatcherThread")
+    # Serve metrics on "metrics_port" (if set) and dump them to "metrics_file" periodically.
+    metrics_exporter = create_metrics_exporter(load_config())
+    metrics_thread = threading.Thread(target=metrics_exporter.run, args=(stop_event,), name="MetricsThread")
 
     monitor_thread.start()
     uploader_thread.start()
+    if watch_rules:
+        rules_thread.start()
+    metrics_thread.start()
 
-    # Wait for both threads to finish
+    # Wait for all threads to finish
     monitor_thread.join()
     uploader_thread.join()
+    if watch_rules:
+        rules_thread.join()
+
+    # Write and fsync threat log entries that are still queued.
+    stop_log_writer()
+    # Flush notifications that are still queued before exiting.
+    stop_dispatcher()
+    # Persisted dedupe keys keep suppressing repeated alerts after a restart.
+    close_dedupe_store()
+    # Close the persistent SFTP session.
+    close_connections()
+    # Write the final metrics, including the shutdown flushes above.
+    metrics_thread.join()
+    metrics_exporter.dump()
 
     logging.info("Program terminated gracefully.")
 
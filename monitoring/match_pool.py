@@ -0,0 +1,117 @@
+import os
+import logging
+import multiprocessing
+
+from rules_loader import RuleSet
+
+# Configure basic logging to output messages with level INFO or higher.
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Batches smaller than this are matched in the calling thread; below it the
+# round trip to a worker costs more than the matching itself.
+DEFAULT_MIN_BATCH = 16
+
+# State of a worker process, set once by _init_worker.
+_worker_ruleset = None
+_worker_match = None
+_worker_positions = None
+
+
+def _init_worker(compiled_rules, automaton, match_function):
+    """
+    Links the compiled rules once when a worker process starts.
+    """
+    global _worker_ruleset, _worker_match, _worker_positions
+    _worker_ruleset = RuleSet(compiled_rules, automaton)
+    _worker_match = match_function
+    # Matches are sent back as rule positions, which is much cheaper than pickling rule dicts.
+    _worker_positions = {id(rule): position for position, rule in enumerate(_worker_ruleset.rules)}
+
+
+def _match_process(proc):
+    """
+    Runs in a worker: returns the positions of the rules matching the process.
+    """
+    return [_worker_positions[id(rule)] for rule in _worker_match(_worker_ruleset, proc)]
+
+
+class MatcherPool:
+    """
+    Evaluates batches of processes against the rules in a pool of worker processes,
+    so matching is no longer limited to one core by the GIL.
+    Every worker links its own copy of the compiled rule set once, at start-up. The batch
+    is sharded across the workers and the matches come back in the order of the batch,
+    so the caller stays the single writer of the resulting logs.
+    """
+
+    def __init__(self, ruleset, match_function, workers=None, min_batch=DEFAULT_MIN_BATCH):
+        """
+        match_function(ruleset, proc) returns the rules matching a process; it must be a
+        module-level function so that it can be sent to the workers.
+        """
+        self.match_function = match_function
+        self.workers = workers or os.cpu_count() or 1
+        self.min_batch = min_batch
+        self.ruleset = None
+        self._pool = None
+        self.update(ruleset)
+
+    def update(self, ruleset):
+        """
+        Switches to another rule set (e.g. after a reload), restarting the workers.
+        """
+        if ruleset is self.ruleset:
+            return
+        self.close()
+        self.ruleset = ruleset
+        # Workers are spawned rather than forked, because forking a process that runs
+        # other threads can leave locks (e.g. of logging handlers) held in the child.
+        context = multiprocessing.get_context("spawn")
+        self._pool = context.Pool(
+            self.workers,
+            initializer=_init_worker,
+            initargs=(ruleset.compiled, ruleset.automaton, self.match_function)
+        )
+        logger.info("Started %d rule matching worker processes", self.workers)
+
+    def match(self, procs):
+        """
+        Returns, for each process of the batch, the list of matching rules.
+        Small batches, and batches arriving while the pool is broken, are matched inline.
+        """
+        if len(procs) < self.min_batch or self._pool is None:
+            return [self.match_function(self.ruleset, proc) for proc in procs]
+        # Give every worker a few chunks, so one slow chunk does not hold up the batch.
+        chunksize = max(1, len(procs) // (self.workers * 4))
+        try:
+            positions = self._pool.map(_match_process, procs, chunksize)
+        except Exception as e:
+            logger.error("Worker pool failed, matching batch inline: %s", e, exc_info=True)
+            return [self.match_function(self.ruleset, proc) for proc in procs]
+        rules = self.ruleset.rules
+        return [[rules[position] for position in matched] for matched in positions]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+
+def create_matcher_pool(ruleset, match_function, workers=0, min_batch=DEFAULT_MIN_BATCH):
+    """
+    Creates a MatcherPool from the "match_workers" setting: 0 (the default) disables the
+    pool, "auto" uses one worker per CPU, any other number is the number of workers.
+    Returns None when matching should stay in the calling thread.
+    """
+    if workers == "auto":
+        workers = os.cpu_count() or 1
+    try:
+        workers = int(workers)
+    except (TypeError, ValueError):
+        logger.warning("Invalid match_workers setting %r, matching in the monitor thread", workers)
+        return None
+    if workers <= 0:
+        return None
+    return MatcherPool(ruleset, match_function, workers, min_batch)
@@ -0,0 +1,306 @@
+import os
+import time
+import logging
+import tempfile
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Configure basic logging to output messages with level INFO or higher.
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Default file the metrics are periodically written to ("metrics_file" in server_config.json).
+DEFAULT_METRICS_FILE = os.path.join(BASE_DIR, "logs", "metrics.prom")
+DEFAULT_DUMP_INTERVAL = 60.0
+# Histogram buckets (seconds) suited to the per-process and per-batch timings of the agent.
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_PREFIX = "pswatchdog_"
+
+
+def format_value(value):
+    """
+    Formats a sample value the way the Prometheus text format expects it.
+    """
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    """
+    A monotonically increasing value (e.g. processes scanned).
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def samples(self):
+        return [(self.name, self._value)]
+
+
+class Gauge:
+    """
+    A value that goes up and down (e.g. upload backlog). Either set explicitly or,
+    with set_function, read from a callback each time the metrics are collected.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._value = 0
+        self._function = None
+
+    def set(self, value):
+        self._value = value
+
+    def set_function(self, function):
+        self._function = function
+
+    @property
+    def value(self):
+        if self._function is not None:
+            try:
+                return self._function()
+            except Exception as e:
+                logger.debug("Could not collect gauge %s: %s", self.name, e)
+                return float("nan")
+        return self._value
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+
+class Histogram:
+    """
+    Distribution of observed values (e.g. durations in seconds) over fixed buckets.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        # One count per bucket plus the +Inf bucket; cumulated when collected.
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def time(self):
+        """
+        Returns a context manager observing the duration of its block.
+        """
+        return _Timer(self)
+
+    def samples(self):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            samples.append((f'{self.name}_bucket{{le="{format_value(float(bound))}"}}', cumulative))
+        samples.append((f"{self.name}_sum", total))
+        samples.append((f"{self.name}_count", cumulative))
+        return samples
+
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class MetricsRegistry:
+    """
+    Holds the agent's metrics by name. Modules create (or look up) their metrics at
+    import time; the same name always returns the same metric.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, help_text, *args):
+        name = METRIC_PREFIX + name
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text, *args)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name} is already registered as a {metric.kind}")
+            return metric
+
+    def counter(self, name, help_text):
+        return self._get_or_create(Counter, name, help_text)
+
+    def gauge(self, name, help_text):
+        return self._get_or_create(Gauge, name, help_text)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help_text, buckets)
+
+    def render(self):
+        """
+        Returns all metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for sample_name, value in metric.samples():
+                lines.append(f"{sample_name} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """
+        Writes the rendered metrics to a file atomically (tempfile + rename).
+        """
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", delete=False, dir=directory) as tmp_file:
+            tmp_file.write(self.render())
+            temp_name = tmp_file.name
+        os.replace(temp_name, path)
+
+
+# The registry shared by all modules of the agent.
+REGISTRY = MetricsRegistry()
+
+
+def counter(name, help_text):
+    return REGISTRY.counter(name, help_text)
+
+
+def gauge(name, help_text):
+    return REGISTRY.gauge(name, help_text)
+
+
+def histogram(name, help_text, buckets=DEFAULT_BUCKETS):
+    return REGISTRY.histogram(name, help_text, buckets)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are frequent; keep them out of the agent's log.
+        pass
+
+
+class MetricsExporter:
+    """
+    Exposes the registry over a local HTTP endpoint (Prometheus text format on /metrics)
+    and periodically dumps it to a file, so the last values survive the agent.
+    """
+
+    def __init__(self, registry=REGISTRY, port=None, host="127.0.0.1",
+                 metrics_file=DEFAULT_METRICS_FILE, dump_interval=DEFAULT_DUMP_INTERVAL):
+        self.registry = registry
+        self.port = port
+        self.host = host
+        self.metrics_file = metrics_file
+        self.dump_interval = dump_interval
+        self._server = None
+
+    def start_server(self):
+        """
+        Starts the HTTP endpoint in a daemon thread, if a port is configured.
+        """
+        if not self.port:
+            return
+        handler = type("MetricsRequestHandler", (_MetricsRequestHandler,), {"registry": self.registry})
+        try:
+            self._server = ThreadingHTTPServer((self.host, int(self.port)), handler)
+        except OSError as e:
+            logger.error("Could not start metrics endpoint on %s:%s: %s", self.host, self.port, e)
+            return
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="MetricsServerThread", daemon=True).start()
+        logger.info("Serving metrics on http://%s:%s/metrics", self.host, self._server.server_address[1])
+
+    def dump(self):
+        if not self.metrics_file:
+            return
+        try:
+            self.registry.dump(self.metrics_file)
+        except OSError as e:
+            logger.warning("Could not write metrics file %s: %s", self.metrics_file, e)
+
+    def run(self, stop_event):
+        """
+        Serves the endpoint and dumps the metrics file every dump_interval seconds
+        until stop_event is set. Call dump() once more after shutdown to record the
+        final values.
+        """
+        self.start_server()
+        try:
+            while not stop_event.wait(self.dump_interval):
+                self.dump()
+        finally:
+            if self._server is not None:
+                self._server.shutdown()
+                self._server.server_close()
+
+
+def create_metrics_exporter(config):
+    """
+    Creates the exporter from server_config.json settings: "metrics_port" (no HTTP
+    endpoint unless set), "metrics_host", "metrics_file" (empty disables the dump)
+    and "metrics_dump_interval".
+    """
+    return MetricsExporter(
+        port=config.get("metrics_port"),
+        host=config.get("metrics_host", "127.0.0.1"),
+        metrics_file=config.get("metrics_file", DEFAULT_METRICS_FILE),
+        dump_interval=float(config.get("metrics_dump_interval", DEFAULT_DUMP_INTERVAL)),
+    )
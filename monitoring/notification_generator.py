@@ -1,22 +1,58 @@
 import html
 import requests
-import hashlib
-import json
+import time
+import queue
+import logging
+import threading
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 import os
+from dedupe_store import DedupeStore, DEFAULT_DB_FILE, DEFAULT_KEY_FIELDS
+from metrics import counter, gauge, histogram
 
 
 load_dotenv()  # Load variables from .env
 TOKEN = os.getenv("TELEGRAM_TOKEN")
 IDS = os.getenv("TELEGRAM_CHAT_IDS", "").split(",")
-url_updates = f"https://api.telegram.org/bot{TOKEN}/getUpdates"
-if not IDS or IDS == [""]:
-    response = requests.get(url_updates)
-    print(response.json())
-    raise ValueError("TELEGRAM_CHAT_IDS environment variable is not set or is empty. Send message to the bot and get your chat ID into .env and start script again.")
-
-# Store hashes of sent logs to avoid duplicates
-_sent_log_hashes = set()
+# Base URL of the Bot API; can be pointed at a local stub server for testing.
+API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+url_updates = f"{API_URL}/bot{TOKEN}/getUpdates"
+
+# Dispatcher tuning, overridable from .env.
+QUEUE_SIZE = int(os.getenv("TELEGRAM_QUEUE_SIZE", "1000"))
+# Alerts arriving within this many seconds of the first one are sent as one digest.
+DIGEST_WINDOW = float(os.getenv("TELEGRAM_DIGEST_WINDOW", "2"))
+MAX_DIGEST_ALERTS = 20
+MAX_RETRIES = 5
+# (connect, read) timeouts for Bot API requests.
+REQUEST_TIMEOUT = (5, 15)
+# Telegram allows about one message per second per chat and 30 per second overall.
+PER_CHAT_INTERVAL = 1.0
+GLOBAL_INTERVAL = 1.0 / 30
+# Telegram rejects messages longer than 4096 characters.
+MAX_MESSAGE_LENGTH = 4096
+# Alert deduplication, overridable from .env: the same alert (by default the same rule,
+# user and normalized cmdline) is sent at most once per window, also across restarts.
+DEDUPE_WINDOW = float(os.getenv("DEDUPE_WINDOW", "3600"))
+DEDUPE_MAX_ENTRIES = int(os.getenv("DEDUPE_MAX_ENTRIES", "10000"))
+DEDUPE_KEY_FIELDS = tuple(
+    field.strip() for field in os.getenv("DEDUPE_KEY_FIELDS", ",".join(DEFAULT_KEY_FIELDS)).split(",")
+    if field.strip()
+)
+DEDUPE_DB_FILE = os.getenv("DEDUPE_DB_FILE", DEFAULT_DB_FILE)
+
+logger = logging.getLogger(__name__)
+
+SEND_NOTIFICATION_SECONDS = histogram("send_notification_seconds", "Time send_notification takes on the calling (monitor) thread")
+NOTIFICATIONS_SUPPRESSED = counter("notifications_suppressed_total", "Alerts suppressed as duplicates")
+NOTIFICATIONS_ENQUEUED = counter("notifications_enqueued_total", "Alerts queued for Telegram")
+NOTIFICATIONS_DROPPED = counter("notifications_dropped_total", "Alerts dropped because the notification queue was full")
+TELEGRAM_MESSAGES_SENT = counter("telegram_messages_sent_total", "Telegram messages delivered")
+TELEGRAM_SEND_FAILURES = counter("telegram_send_failures_total", "Telegram messages given up on or rejected")
+TELEGRAM_REQUEST_SECONDS = histogram("telegram_request_seconds", "Duration of Bot API sendMessage requests")
+NOTIFICATION_QUEUE_DEPTH = gauge("notification_queue_depth", "Alerts waiting in the notification queue")
+DEDUPE_ENTRIES = gauge("dedupe_entries", "Alert keys held in memory by the dedupe store")
+
 """
 log_entry = {
         "timestamp": current_time,
@@ -36,41 +72,298 @@ log_entry = {
     }
 """
 
-def send_notification(logs: dict, severity: str):
-    # Remove 'timestamp' from logs before hashing
-    logs_for_hash = dict(logs)  # shallow copy
-    logs_for_hash.pop("timestamp", None)
-    log_hash = hashlib.sha256(json.dumps(logs_for_hash, sort_keys=True).encode()).hexdigest()
-    if log_hash in _sent_log_hashes:
-        print("Duplicate threat detected, notification not sent.")
-        return
-    _sent_log_hashes.add(log_hash)
-
-    # Send Telegram notification
-    url = f"https://api.telegram.org/bot{TOKEN}/sendMessage"
-    for chat_id in IDS:
-        # Format the log for better readability in Telegram
+
+def format_message(logs, severity):
+    """
+    Formats a single log entry as an HTML Telegram message.
+    """
+    rule = logs.get("rule", {})
+    # Parent chain, e.g. "winword.exe (PID 4242) <- explorer.exe (PID 1337)".
+    parents = " &lt;- ".join(
+        f"{html.escape(str(ancestor.get('name') or 'Unknown'))} (PID {html.escape(str(ancestor.get('pid')))})"
+        for ancestor in logs.get("ancestry", [])
+    )
+    parent_line = f"<b>Parent:</b> {parents}\n" if parents else ""
+    return (
+        f"<b>PSWatchdog Alert</b>\n"
+        f"<b>Severity:</b> {html.escape(severity)}\n"
+        f"<b>User:</b> {html.escape(logs.get('user', 'Unknown'))}\n"
+        f"<b>Process:</b> {html.escape(logs.get('process', 'Unknown'))} (PID: {html.escape(str(logs.get('pid', 'Unknown')))})\n"
+        f"{parent_line}"
+        f"<b>Cmdline:</b> {html.escape(logs.get('cmdline', 'N/A'))}\n"
+        f"<b>Executed Code:</b> {html.escape(logs.get('executed_code', 'N/A'))}\n"
+        f"<b>Rule:</b> {html.escape(rule.get('title', 'Unknown'))} (ID: {html.escape(rule.get('id', 'Unknown'))})\n"
+        f"<b>Description:</b> {html.escape(rule.get('description', 'No description available'))}\n"
+        f"<b>Tags:</b> {html.escape(', '.join(rule.get('tags', [])))}\n"
+        f"<b>References:</b> {html.escape('; '.join(rule.get('references', [])))}\n"
+    )
+
+
+def format_digest(alerts):
+    """
+    Formats a burst of alerts as one or more compact digest messages,
+    each within Telegram's message length limit.
+    """
+    header = f"<b>PSWatchdog Alert Digest</b> ({len(alerts)} alerts)\n"
+    messages = []
+    current = header
+    for logs, severity in alerts:
         rule = logs.get("rule", {})
-        log_message = (
-            f"<b>PSWatchdog Alert</b>\n"
-            f"<b>Severity:</b> {html.escape(severity)}\n"
-            f"<b>User:</b> {html.escape(logs.get('user', 'Unknown'))}\n"
-            f"<b>Process:</b> {html.escape(logs.get('process', 'Unknown'))} (PID: {html.escape(str(logs.get('pid', 'Unknown')))})\n"
-            f"<b>Cmdline:</b> {html.escape(logs.get('cmdline', 'N/A'))}\n"
-            f"<b>Executed Code:</b> {html.escape(logs.get('executed_code', 'N/A'))}\n"
-            f"<b>Rule:</b> {html.escape(rule.get('title', 'Unknown'))} (ID: {html.escape(rule.get('id', 'Unknown'))})\n"
-            f"<b>Description:</b> {html.escape(rule.get('description', 'No description available'))}\n"
-            f"<b>Tags:</b> {html.escape(', '.join(rule.get('tags', [])))}\n"
-            f"<b>References:</b> {html.escape('; '.join(rule.get('references', [])))}\n"
+        cmdline = logs.get("cmdline", "N/A")
+        if len(cmdline) > 200:
+            cmdline = cmdline[:200] + "..."
+        line = (
+            f"\n<b>[{html.escape(severity)}]</b> {html.escape(rule.get('title', 'Unknown'))}\n"
+            f"User: {html.escape(logs.get('user', 'Unknown'))}, "
+            f"Process: {html.escape(logs.get('process', 'Unknown'))} (PID: {html.escape(str(logs.get('pid', 'Unknown')))})\n"
+            f"Cmdline: {html.escape(cmdline)}\n"
         )
+        if len(current) + len(line) > MAX_MESSAGE_LENGTH and current != header:
+            messages.append(current)
+            current = header
+        current += line
+    messages.append(current)
+    return messages
+
+
+class RateLimiter:
+    """
+    Enforces a minimum interval between sends, per chat and globally.
+    """
+
+    def __init__(self, per_key_interval, global_interval):
+        self.per_key_interval = per_key_interval
+        self.global_interval = global_interval
+        self._next_for_key = {}
+        self._next_global = 0.0
+
+    def wait(self, key):
+        """
+        Blocks until a message may be sent to the given chat and reserves the slot.
+        """
+        now = time.monotonic()
+        send_at = max(now, self._next_for_key.get(key, 0.0), self._next_global)
+        if send_at > now:
+            time.sleep(send_at - now)
+        self._next_for_key[key] = send_at + self.per_key_interval
+        self._next_global = send_at + self.global_interval
+
+    def delay(self, key, seconds):
+        """
+        Pushes back the next allowed send for a chat (used when Telegram asks us to slow down).
+        """
+        self._next_for_key[key] = max(self._next_for_key.get(key, 0.0), time.monotonic() + seconds)
+
+
+class NotificationDispatcher:
+    """
+    Sends Telegram notifications from a background thread.
+    The monitor thread only enqueues alerts into a bounded queue; the worker
+    coalesces bursts into digest messages, respects Telegram's rate limits,
+    reuses one pooled HTTP session and retries failed requests with backoff.
+    """
+
+    def __init__(self, token, chat_ids, api_url=API_URL, queue_size=QUEUE_SIZE,
+                 digest_window=DIGEST_WINDOW):
+        self.url = f"{api_url}/bot{token}/sendMessage"
+        self.chat_ids = [chat_id for chat_id in chat_ids if chat_id]
+        self.digest_window = digest_window
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._limiter = RateLimiter(PER_CHAT_INTERVAL, GLOBAL_INTERVAL)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._thread = threading.Thread(target=self._run, name="NotificationThread", daemon=True)
+        self.dropped = 0
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def enqueue(self, logs, severity):
+        """
+        Queues an alert without blocking. Returns False if the queue is full and it was dropped.
+        """
+        try:
+            self._queue.put_nowait((logs, severity))
+            NOTIFICATIONS_ENQUEUED.inc()
+            return True
+        except queue.Full:
+            self.dropped += 1
+            NOTIFICATIONS_DROPPED.inc()
+            logger.warning("Notification queue full, dropping alert (%d dropped so far)", self.dropped)
+            return False
+
+    def stop(self, timeout=10):
+        """
+        Stops the worker after it has sent what is already queued.
+        The worker is a daemon thread, so shutdown never waits longer than timeout.
+        """
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def _next_batch(self):
+        """
+        Waits for the next alert and collects any further alerts arriving within
+        the digest window. Returns an empty list if stopped with an empty queue.
+        """
+        while True:
+            try:
+                first = self._queue.get(timeout=0.5)
+                break
+            except queue.Empty:
+                if self._stop.is_set():
+                    return []
+        batch = [first]
+        deadline = time.monotonic() + self.digest_window
+        while len(batch) < MAX_DIGEST_ALERTS:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stop.is_set():
+                # On shutdown, take whatever is already queued without waiting.
+                remaining = 0
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                break
+            if len(batch) == 1:
+                messages = [format_message(*batch[0])]
+            else:
+                messages = format_digest(batch)
+            for chat_id in self.chat_ids:
+                for message in messages:
+                    self._send(chat_id, message)
+        self._session.close()
+
+    def _send(self, chat_id, text):
+        """
+        Sends one message to one chat, retrying with exponential backoff.
+        Honors Telegram's retry_after on HTTP 429; other client errors are not retried.
+        """
         params = {
             "chat_id": chat_id,
-            "text": log_message,
+            "text": text,
             "parse_mode": "HTML"
         }
-        try:
-            response = requests.post(url, data=params)
-            response.raise_for_status()
-            print("Telegram notification sent:", response.json())
-        except requests.RequestException as e:
-            print("Error sending Telegram notification:", e)
\ No newline at end of file
+        backoff = 1.0
+        for attempt in range(1, MAX_RETRIES + 1):
+            self._limiter.wait(chat_id)
+            try:
+                with TELEGRAM_REQUEST_SECONDS.time():
+                    response = self._session.post(self.url, data=params, timeout=REQUEST_TIMEOUT)
+                if response.status_code == 429:
+                    retry_after = 0
+                    try:
+                        retry_after = response.json().get("parameters", {}).get("retry_after", 0)
+                    except ValueError:
+                        pass
+                    self._limiter.delay(chat_id, max(retry_after, backoff))
+                    logger.warning("Telegram rate limit hit for chat %s, retrying in %ss", chat_id, max(retry_after, backoff))
+                elif 400 <= response.status_code < 500:
+                    logger.error("Telegram rejected notification for chat %s: %s", chat_id, response.text)
+                    TELEGRAM_SEND_FAILURES.inc()
+                    return False
+                else:
+                    response.raise_for_status()
+                    logger.debug("Telegram notification sent to chat %s", chat_id)
+                    TELEGRAM_MESSAGES_SENT.inc()
+                    return True
+            except requests.RequestException as e:
+                logger.warning("Error sending Telegram notification (attempt %d/%d): %s", attempt, MAX_RETRIES, e)
+                time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+        logger.error("Giving up on Telegram notification for chat %s after %d attempts", chat_id, MAX_RETRIES)
+        TELEGRAM_SEND_FAILURES.inc()
+        return False
+
+
+def get_chat_ids():
+    """
+    Returns the Telegram chat IDs to notify (TELEGRAM_CHAT_IDS).
+    If none are set, prints the bot's recent updates, which contain the chat ID of
+    everyone who messaged the bot, and raises ValueError. Only called once notifications
+    are actually sent, so importing this module needs neither the bot nor the network.
+    """
+    if not IDS or IDS == [""]:
+        response = requests.get(url_updates, timeout=10)
+        print(response.json())
+        raise ValueError("TELEGRAM_CHAT_IDS environment variable is not set or is empty. Send message to the bot and get your chat ID into .env and start script again.")
+    return IDS
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    """
+    Returns the shared dispatcher, starting its worker thread on first use.
+    """
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = NotificationDispatcher(TOKEN, get_chat_ids()).start()
+            NOTIFICATION_QUEUE_DEPTH.set_function(_dispatcher._queue.qsize)
+        return _dispatcher
+
+
+def stop_dispatcher(timeout=10):
+    """
+    Flushes queued notifications and stops the dispatcher thread, if it was started.
+    """
+    global _dispatcher
+    with _dispatcher_lock:
+        dispatcher, _dispatcher = _dispatcher, None
+    if dispatcher is not None:
+        dispatcher.stop(timeout)
+
+
+_dedupe_store = None
+_dedupe_lock = threading.Lock()
+
+
+def get_dedupe_store():
+    """
+    Returns the shared alert dedupe store, opening it on first use.
+    """
+    global _dedupe_store
+    with _dedupe_lock:
+        if _dedupe_store is None:
+            store = DedupeStore(DEDUPE_DB_FILE, DEDUPE_WINDOW, DEDUPE_MAX_ENTRIES, DEDUPE_KEY_FIELDS)
+            # Bound to this store, so a metrics dump after close_dedupe_store still reads it.
+            DEDUPE_ENTRIES.set_function(lambda: store.stats()["entries"])
+            _dedupe_store = store
+        return _dedupe_store
+
+
+def close_dedupe_store():
+    """
+    Logs the dedupe counters and closes the dedupe store, if it was opened.
+    """
+    global _dedupe_store
+    with _dedupe_lock:
+        store, _dedupe_store = _dedupe_store, None
+    if store is not None:
+        logger.info("Alert dedupe: %s", store.stats())
+        store.close()
+
+
+def send_notification(logs: dict, severity: str):
+    with SEND_NOTIFICATION_SECONDS.time():
+        # Suppress alerts already sent within the dedupe window (keyed by rule, user and cmdline).
+        if get_dedupe_store().check(logs):
+            NOTIFICATIONS_SUPPRESSED.inc()
+            print("Duplicate threat detected, notification not sent.")
+            return
+
+        # Hand the alert to the background dispatcher; sending happens off the monitor thread.
+        get_dispatcher().enqueue(logs, severity)
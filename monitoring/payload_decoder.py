@@ -0,0 +1,142 @@
+import os
+import stat
+import base64
+import binascii
+import logging
+from functools import lru_cache
+
+# Configure basic logging to output messages with level INFO or higher.
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Script files are read up to this many bytes; the rest of a larger file is not inspected.
+MAX_SCRIPT_BYTES = 1024 * 1024
+# Number of distinct encoded commands and script file versions kept decoded.
+DECODE_CACHE_SIZE = 1024
+SCRIPT_CACHE_SIZE = 256
+
+# PowerShell accepts "-", "/" and the Unicode dashes in front of parameter names.
+PARAMETER_PREFIXES = ("-", "/", "\u2013", "\u2014", "\u2015")
+# Parameters of powershell.exe / pwsh that take a value, which must be skipped while parsing.
+VALUE_PARAMETERS = (
+    "executionpolicy", "windowstyle", "version", "psconsolefile", "inputformat",
+    "outputformat", "configurationname", "workingdirectory", "custompipename", "settingsfile",
+)
+VALUE_PARAMETER_ALIASES = ("ep", "ex", "w", "v", "if", "of", "wd")
+
+
+def parameter_name(token):
+    """
+    Returns the lowercased name of a command line parameter (e.g. "-EnC" -> "enc"),
+    or None if the token is not a parameter.
+    """
+    if not token or not token.startswith(PARAMETER_PREFIXES):
+        return None
+    return token.lstrip("".join(PARAMETER_PREFIXES)).lower()
+
+
+def is_abbreviation(name, parameter):
+    """
+    Returns True if name is the parameter or an abbreviation of it, the way PowerShell
+    accepts any prefix of a parameter name (-e, -enc, -EncodedCommand).
+    """
+    return bool(name) and parameter.startswith(name)
+
+
+def parse_powershell_arguments(cmdline_parts):
+    """
+    Finds the payload parameters in a PowerShell host command line.
+    Returns a dict with the inline "command", the "encoded" command and the script "file"
+    (each None if absent). Parameter names are matched case-insensitively and may be
+    abbreviated (-e/-ec/-enc for -EncodedCommand, -f for -File, -c for -Command).
+    Parsing stops at -Command and -File, since the rest belongs to the command or script.
+    """
+    arguments = {"command": None, "encoded": None, "file": None}
+    index = 1
+    while index < len(cmdline_parts):
+        name = parameter_name(cmdline_parts[index])
+        has_value = index + 1 < len(cmdline_parts)
+        if name is None:
+            # The first positional argument is the command (or the script for pwsh).
+            break
+        if name == "ec" or is_abbreviation(name, "encodedcommand"):
+            if has_value:
+                arguments["encoded"] = cmdline_parts[index + 1]
+            index += 2
+        elif is_abbreviation(name, "command"):
+            arguments["command"] = " ".join(cmdline_parts[index + 1:])
+            break
+        elif is_abbreviation(name, "file"):
+            if has_value:
+                arguments["file"] = cmdline_parts[index + 1]
+            break
+        elif name in VALUE_PARAMETER_ALIASES or (
+                len(name) > 1 and any(parameter.startswith(name) for parameter in VALUE_PARAMETERS)):
+            index += 2
+        else:
+            index += 1
+    return arguments
+
+
+@lru_cache(maxsize=DECODE_CACHE_SIZE)
+def decode_encoded_command(encoded):
+    """
+    Decodes an -EncodedCommand value (base64 of UTF-16LE text).
+    Raises ValueError if the value is not valid base64 or UTF-16LE.
+    Results are cached by the encoded value, so a command repeated by a scheduled
+    task is decoded once.
+    """
+    encoded = encoded.strip().strip("'\"")
+    # Tolerate missing padding, which PowerShell itself accepts.
+    encoded += "=" * (-len(encoded) % 4)
+    try:
+        return base64.b64decode(encoded, validate=True).decode("utf-16le")
+    except (binascii.Error, UnicodeDecodeError) as e:
+        raise ValueError(f"invalid encoded command: {e}") from e
+
+
+@lru_cache(maxsize=SCRIPT_CACHE_SIZE)
+def _read_script_version(path, mtime_ns, size):
+    """
+    Reads (the first MAX_SCRIPT_BYTES of) one version of a script file.
+    mtime_ns and size are only part of the cache key.
+    """
+    with open(path, "rb") as f:
+        data = f.read(MAX_SCRIPT_BYTES)
+    # PowerShell scripts are often saved as UTF-16 with a byte order mark.
+    if data.startswith((b"\xff\xfe", b"\xfe\xff")):
+        return data.decode("utf-16", errors="ignore")
+    return data.decode("utf-8-sig", errors="ignore")
+
+
+def read_script(path):
+    """
+    Returns the content of a script file, read at most once per version of the file:
+    the cache is keyed by (path, modification time, size).
+    Raises OSError if the file cannot be read (FileNotFoundError if it does not exist).
+    """
+    file_stat = os.stat(path)
+    if not stat.S_ISREG(file_stat.st_mode):
+        raise FileNotFoundError(path)
+    return _read_script_version(path, file_stat.st_mtime_ns, file_stat.st_size)
+
+
+def decode_payload(cmdline_parts):
+    """
+    Returns the code hidden from a plain reading of the command line: the decoded
+    -EncodedCommand and/or the content of the -File script, or None if there is none
+    (or it cannot be decoded or read).
+    """
+    arguments = parse_powershell_arguments(cmdline_parts)
+    payloads = []
+    if arguments["encoded"]:
+        try:
+            payloads.append(decode_encoded_command(arguments["encoded"]))
+        except ValueError as e:
+            logger.debug("Could not decode encoded command: %s", e)
+    if arguments["file"]:
+        try:
+            payloads.append(read_script(arguments["file"]))
+        except OSError as e:
+            logger.debug("Could not read script file %s: %s", arguments["file"], e)
+    return "\n".join(payloads) if payloads else None
@@ -0,0 +1,131 @@
+import logging
+
+import psutil
+
+from metrics import counter
+
+# Configure basic logging to output messages with level INFO or higher.
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Ancestors reported per process (parent, grandparent), unless overridden with
+# "process_ancestry_depth" in server_config.json; 0 disables the enrichment.
+DEFAULT_ANCESTRY_DEPTH = 2
+# Upper bound on cached processes, for exits the process source did not report.
+DEFAULT_MAX_ENTRIES = 8192
+# Attributes read once for every ancestor process.
+ANCESTOR_ATTRS = ["ppid", "name", "exe", "username", "create_time"]
+
+ANCESTRY_READS = counter("ancestry_reads_total", "Ancestor processes read from the OS because they were not cached")
+
+
+class ProcessNode:
+    """
+    A cached ancestor process. parent links to the node of its own parent, so the
+    chain of a process stays available after an ancestor has exited; levels is how
+    many generations (itself included) have been resolved.
+    """
+
+    __slots__ = ("pid", "ppid", "create_time", "name", "exe", "user", "parent", "levels")
+
+    def __init__(self, pid, ppid, create_time, name, exe, user):
+        self.pid = pid
+        self.ppid = ppid
+        self.create_time = create_time
+        self.name = name
+        self.exe = exe
+        self.user = user
+        self.parent = None
+        self.levels = 1
+
+    def describe(self):
+        return {"pid": self.pid, "name": self.name, "exe": self.exe, "user": self.user}
+
+
+def read_process(pid):
+    """
+    Reads the attributes of an ancestor process. Returns None if it is gone.
+    Attributes that cannot be read (e.g. exe of another user's process) are None.
+    """
+    try:
+        return psutil.Process(pid).as_dict(attrs=ANCESTOR_ATTRS, ad_value=None)
+    except (psutil.NoSuchProcess, psutil.ZombieProcess, psutil.AccessDenied) as e:
+        logger.debug("Could not read ancestor process %s: %s", pid, e)
+        return None
+
+
+class AncestryCache:
+    """
+    Maps PIDs to the processes that launched target processes, maintained incrementally:
+    an ancestor is read from the OS once, when the first of its descendants is seen, and
+    forgotten when the process source reports its exit. A cached node is only reused for
+    processes that started after it, so a reused PID is read again.
+    """
+
+    def __init__(self, depth=DEFAULT_ANCESTRY_DEPTH, max_entries=DEFAULT_MAX_ENTRIES, reader=read_process):
+        self.depth = depth
+        self.max_entries = max_entries
+        self.reader = reader
+        self._nodes = {}
+
+    def _node(self, pid, started_before, levels):
+        """
+        Returns the node of process pid, resolving its ancestors up to levels deep,
+        or None if it is gone or is not the process that started before started_before.
+        """
+        if not pid or levels <= 0:
+            return None
+        node = self._nodes.get(pid)
+        if node is None or (started_before is not None and node.create_time is not None
+                            and node.create_time > started_before):
+            info = self.reader(pid)
+            ANCESTRY_READS.inc()
+            if info is None:
+                self._nodes.pop(pid, None)
+                return None
+            create_time = info.get("create_time")
+            if started_before is not None and create_time is not None and create_time > started_before:
+                # The PID was reused after the descendant started; its real ancestor is gone.
+                return None
+            node = ProcessNode(pid, info.get("ppid"), create_time, info.get("name"), info.get("exe"),
+                               info.get("username"))
+            if len(self._nodes) >= self.max_entries and pid not in self._nodes:
+                # Drop the oldest entry; it is most likely of a process whose exit was missed.
+                self._nodes.pop(next(iter(self._nodes)))
+            self._nodes[pid] = node
+        if node.levels < levels:
+            # Cached as a more distant ancestor; resolve the generations above it now.
+            if node.ppid != pid:
+                node.parent = self._node(node.ppid, node.create_time, levels - 1)
+            node.levels = levels
+        return node
+
+    def ancestry(self, info):
+        """
+        Returns the ancestors of a process (parent first, up to depth) from its psutil
+        info with "ppid" and "create_time", as a list of dicts with pid, name, exe and user.
+        """
+        chain = []
+        node = self._node(info.get("ppid"), info.get("create_time"), self.depth)
+        while node is not None and len(chain) < self.depth:
+            chain.append(node.describe())
+            node = node.parent
+        return chain
+
+    def enrich(self, proc):
+        """
+        Stores the ancestry of a process in its info as "ancestry".
+        """
+        if self.depth > 0:
+            proc.info["ancestry"] = self.ancestry(proc.info)
+        return proc
+
+    def evict(self, pids):
+        """
+        Forgets the given (exited) processes. Descendants keep their links to them.
+        """
+        for pid in pids:
+            self._nodes.pop(pid, None)
+
+    def __len__(self):
+        return len(self._nodes)
@@ -0,0 +1,332 @@
+import os
+import sys
+import errno
+import time
+import socket
+import select
+import struct
+import logging
+
+import psutil
+
+# Configure basic logging to output messages with level INFO or higher.
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Attributes collected for every reported process (ppid for process_ancestry).
+PROCESS_ATTRS = ["pid", "ppid", "name", "cmdline", "create_time"]
+
+# Lowercased substrings of process names worth inspecting. Renamed PowerShell hosts
+# (e.g. flagged by posh_pc_renamed_powershell.yml) can be added via "target_process_names"
+# in server_config.json.
+DEFAULT_TARGET_NAMES = ("powershell", "pwsh")
+
+PROC_DIR = "/proc"
+
+# Netlink proc connector constants (see linux/connector.h and linux/cn_proc.h).
+NETLINK_CONNECTOR = 11
+CN_IDX_PROC = 1
+CN_VAL_PROC = 1
+NLMSG_DONE = 3
+PROC_CN_MCAST_LISTEN = 1
+PROC_CN_MCAST_IGNORE = 2
+PROC_EVENT_EXEC = 0x00000002
+PROC_EVENT_EXIT = 0x80000000
+
+# struct nlmsghdr: len, type, flags, seq, pid
+NLMSGHDR = struct.Struct("=IHHII")
+# struct cn_msg: idx, val, seq, ack, len, flags
+CN_MSG = struct.Struct("=IIIIHH")
+# struct proc_event header: what, cpu, timestamp_ns
+PROC_EVENT_HEADER = struct.Struct("=IIQ")
+# Exec and exit events both start with process_pid, process_tgid.
+PROC_EVENT_IDS = struct.Struct("=II")
+
+
+class ProcessSnapshot:
+    """
+    A lightweight stand-in for psutil.Process carrying only the collected info dict,
+    so event-driven sources can hand processes to the monitor like process_iter does.
+    """
+
+    __slots__ = ("info",)
+
+    def __init__(self, info):
+        self.info = info
+
+
+def is_target_name(name, target_names):
+    """
+    Returns True if the process name contains any of the target substrings.
+    """
+    name = (name or "").lower()
+    return any(target in name for target in target_names)
+
+
+def _read_proc_stat(pid):
+    """
+    Reads the name and start time of a process from /proc/<pid>/stat.
+    The start time (in clock ticks since boot) tells a reused PID apart from the old process.
+    """
+    with open(f"{PROC_DIR}/{pid}/stat", "rb") as f:
+        stat = f.read()
+    # The name is enclosed in parentheses and may itself contain spaces or parentheses.
+    name_start = stat.index(b"(") + 1
+    name_end = stat.rindex(b")")
+    name = stat[name_start:name_end].decode("utf-8", errors="replace")
+    # Fields after the name start at field 3 (state); starttime is field 22.
+    fields = stat[name_end + 2:].split()
+    return name, int(fields[19])
+
+
+def enumerate_process_names():
+    """
+    Cheaply enumerates running processes without reading their command lines.
+    Returns a dict mapping (pid, identity) to the process name, where identity
+    distinguishes a reused PID from the previous process with the same PID.
+    On Linux only /proc/<pid>/stat is read; elsewhere psutil provides just the names.
+    """
+    processes = {}
+    if os.path.isdir(PROC_DIR) and sys.platform.startswith("linux"):
+        for entry in os.scandir(PROC_DIR):
+            if not entry.name.isdigit():
+                continue
+            pid = int(entry.name)
+            try:
+                name, start_time = _read_proc_stat(pid)
+            except (OSError, ValueError, IndexError):
+                # The process exited while we were scanning.
+                continue
+            processes[(pid, start_time)] = name
+    else:
+        for proc in psutil.process_iter(["name"]):
+            name = proc.info.get("name") or ""
+            processes[(proc.pid, name)] = name
+    return processes
+
+
+def snapshot_process(pid, target_names=None):
+    """
+    Reads the monitored attributes of a single process.
+    When target_names is given, the command line is only read if the name matches.
+    Returns None if the process is not a target, is already gone or cannot be inspected.
+    """
+    try:
+        proc = psutil.Process(pid)
+        if target_names is not None and not is_target_name(proc.name(), target_names):
+            return None
+        return ProcessSnapshot(proc.as_dict(attrs=PROCESS_ATTRS))
+    except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess) as e:
+        logger.debug("Could not snapshot process %s: %s", pid, e)
+        return None
+
+
+def scan_target_processes(target_names, processes=None):
+    """
+    Takes snapshots of all running processes whose names match the targets.
+    processes is an enumerate_process_names() result to reuse, if already taken.
+    """
+    if processes is None:
+        processes = enumerate_process_names()
+    started = []
+    for (pid, _), name in processes.items():
+        if is_target_name(name, target_names):
+            snapshot = snapshot_process(pid)
+            if snapshot is not None:
+                started.append(snapshot)
+    return started
+
+
+class ProcessEventSource:
+    """
+    Base class for process sources feeding monitor_system.
+    poll() blocks until there is something to report (or stop_event is set)
+    and returns a tuple (started, exited):
+      - started: newly seen target processes exposing an .info dict with PROCESS_ATTRS.
+      - exited: PIDs of processes that have terminated since the last poll.
+    Only processes whose names match the target names are reported.
+    """
+
+    name = "base"
+
+    def poll(self, stop_event):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PollingProcessSource(ProcessEventSource):
+    """
+    Fallback source that scans the process table on an interval in two stages:
+    first only PIDs and names are enumerated (cheap), then the command line is
+    fetched only for PIDs that were not known in the previous scan and whose name
+    matches the targets. Exits are derived from the PIDs that disappeared.
+    With a scan_interval (scheduler.AdaptiveInterval) the interval follows the load:
+    shorter while new target processes appear, longer on idle or busy hosts.
+    """
+
+    name = "poll"
+
+    def __init__(self, interval=1.0, target_names=DEFAULT_TARGET_NAMES, scan_interval=None):
+        self.interval = scan_interval.interval if scan_interval is not None else interval
+        self.scan_interval = scan_interval
+        self.target_names = tuple(target_names)
+        self._known = set()
+        self._first_poll = True
+
+    def poll(self, stop_event):
+        if not self._first_poll:
+            # Sleep for the interval in short 0.1-second steps,
+            # to more frequently check if stop_event is set.
+            deadline = time.monotonic() + self.interval
+            while not stop_event.is_set() and time.monotonic() < deadline:
+                time.sleep(0.1)
+            if stop_event.is_set():
+                return [], []
+        self._first_poll = False
+
+        processes = enumerate_process_names()
+        current = set(processes)
+        started = []
+        for key in current - self._known:
+            if is_target_name(processes[key], self.target_names):
+                snapshot = snapshot_process(key[0])
+                if snapshot is not None:
+                    started.append(snapshot)
+        exited = [pid for pid, _ in self._known - current]
+        self._known = current
+        if self.scan_interval is not None:
+            self.interval = self.scan_interval.update(len(started))
+        return started, exited
+
+
+class NetlinkProcessSource(ProcessEventSource):
+    """
+    Linux source driven by the kernel proc connector.
+    The kernel pushes an event for every exec() and exit(), so new processes are
+    inspected within milliseconds of starting instead of on the next 1-second scan,
+    and short-lived processes are no longer missed between scans.
+    The PIDs seen running are tracked, so exits lost in a receive buffer overrun are
+    still reported after the resynchronizing scan.
+    Requires CAP_NET_ADMIN (usually root); the constructor raises OSError otherwise.
+    """
+
+    name = "netlink"
+
+    def __init__(self, wait_step=0.1, target_names=DEFAULT_TARGET_NAMES):
+        self.wait_step = wait_step
+        self.target_names = tuple(target_names)
+        self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_CONNECTOR)
+        try:
+            # Port id 0 lets the kernel assign a unique netlink address.
+            self._sock.bind((0, CN_IDX_PROC))
+            self._send_control(PROC_CN_MCAST_LISTEN)
+        except OSError:
+            self._sock.close()
+            raise
+        self._first_poll = True
+        # PIDs known to be running: from the last full scan plus exec events, minus exits.
+        self._known_pids = set()
+
+    def _send_control(self, op):
+        """
+        Sends a proc connector control message (subscribe or unsubscribe).
+        """
+        payload = struct.pack("=I", op)
+        cn_msg = CN_MSG.pack(CN_IDX_PROC, CN_VAL_PROC, 0, 0, len(payload), 0) + payload
+        port_id = self._sock.getsockname()[0]
+        header = NLMSGHDR.pack(NLMSGHDR.size + len(cn_msg), NLMSG_DONE, 0, 0, port_id)
+        self._sock.send(header + cn_msg)
+
+    def _read_events(self, started, exited):
+        """
+        Drains all pending datagrams from the socket without blocking.
+        Exec'd processes are inspected immediately, while they are most likely still alive.
+        """
+        while True:
+            try:
+                data = self._sock.recv(65536, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                # The kernel dropped events because we fell behind;
+                # resynchronize with a full scan on the next poll.
+                logger.warning("Netlink receive buffer overrun, rescanning all processes")
+                self._first_poll = True
+                return
+            offset = 0
+            while offset + NLMSGHDR.size <= len(data):
+                msg_len = NLMSGHDR.unpack_from(data, offset)[0]
+                if msg_len < NLMSGHDR.size:
+                    break
+                event_offset = offset + NLMSGHDR.size + CN_MSG.size
+                if event_offset + PROC_EVENT_HEADER.size + PROC_EVENT_IDS.size <= len(data):
+                    what = PROC_EVENT_HEADER.unpack_from(data, event_offset)[0]
+                    pid, tgid = PROC_EVENT_IDS.unpack_from(data, event_offset + PROC_EVENT_HEADER.size)
+                    # Only whole processes are interesting, not individual threads.
+                    if pid == tgid:
+                        if what == PROC_EVENT_EXEC:
+                            self._known_pids.add(tgid)
+                            snapshot = snapshot_process(tgid, self.target_names)
+                            if snapshot is not None:
+                                started.append(snapshot)
+                        elif what == PROC_EVENT_EXIT:
+                            self._known_pids.discard(tgid)
+                            exited.append(tgid)
+                # Netlink messages are aligned to 4 bytes.
+                offset += (msg_len + 3) & ~3
+
+    def poll(self, stop_event):
+        if self._first_poll:
+            # Processes that were already running before we subscribed never produce
+            # an exec event, so report them once from a full scan (also used to resync).
+            # Known PIDs missing from the scan exited while events were being dropped.
+            self._first_poll = False
+            processes = enumerate_process_names()
+            running = {pid for pid, _ in processes}
+            exited = list(self._known_pids - running)
+            self._known_pids = running
+            return scan_target_processes(self.target_names, processes), exited
+
+        started = []
+        exited = []
+        while not stop_event.is_set():
+            readable, _, _ = select.select([self._sock], [], [], self.wait_step)
+            if readable:
+                self._read_events(started, exited)
+                if started or exited:
+                    break
+        return started, exited
+
+    def close(self):
+        try:
+            self._send_control(PROC_CN_MCAST_IGNORE)
+        except OSError:
+            pass
+        self._sock.close()
+
+
+def create_process_source(preferred="auto", target_names=DEFAULT_TARGET_NAMES, scan_interval=None):
+    """
+    Creates the process source used by monitor_system.
+    preferred is one of "auto", "netlink" or "poll". With "auto" the netlink
+    proc connector is used on Linux when permitted, otherwise the psutil poller.
+    target_names are the lowercased name substrings of processes to inspect.
+    scan_interval (an AdaptiveInterval) paces the poller; netlink events need no polling.
+    """
+    target_names = tuple(name.lower() for name in target_names)
+    if preferred in ("auto", "netlink") and sys.platform.startswith("linux"):
+        try:
+            source = NetlinkProcessSource(target_names=target_names)
+            logger.info("Using netlink proc connector for process events")
+            return source
+        except OSError as e:
+            logger.warning("Netlink proc connector unavailable, falling back to polling: %s", e)
+    elif preferred == "netlink":
+        logger.warning("Netlink proc connector is only available on Linux, falling back to polling")
+
+    logger.info("Using psutil polling for process events")
+    return PollingProcessSource(target_names=target_names, scan_interval=scan_interval)
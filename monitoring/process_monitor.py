@@ -1,104 +1,306 @@
-import psutil
 import time
+import psutil
 import logging
 from log_generator import generate_log
+from process_events import create_process_source, DEFAULT_TARGET_NAMES
+from match_pool import create_matcher_pool, DEFAULT_MIN_BATCH
+from rules_loader import FieldSource, RuleProfiler, DEFAULT_PROFILE_FILE
+from payload_decoder import decode_payload
+from deobfuscator import normalize_script
+from process_ancestry import AncestryCache, DEFAULT_ANCESTRY_DEPTH
+from server_config import load_config
+from scheduler import create_scan_interval
+from metrics import counter, gauge, histogram
 
 # Configure basic logging to output messages with level INFO or higher.
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+TICK_SECONDS = histogram("monitor_tick_seconds", "Time to handle one batch of process events, from filtering to written logs")
+MATCH_BATCH_SECONDS = histogram("match_batch_seconds", "Time to match one batch of processes against the rules")
+PROCESSES_REPORTED = counter("processes_reported_total", "Started processes reported by the process source")
+PROCESSES_SCANNED = counter("processes_scanned_total", "Processes evaluated against the rules")
+RULES_EVALUATED = counter("rules_evaluated_total", "Rule evaluations requested (processes scanned times rules loaded, before needle prefiltering)")
+RULE_MATCHES = counter("rule_matches_total", "Rule matches, each producing a threat log entry")
+VERDICT_CACHE_ENTRIES = gauge("verdict_cache_entries", "Process/cmdline pairs in the verdict cache")
+ANCESTRY_CACHE_ENTRIES = gauge("ancestry_cache_entries", "Ancestor processes in the ancestry cache")
+RULES_LOADED = gauge("rules_loaded", "Rules in the active rule set")
+
+# How often (seconds) the rule profile is written while "rule_profiling" is enabled.
+PROFILE_SAVE_INTERVAL = 60.0
+
 
-def match_sigma_conditions(condition_dict, cmdline_lower):
+def ancestor_field(generation, key):
     """
-    Handles Sigma-style condition blocks.
-    Returns True if any pattern is found in the command line.
+    Returns a field extractor for an attribute of the parent (generation 0) or
+    grandparent (1) of a process, falling back to the name when the image is unreadable.
     """
-    # Ensure the condition is a dictionary.
-    if not isinstance(condition_dict, dict):
-        return False
-    # Iterate over the condition dictionary items.
-    for key, values in condition_dict.items():
-        # Normalize the values to a list.
-        values = values if isinstance(values, list) else [values]
-        # Check for the '|contains' marker in the key and if any value matches.
-        if "|contains" in key:
-            if any(val.lower() in cmdline_lower for val in values):
-                # Return True as soon as a matching pattern is found.
-                return True
-    # If no matching pattern is found, return False.
-    return False
-
-
-def check_rule_conditions(rule, proc):
+    def extract(raw):
+        ancestry = raw[2]
+        if len(ancestry) <= generation:
+            return None
+        ancestor = ancestry[generation]
+        if key == "exe":
+            return ancestor.get("exe") or ancestor.get("name")
+        return ancestor.get(key)
+    return extract
+
+
+# Maps a process onto the fields referenced by the PowerShell rules. Raw events are
+# (command line, script text, ancestry) tuples. Script text fields see the script text
+# (the command line itself, or e.g. a decoded payload), while the host description fields
+# of the module (ContextInfo) and classic (Data) event logs get the command line in the
+# same shape Windows logs it, so host-based selections and filters apply correctly.
+# Parent fields come from the process ancestry (see process_ancestry.AncestryCache).
+# Fields not listed here (e.g. Path) are absent, and are never computed.
+PROCESS_FIELD_EXTRACTORS = {
+    "ScriptBlockText": lambda raw: raw[1],
+    "Payload": lambda raw: raw[1],
+    "CommandLine": lambda raw: raw[0],
+    "ContextInfo": lambda raw: f"Host Application = {raw[0]}",
+    "Data": lambda raw: f"HostApplication={raw[0]}",
+    "ParentImage": ancestor_field(0, "exe"),
+    "ParentUser": ancestor_field(0, "user"),
+    "GrandparentImage": ancestor_field(1, "exe"),
+}
+PROCESS_LOGSOURCES = ("ps_script", "ps_module", "ps_classic_start")
+
+PROCESS_SOURCE = FieldSource(
+    "process", PROCESS_LOGSOURCES, PROCESS_FIELD_EXTRACTORS, default=lambda raw: raw[1]
+)
+# The decoded payload of a process only changes the script text (and keyword) fields, so
+# rules reading none of them already had their verdict from the command line itself.
+DECODED_PAYLOAD_SOURCE = FieldSource(
+    "decoded payload", PROCESS_LOGSOURCES, PROCESS_FIELD_EXTRACTORS, default=lambda raw: raw[1],
+    trigger_fields=("ScriptBlockText", "Payload", None)
+)
+# The canonical form of an obfuscated command line changes every field but the parent ones.
+NORMALIZED_SOURCE = FieldSource(
+    "normalized command line", PROCESS_LOGSOURCES, PROCESS_FIELD_EXTRACTORS, default=lambda raw: raw[1],
+    trigger_fields=("ScriptBlockText", "Payload", "CommandLine", "ContextInfo", "Data", None)
+)
+
+
+def add_matches(matched, more):
     """
-    Evaluates whether a process meets the Sigma rule conditions.
-    The process must match selection conditions and NOT match any filter conditions.
+    Appends the rules of more that are not in matched yet.
     """
-    # Retrieve detection settings from the rule; use an empty dict if not provided.
-    detection = rule.get("detection", {})
+    if more:
+        seen = {id(rule) for rule in matched}
+        matched.extend(rule for rule in more if id(rule) not in seen)
+    return matched
 
+
+def check_rule_conditions(rules, proc):
+    """
+    Evaluates a process against the compiled rule set.
+    Each rule's Sigma condition (selections, filters, modifiers and regexes) is resolved
+    from a single automaton pass over each distinct field text, and only rules whose
+    logsource and fields a process can supply are evaluated.
+    If the command line hides its code (-EncodedCommand or a -File script), the decoded
+    code is evaluated as the script text as well, so encoded payloads cannot evade rules.
+    Obfuscated command lines and payloads (backticks, carets, concatenated or formatted
+    strings) are evaluated once more in their canonical form (see deobfuscator).
+    Returns the list of matching rules.
+    """
+    if rules.profiler is not None:
+        rules.profiler.record_event()
     # Get the process command line as a list; join it to form a single string.
     cmdline_list = proc.info.get("cmdline", [])
     cmdline = " ".join(cmdline_list) if cmdline_list else ""
-    # Convert the command line to lowercase for case-insensitive matching.
-    cmdline_lower = cmdline.lower()
+    # Lowercasing for case-insensitive matching happens once inside the rule set,
+    # since regexes and cased modifiers need the original text.
+    ancestry = proc.info.get("ancestry") or ()
+    matched, event = rules.match_source(PROCESS_SOURCE, (cmdline, cmdline, ancestry))
+
+    canonical = normalize_script(cmdline)
+    if canonical:
+        add_matches(matched, rules.match_source(NORMALIZED_SOURCE, (canonical, canonical, ancestry))[0])
+
+    payload = decode_payload(cmdline_list) if cmdline_list else None
+    if payload:
+        # The command line texts were already lowercased and scanned for the first event.
+        add_matches(matched, rules.match_source(DECODED_PAYLOAD_SOURCE, (cmdline, payload, ancestry), shared=event)[0])
+        canonical = normalize_script(payload)
+        if canonical:
+            add_matches(matched, rules.match_source(DECODED_PAYLOAD_SOURCE, (cmdline, canonical, ancestry),
+                                                    shared=event)[0])
+    return matched
+
 
-    # Extract the selection criteria from the detection block.
-    selection = detection.get("selection")
-    # If no selection is provided or there is no match, return False.
-    if not selection or not match_sigma_conditions(selection, cmdline_lower):
+class VerdictCache:
+    """
+    Remembers which processes have already been evaluated against the rules.
+    Entries are keyed by (pid, create_time, hash of cmdline), so a reused PID or a
+    changed command line is evaluated again, while an unchanged process is evaluated
+    exactly once. Entries are evicted when the process source reports the PID as exited.
+    """
+
+    def __init__(self):
+        # Maps each PID to the keys evaluated for it.
+        self._keys_by_pid = {}
+
+    @staticmethod
+    def make_key(proc):
+        """
+        Builds the cache key for a process from its psutil info.
+        """
+        info = proc.info
+        return info.get("pid"), info.get("create_time"), hash(tuple(info.get("cmdline") or ()))
+
+    def check(self, key):
+        """
+        Returns True if the process was already evaluated, False if it is new
+        (in which case it is recorded as evaluated).
+        """
+        keys = self._keys_by_pid.setdefault(key[0], set())
+        if key in keys:
+            return True
+        keys.add(key)
         return False
 
-    # Check filter conditions: if any filter matches, the process should be excluded.
-    for key, value in detection.items():
-        if key.startswith("filter_") and match_sigma_conditions(value, cmdline_lower):
-            return False
+    def evict(self, pids):
+        """
+        Forgets all entries of the given (exited) PIDs.
+        """
+        for pid in pids:
+            self._keys_by_pid.pop(pid, None)
+
+    def __len__(self):
+        return sum(len(keys) for keys in self._keys_by_pid.values())
 
-    # Process passes selection and does not match any filter conditions.
-    return True
+
+def save_profile(profiler, path):
+    try:
+        profiler.save(path)
+    except OSError as e:
+        logger.warning("Could not write rule profile %s: %s", path, e)
 
 
-def monitor_system(rules, stop_event):
+def monitor_system(rules, stop_event, source=None, rules_watcher=None):
     """
     Continuously monitors processes (e.g., Powershell) against Sigma rules.
+    Processes come from a process event source (netlink proc connector on Linux
+    when available, psutil polling otherwise); see process_events.create_process_source.
+    The poller's interval adapts to the load between "scan_min_interval" and
+    "scan_max_interval" (see scheduler.AdaptiveInterval).
+    The source only reports processes whose names match "target_process_names".
+    Each process/cmdline pair is evaluated once; the entry is dropped when it exits.
+    Processes are enriched with their parent and grandparent ("process_ancestry_depth")
+    from an ancestry cache, so each ancestor is only read once while it runs.
+    With a rules_watcher, a reloaded rule set is picked up before each batch of processes.
+    With "match_workers" set, batches are matched in worker processes (see match_pool),
+    while logs are still generated from this thread only.
+    With "rule_profiling" enabled, the cost of every rule is recorded and saved to
+    "rule_profile_file" (see rule_report.py); matching then stays in this thread.
     Checks the stop_event periodically and exits gracefully.
     """
     logger.info("Starting process monitoring...")
+    config = load_config()
+    if source is None:
+        source = create_process_source(
+            config.get("process_source", "auto"),
+            config.get("target_process_names", DEFAULT_TARGET_NAMES),
+            create_scan_interval(config)
+        )
+    verdict_cache = VerdictCache()
+    VERDICT_CACHE_ENTRIES.set_function(verdict_cache.__len__)
+    ancestry_cache = AncestryCache(int(config.get("process_ancestry_depth", DEFAULT_ANCESTRY_DEPTH)))
+    ANCESTRY_CACHE_ENTRIES.set_function(ancestry_cache.__len__)
+    RULES_LOADED.set(len(rules))
+    matcher = None
+    profiler = None
+    profile_file = config.get("rule_profile_file", DEFAULT_PROFILE_FILE)
+    if config.get("rule_profiling", False):
+        # Statistics accumulate across restarts until the profile file is removed.
+        profiler = RuleProfiler.load(profile_file)
+        rules.set_profiler(profiler)
+        logger.info("Rule profiling enabled, writing the profile to %s", profile_file)
+    next_profile_save = time.monotonic() + PROFILE_SAVE_INTERVAL
     try:
+        match_workers = config.get("match_workers", 0)
+        if profiler is not None and match_workers not in (0, "0", None):
+            # Statistics recorded in worker processes would be lost.
+            logger.warning("Rule profiling is enabled, matching in the monitor thread instead of worker processes")
+            match_workers = 0
+        matcher = create_matcher_pool(
+            rules, check_rule_conditions,
+            match_workers,
+            int(config.get("match_pool_min_batch", DEFAULT_MIN_BATCH))
+        )
         # Main loop: runs until a stop event is set.
         while not stop_event.is_set():
-            # Iterate through processes with required attributes.
-            for proc in psutil.process_iter(["pid", "name", "cmdline"]):
+            # Wait for the source to report started and exited processes.
+            started, exited = source.poll(stop_event)
+            # Switch to a reloaded rule set between ticks, never in the middle of a batch.
+            if rules_watcher is not None and rules_watcher.ruleset is not rules:
+                rules = rules_watcher.ruleset
+                logger.info("Switched to reloaded rule set with %d rules", len(rules))
+                RULES_LOADED.set(len(rules))
+                if profiler is not None:
+                    rules.set_profiler(profiler)
+                if matcher is not None:
+                    matcher.update(rules)
+            if profiler is not None and time.monotonic() >= next_profile_save:
+                next_profile_save = time.monotonic() + PROFILE_SAVE_INTERVAL
+                save_profile(profiler, profile_file)
+
+            if not started and not exited:
+                continue
+            tick_start = time.perf_counter()
+            PROCESSES_REPORTED.inc(len(started))
+            # Forget the verdicts of exited processes before recording the started ones, since
+            # a PID may have been reused within one poll. A process that started and exited
+            # within the poll keeps its entry until its PID exits again; entries are keyed by
+            # create time, so that entry never applies to another process.
+            verdict_cache.evict(exited)
+
+            candidates = []
+            for proc in started:
+                # Retrieve the command line of the process.
+                cmdline = proc.info.get("cmdline") or []
+                # Skip processes without sufficient command line arguments.
+                if len(cmdline) <= 1:
+                    continue
+                # Skip processes whose current command line was already evaluated.
+                if verdict_cache.check(VerdictCache.make_key(proc)):
+                    continue
+                # Parent context for the rules and the log entry, read before the parent may exit.
+                candidates.append(ancestry_cache.enrich(proc))
+
+            # A single pass over each command line resolves every Sigma rule.
+            if candidates:
+                with MATCH_BATCH_SECONDS.time():
+                    if matcher is not None:
+                        results = matcher.match(candidates)
+                    else:
+                        results = [check_rule_conditions(rules, proc) for proc in candidates]
+                PROCESSES_SCANNED.inc(len(candidates))
+                RULES_EVALUATED.inc(len(candidates) * len(rules))
+            else:
+                results = []
+
+            for proc, matched in zip(candidates, results):
+                RULE_MATCHES.inc(len(matched))
                 try:
-                    # Get the process name in lowercase for consistent comparison.
-                    process_name = proc.info.get("name", "").lower()
-                    # Filter to monitor only processes related to "powershell".
-                    if "powershell" not in process_name:
-                        continue
-
-                    # Retrieve the command line of the process.
-                    cmdline = proc.info.get("cmdline", [])
-                    # Skip processes without sufficient command line arguments.
-                    if len(cmdline) <= 1:
-                        continue
-
-                    # Iterate through the set of Sigma rules to check for matches.
-                    for rule in rules:
-                        if check_rule_conditions(rule, proc):
-                            # Generate a log entry if the process matches the rule conditions.
-                            generate_log(rule, proc)
+                    for rule in matched:
+                        # Generate a log entry for each rule the process matches.
+                        generate_log(rule, proc)
                 except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess) as e:
                     # Log specific process-related exceptions at debug level and continue.
                     logger.debug("Process exception: %s", e)
                     continue
-
-            # Sleep for a total of 1 second, broken into short 0.1-second intervals,
-            # to more frequently check if stop_event is set.
-            for _ in range(10):
-                if stop_event.is_set():
-                    break
-                time.sleep(0.1)
+            # Forget exited ancestors only now, after the started processes (possibly their
+            # children) were enriched, so the cache stays bounded.
+            ancestry_cache.evict(exited)
+            TICK_SECONDS.observe(time.perf_counter() - tick_start)
     except Exception as e:
         # Log any unexpected exceptions, including traceback information.
         logger.error("Exception in monitor_system: %s", e, exc_info=True)
+    finally:
+        if matcher is not None:
+            matcher.close()
+        if profiler is not None:
+            save_profile(profiler, profile_file)
+        source.close()
     logger.info("monitor_system() exiting gracefully due to stop_event.")
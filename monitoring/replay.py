@@ -0,0 +1,364 @@
+import io
+import os
+import re
+import csv
+import sys
+import gzip
+import json
+import time
+import logging
+import argparse
+from itertools import islice
+
+from rules_loader import FieldSource, load_rules
+from process_events import ProcessSnapshot
+from process_monitor import add_matches, check_rule_conditions
+from deobfuscator import normalize_script
+from match_pool import create_matcher_pool
+from log_generator import LOG_DIR, ThreatLogWriter, build_log_entry
+
+# Configure basic logging to output messages with level INFO or higher.
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_OUTPUT_FILE = os.path.join(LOG_DIR, "replay_threats.log")
+# Records read, matched and written together; bounds the memory used for any input size.
+DEFAULT_CHUNK_SIZE = 2000
+# Progress is logged every this many records.
+PROGRESS_EVERY = 100000
+
+FORMATS = ("jsonl", "csv", "evtx-text")
+FORMAT_EXTENSIONS = {
+    ".jsonl": "jsonl", ".ndjson": "jsonl", ".json": "jsonl",
+    ".csv": "csv",
+    ".txt": "evtx-text", ".log": "evtx-text",
+}
+
+# Column / key names accepted for each record field (compared case-insensitively).
+CMDLINE_KEYS = ("cmdline", "commandline", "command_line", "processcommandline", "process command line")
+SCRIPT_KEYS = ("scriptblocktext", "script", "script_text", "payload")
+TIMESTAMP_KEYS = ("timestamp", "timecreated", "utctime", "time", "date")
+USER_KEYS = ("user", "username", "user name", "subjectusername", "account name")
+PID_KEYS = ("pid", "processid", "newprocessid", "new process id")
+NAME_KEYS = ("process", "name", "image", "newprocessname", "new process name")
+
+# wevtutil "qe ... /f:text" output: one "Event[N]:" block per event.
+EVENT_HEADER = re.compile(r"^Event\[\d+\]:\s*$")
+HEADER_FIELD = re.compile(r"^\s+([A-Za-z ]+):\s?(.*)$")
+DESCRIPTION_FIELD = re.compile(r"^\s*([A-Za-z ]+):\s*(.*?)\s*$")
+
+
+def lookup(mapping, keys):
+    """
+    Returns the first non-empty value of a mapping under any of the keys, ignoring case.
+    """
+    for key in keys:
+        value = mapping.get(key)
+        if value not in (None, ""):
+            return value
+    return None
+
+
+def parse_pid(value):
+    """
+    Parses a process ID given as a number, a decimal string or a hex string (4688 events).
+    """
+    if isinstance(value, int):
+        return value
+    try:
+        return int(value, 16) if str(value).lower().startswith("0x") else int(value)
+    except (TypeError, ValueError):
+        return value if value is not None else "Unknown"
+
+
+def make_record(cmdline=None, script=None, timestamp=None, user=None, pid=None, name=None):
+    """
+    Builds a replayed event as a ProcessSnapshot, so it runs through the same rule engine
+    and log format as a live process. Returns None if it has neither a command line nor a script.
+    """
+    if isinstance(cmdline, str):
+        cmdline = cmdline.split()
+    cmdline = [str(part) for part in cmdline] if cmdline else []
+    if not cmdline and not script:
+        return None
+    if name is None:
+        name = os.path.basename(cmdline[0]) if cmdline else "Unknown"
+    return ProcessSnapshot({
+        "cmdline": cmdline,
+        "script": script,
+        "timestamp": str(timestamp) if timestamp else None,
+        "user": user,
+        "pid": parse_pid(pid),
+        "name": os.path.basename(str(name).replace("\\", "/")),
+    })
+
+
+def record_from_mapping(mapping):
+    """
+    Builds a replayed event from a JSON object or CSV row; key names are case-insensitive.
+    """
+    mapping = {str(key).strip().lower(): value for key, value in mapping.items()}
+    return make_record(
+        lookup(mapping, CMDLINE_KEYS),
+        lookup(mapping, SCRIPT_KEYS),
+        lookup(mapping, TIMESTAMP_KEYS),
+        lookup(mapping, USER_KEYS),
+        lookup(mapping, PID_KEYS),
+        lookup(mapping, NAME_KEYS),
+    )
+
+
+def open_text(path, newline=None):
+    """
+    Opens a (possibly gzip-compressed) text file for streaming. UTF-16 files, as written
+    by PowerShell's output redirection, are recognized by their byte order mark.
+    """
+    raw = gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+    head = raw.peek(2)[:2]
+    encoding = "utf-16" if head in (b"\xff\xfe", b"\xfe\xff") else "utf-8-sig"
+    return io.TextIOWrapper(raw, encoding=encoding, errors="replace", newline=newline)
+
+
+def read_jsonl(path):
+    """
+    Yields the events of a JSON Lines file, one JSON object per line.
+    """
+    with open_text(path) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = record_from_mapping(json.loads(line))
+            except (ValueError, AttributeError) as e:
+                logger.debug("Skipping line %d of %s: %s", line_number, path, e)
+                continue
+            if record is not None:
+                yield record
+
+
+def read_csv(path):
+    """
+    Yields the events of a CSV file with a header row.
+    """
+    # Command lines and script blocks can be far longer than the default field limit.
+    csv.field_size_limit(2 ** 31 - 1)
+    with open_text(path, newline="") as f:
+        for row in csv.DictReader(f):
+            record = record_from_mapping({key: value for key, value in row.items() if key is not None})
+            if record is not None:
+                yield record
+
+
+def parse_evtx_event(lines):
+    """
+    Parses one event block of wevtutil text output. Returns a replayed event for
+    4688 (process creation, with command line auditing) and 4104 (script block logging)
+    events, None for any other event.
+    """
+    header = {}
+    description = []
+    for index, line in enumerate(lines):
+        match = HEADER_FIELD.match(line)
+        if match and match.group(1).strip() == "Description":
+            description = lines[index + 1:]
+            break
+        if match:
+            header[match.group(1).strip().lower()] = match.group(2).strip()
+
+    event_id = header.get("event id")
+    timestamp = header.get("date")
+    user = header.get("user name")
+    if user in (None, "", "N/A"):
+        user = None
+
+    if event_id == "4104":
+        script_lines = None
+        for line in description:
+            if script_lines is None:
+                if line.startswith("Creating Scriptblock text"):
+                    script_lines = []
+            elif line.startswith("ScriptBlock ID:"):
+                break
+            else:
+                script_lines.append(line)
+        script = "\n".join(script_lines or []).strip()
+        return make_record(script=script, timestamp=timestamp, user=user, name="powershell.exe")
+
+    if event_id == "4688":
+        fields = {}
+        for line in description:
+            match = DESCRIPTION_FIELD.match(line)
+            # The first "Account Name" is the creator subject's.
+            if match and match.group(1).strip().lower() not in fields:
+                fields[match.group(1).strip().lower()] = match.group(2)
+        return make_record(
+            fields.get("process command line"),
+            timestamp=timestamp,
+            user=fields.get("account name") or user,
+            pid=fields.get("new process id"),
+            name=fields.get("new process name"),
+        )
+    return None
+
+
+def read_evtx_text(path):
+    """
+    Yields the 4688 and 4104 events of an event log exported as text, e.g. with
+    wevtutil qe Microsoft-Windows-PowerShell/Operational /f:text > events.txt
+    (or "wevtutil qe events.evtx /lf:true /f:text" for a saved .evtx file).
+    """
+    with open_text(path) as f:
+        block = None
+        for line in f:
+            line = line.rstrip("\r\n")
+            if EVENT_HEADER.match(line):
+                if block:
+                    record = parse_evtx_event(block)
+                    if record is not None:
+                        yield record
+                block = []
+            elif block is not None:
+                block.append(line)
+        if block:
+            record = parse_evtx_event(block)
+            if record is not None:
+                yield record
+
+
+READERS = {"jsonl": read_jsonl, "csv": read_csv, "evtx-text": read_evtx_text}
+
+
+def detect_format(path):
+    """
+    Guesses the input format from the file extension (ignoring a trailing .gz).
+    Raises ValueError if it cannot.
+    """
+    name = path[:-3] if path.endswith(".gz") else path
+    extension = os.path.splitext(name)[1].lower()
+    if extension == ".evtx":
+        raise ValueError(f"{path} is a binary event log; export it as text first: "
+                         f"wevtutil qe {path} /lf:true /f:text > events.txt")
+    if extension not in FORMAT_EXTENSIONS:
+        raise ValueError(f"Cannot tell the format of {path}; use --format ({', '.join(FORMATS)})")
+    return FORMAT_EXTENSIONS[extension]
+
+
+# Script block (4104) events: the script is the ScriptBlockText, while the command line
+# and host description fields are absent, so module and classic log rules do not apply.
+SCRIPT_BLOCK_SOURCE = FieldSource(
+    "script block", ("ps_script",), {"ScriptBlockText": lambda script: script}, default=lambda script: script
+)
+
+
+def match_record(rules, proc):
+    """
+    Returns the rules matching a replayed event: its command line exactly like a live
+    process (see check_rule_conditions), and its script block text, if any, as ScriptBlockText
+    (in its canonical form as well, if it is obfuscated).
+    """
+    matched = check_rule_conditions(rules, proc) if proc.info["cmdline"] else []
+    script = proc.info.get("script")
+    if script:
+        add_matches(matched, rules.match_source(SCRIPT_BLOCK_SOURCE, script)[0])
+        canonical = normalize_script(script)
+        if canonical:
+            add_matches(matched, rules.match_source(SCRIPT_BLOCK_SOURCE, canonical)[0])
+    return matched
+
+
+def replay(records, rules, writer, matcher=None, chunk_size=DEFAULT_CHUNK_SIZE, notify=False):
+    """
+    Runs a stream of replayed events through the rules and queues a threat log entry
+    to the writer for every match. Events are processed chunk by chunk, so memory use
+    does not depend on the length of the stream; with a matcher pool each chunk is
+    matched in parallel. Returns (events, matched events, log entries).
+    """
+    if notify:
+        # Only imported for --notify, since notifications need the Telegram configuration.
+        from notification_generator import send_notification
+    events = matched_events = entries = 0
+    next_progress = PROGRESS_EVERY
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            break
+        if matcher is not None:
+            results = matcher.match(chunk)
+        else:
+            results = [match_record(rules, proc) for proc in chunk]
+        for proc, matched in zip(chunk, results):
+            if matched:
+                matched_events += 1
+            for rule in matched:
+                log_entry = build_log_entry(rule, proc)
+                writer.write(log_entry)
+                entries += 1
+                if notify:
+                    send_notification(log_entry, rule.get("level", "medium"))
+        events += len(chunk)
+        if events >= next_progress:
+            logger.info("Replayed %d events, %d matched", events, matched_events)
+            next_progress += PROGRESS_EVERY
+    return events, matched_events, entries
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Scans historical PowerShell command lines and script blocks with the detection rules, "
+                    "writing matches in the threats.log format."
+    )
+    parser.add_argument("input", help="JSONL, CSV or wevtutil text export (optionally .gz)")
+    parser.add_argument("--format", choices=FORMATS, help="input format (default: from the file extension)")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT_FILE,
+                        help="threat log to write (default: logs/replay_threats.log)")
+    parser.add_argument("--workers", default="0",
+                        help='worker processes for matching: a number or "auto" (default: 0, no workers)')
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--notify", action="store_true", help="also send Telegram notifications for matches")
+    args = parser.parse_args(argv)
+
+    try:
+        input_format = args.format or detect_format(args.input)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.notify:
+        from notification_generator import get_chat_ids, stop_dispatcher, close_dedupe_store
+        try:
+            get_chat_ids()
+        except (ValueError, OSError) as e:
+            parser.error(f"--notify needs the Telegram configuration: {e}")
+
+    rules = load_rules()
+    if not rules:
+        logger.warning("No rules loaded. Exiting.")
+        return 1
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    # The replay output is not rotated, and only fsynced when the replay is done.
+    writer = ThreatLogWriter(filename=args.output, max_bytes=0, fsync_interval=float("inf"),
+                             announce=False).start()
+    matcher = create_matcher_pool(rules, match_record, args.workers)
+    start = time.perf_counter()
+    try:
+        events, matched_events, entries = replay(
+            READERS[input_format](args.input), rules, writer, matcher, args.chunk_size, args.notify
+        )
+    finally:
+        if matcher is not None:
+            matcher.close()
+        writer.stop()
+        if args.notify:
+            stop_dispatcher()
+            close_dedupe_store()
+    elapsed = time.perf_counter() - start
+
+    logger.info(
+        "Replayed %d events in %.1f s (%.0f events/sec): %d matched, %d log entries written to %s",
+        events, elapsed, events / elapsed if elapsed else 0.0, matched_events, entries, args.output
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
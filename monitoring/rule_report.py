@@ -0,0 +1,120 @@
+import sys
+import logging
+import argparse
+
+from rules_loader import DEFAULT_PROFILE_FILE, RuleProfiler, load_rules
+
+# Configure basic logging to output messages with level INFO or higher.
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SORT_KEYS = ("time", "matches", "suppressed", "evaluations", "skipped")
+
+
+class CommandLineProcess:
+    """
+    Stands in for a psutil process when profiling the rules over recorded command lines.
+    """
+
+    def __init__(self, cmdline):
+        self.info = {"cmdline": cmdline.split()}
+
+
+def sort_rows(rows, sort_key):
+    """
+    Ranks the rules of a profile, most expensive (or most matching, ...) first.
+    """
+    field = "seconds" if sort_key == "time" else sort_key
+    return sorted(rows, key=lambda row: (row[field], row["seconds"]), reverse=True)
+
+
+def format_report(profiler, sort_key="time", top=None, never_matched=False):
+    """
+    Formats the statistics of a RuleProfiler as a ranked table.
+    With never_matched, only rules that were evaluated but never matched are listed,
+    the candidates for pruning.
+    """
+    rows = profiler.rows()
+    if never_matched:
+        rows = [row for row in rows if row["evaluations"] > 0 and row["matches"] == 0]
+    rows = sort_rows(rows, sort_key)
+    total_seconds = sum(row["seconds"] for row in profiler.rows()) or 1.0
+    if top:
+        rows = rows[:top]
+
+    lines = [
+        f"Events profiled: {profiler.events}, automaton scan time: {profiler.automaton_seconds * 1000:.1f} ms",
+        f"{'rank':>4}  {'time ms':>9}  {'share':>6}  {'us/eval':>8}  {'evals':>8}  {'skipped':>8}  "
+        f"{'matches':>7}  {'suppr.':>6}  rule",
+    ]
+    for rank, row in enumerate(rows, 1):
+        per_evaluation = row["seconds"] / row["evaluations"] * 1e6 if row["evaluations"] else 0.0
+        lines.append(
+            f"{rank:>4}  {row['seconds'] * 1000:>9.2f}  {row['seconds'] / total_seconds:>6.1%}  "
+            f"{per_evaluation:>8.1f}  {row['evaluations']:>8}  {row['skipped']:>8}  "
+            f"{row['matches']:>7}  {row['suppressed']:>6}  {row['title']} ({row['id']})"
+        )
+    return "\n".join(lines)
+
+
+def profile_command_lines(path):
+    """
+    Evaluates every command line of a file (one per line) against the rules with
+    profiling enabled, and returns the RuleProfiler.
+    """
+    # Imported here so that "report" does not need the agent's runtime dependencies.
+    from process_monitor import check_rule_conditions
+
+    ruleset = load_rules()
+    if ruleset is None:
+        raise SystemExit("No rules loaded")
+    profiler = RuleProfiler()
+    ruleset.set_profiler(profiler)
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                check_rule_conditions(ruleset, CommandLineProcess(line))
+    return profiler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Ranks the detection rules by evaluation time, matches and filter suppressions."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    report_parser = subparsers.add_parser(
+        "report", help="print the profile recorded by the agent (\"rule_profiling\" in server_config.json)"
+    )
+    report_parser.add_argument("--file", default=DEFAULT_PROFILE_FILE, help="rule profile file")
+
+    profile_parser = subparsers.add_parser(
+        "profile", help="profile the rules over a file of command lines, one per line"
+    )
+    profile_parser.add_argument("cmdlines_file")
+    profile_parser.add_argument("--save", metavar="FILE", help="also save the profile to FILE")
+
+    for subparser in (report_parser, profile_parser):
+        subparser.add_argument("--sort", choices=SORT_KEYS, default="time", help="ranking (default: time)")
+        subparser.add_argument("--top", type=int, help="only list the first N rules")
+        subparser.add_argument("--never-matched", action="store_true",
+                               help="only list rules that never matched")
+    args = parser.parse_args(argv)
+
+    if args.command == "report":
+        profiler = RuleProfiler.load(args.file)
+        if not profiler.rows():
+            print(f"No rule profile recorded in {args.file}", file=sys.stderr)
+            return 1
+    else:
+        profiler = profile_command_lines(args.cmdlines_file)
+        if args.save:
+            profiler.save(args.save)
+
+    print(format_report(profiler, args.sort, args.top, args.never_matched))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
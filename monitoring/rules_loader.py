@@ -1,9 +1,19 @@
 import os
+import re
 import yaml
+import base64
 import pickle
+import mmap
+import struct
+import fnmatch
+import hashlib
+import json
+import time
 import tempfile
 import logging
 
+from aho_corasick import Automaton
+
 # Set up basic logging to output messages with level INFO or above.
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -12,77 +22,1184 @@ logger = logging.getLogger(__name__)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # Define the directory that contains the YAML rule files.
 RULES_DIR = os.path.join(BASE_DIR, "rules")
-# Define the cache file path for storing the loaded rules.
-CACHE_FILE = os.path.join(BASE_DIR, "rules_cache.pkl")
+# Define the cache file path for storing the compiled rules.
+CACHE_FILE = os.path.join(BASE_DIR, "rules_cache.bin")
+# Sigma logsource services indexed under the category of the same events.
+LOGSOURCE_SERVICES = {"powershell-classic": "ps_classic_start"}
+# Default file the rule profile is saved to ("rule_profile_file" in server_config.json).
+DEFAULT_PROFILE_FILE = os.path.join(BASE_DIR, "logs", "rule_profile.json")
+# Bump whenever the compiled rule format or compiler semantics change; this invalidates caches.
+COMPILER_VERSION = 4
+# Cache file header: magic, compiler version, ruleset key (SHA-256 digest).
+CACHE_MAGIC = b"PSWR"
+CACHE_HEADER = struct.Struct("<4sI32s")
 
-def get_latest_mod_time(directory):
+def list_rule_files(directory):
     """
-    Returns the latest modification time among all YAML files in the given directory.
-    This is used to determine if any rules have been updated.
+    Returns the paths of all YAML rule files in the directory (recursively),
+    relative to it and sorted, so the result is stable across runs.
     """
-    latest_time = 0
+    paths = []
     # Walk through the directory recursively.
     for root, _, files in os.walk(directory):
         for filename in files:
             # Consider only YAML files (with .yml or .yaml extension).
             if filename.endswith((".yml", ".yaml")):
-                filepath = os.path.join(root, filename)
-                # Update the latest_time if this file has been modified more recently.
-                latest_time = max(latest_time, os.path.getmtime(filepath))
-    return latest_time
+                paths.append(os.path.relpath(os.path.join(root, filename), directory))
+    return sorted(paths)
+
+
+def hash_rule_files(directory):
+    """
+    Returns a dict mapping each rule file (relative path) to the SHA-256 of its content.
+    """
+    hashes = {}
+    for relpath in list_rule_files(directory):
+        with open(os.path.join(directory, relpath), "rb") as f:
+            hashes[relpath] = hashlib.sha256(f.read()).hexdigest()
+    return hashes
+
 
-def save_cache(data, cache_file):
+def ruleset_key(file_hashes):
     """
-    Safely saves the cache data to the specified cache file using a temporary file.
+    Returns the cache key of a rules tree: a digest over the compiler version and the
+    names and content hashes of all rule files. Any added, removed or edited rule file,
+    or a new compiler version, produces a different key.
+    """
+    digest = hashlib.sha256(f"compiler:{COMPILER_VERSION}\n".encode())
+    for relpath, file_hash in sorted(file_hashes.items()):
+        digest.update(f"{relpath}\0{file_hash}\n".encode())
+    return digest.digest()
+
+
+def save_cache(data, key, cache_file):
+    """
+    Safely saves the compiled rules cache to the specified cache file using a temporary file.
     This prevents partial writes that might corrupt the cache.
+    The file starts with a fixed header (magic, compiler version, ruleset key) followed by
+    the pickled payload, so staleness is checked without unpickling anything.
     """
     temp_dir = os.path.dirname(cache_file)
     # Create a temporary file in the same directory.
     with tempfile.NamedTemporaryFile("wb", delete=False, dir=temp_dir) as tmp_file:
-        pickle.dump(data, tmp_file)
+        tmp_file.write(CACHE_HEADER.pack(CACHE_MAGIC, COMPILER_VERSION, key))
+        pickle.dump(data, tmp_file, protocol=pickle.HIGHEST_PROTOCOL)
         temp_name = tmp_file.name
     # Replace the existing cache file with the temporary file atomically.
     os.replace(temp_name, cache_file)
 
-def load_rules():
+
+def load_cache(cache_file):
+    """
+    Loads the compiled rules cache by memory-mapping the file and unpickling the payload
+    straight from the mapping. Returns (stored_key, data), or (None, None) for a missing,
+    corrupted or incompatible (other compiler version) cache.
+    """
+    try:
+        with open(cache_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if len(mapped) < CACHE_HEADER.size:
+                return None, None
+            magic, version, stored_key = CACHE_HEADER.unpack_from(mapped)
+            if magic != CACHE_MAGIC or version != COMPILER_VERSION:
+                return None, None
+            with memoryview(mapped)[CACHE_HEADER.size:] as payload:
+                return stored_key, pickle.loads(payload)
+    except FileNotFoundError:
+        return None, None
+    except (OSError, ValueError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+        # If cache is corrupted or unreadable, log a warning and proceed to recompile rules.
+        logger.warning("Rules cache corrupted, recompiling rules from YAML: %s", e)
+        return None, None
+
+
+class RuleCompileError(ValueError):
+    """
+    Raised when a rule uses detection syntax the compiler does not support.
+    """
+
+
+# Field modifiers the compiler understands.
+STRING_OPERATORS = ("contains", "startswith", "endswith")
+ENCODING_MODIFIERS = ("wide", "utf16le", "utf16be", "utf16")
+SUPPORTED_MODIFIERS = set(STRING_OPERATORS) | set(ENCODING_MODIFIERS) | {
+    "all", "re", "i", "m", "s", "base64", "base64offset", "windash", "cased", "exists"
+}
+# Characters accepted as a dash by Windows command line parsers (the windash modifier).
+WINDASH_CHARACTERS = ("-", "/", "\u2013", "\u2014", "\u2015")
+
+
+def split_wildcards(value):
+    """
+    Splits a Sigma string value into literal text and wildcards.
+    Unescaped '*' and '?' are wildcards; '\\*', '\\?' and '\\\\' are escaped literals.
+    Returns a list of parts, each either a literal string or the wildcard "*" / "?" as a
+    one-element tuple.
+    """
+    parts = []
+    literal = []
+    i = 0
+    while i < len(value):
+        ch = value[i]
+        if ch == "\\" and i + 1 < len(value) and value[i + 1] in "*?\\":
+            literal.append(value[i + 1])
+            i += 2
+            continue
+        if ch in "*?":
+            if literal:
+                parts.append("".join(literal))
+                literal = []
+            parts.append((ch,))
+        else:
+            literal.append(ch)
+        i += 1
+    if literal:
+        parts.append("".join(literal))
+    return parts
+
+
+def wildcard_to_regex(parts, operator, cased=False):
+    """
+    Builds a regex pattern from split_wildcards() parts, anchored according to the
+    string operator; it is case-insensitive unless cased.
+    """
+    body = "".join(
+        re.escape(part) if isinstance(part, str) else (".*" if part[0] == "*" else ".")
+        for part in parts
+    )
+    prefix = "" if operator in ("contains", "endswith") else "^"
+    suffix = "" if operator in ("contains", "startswith") else "$"
+    flags = "(?s)" if cased else "(?is)"
+    return f"{flags}{prefix}{body}{suffix}"
+
+
+def encode_value(value, modifiers):
+    """
+    Applies the encoding modifiers (wide/utf16*, base64, base64offset) to a value.
+    Returns a list of resulting strings (base64offset yields three variants).
+    """
+    if "utf16le" in modifiers or "wide" in modifiers:
+        raw = value.encode("utf-16-le")
+    elif "utf16be" in modifiers:
+        raw = value.encode("utf-16-be")
+    elif "utf16" in modifiers:
+        raw = b"\xff\xfe" + value.encode("utf-16-le")
+    else:
+        raw = value.encode("utf-8")
+
+    if "base64offset" in modifiers:
+        # The value may start at any of the three byte offsets within a base64 group;
+        # strip the characters that depend on the surrounding bytes.
+        start_offsets = (0, 2, 3)
+        end_offsets = (None, -3, -2)
+        return [
+            base64.b64encode(b" " * i + raw)[start_offsets[i]:end_offsets[(len(raw) + i) % 3]].decode("ascii")
+            for i in range(3)
+        ]
+    if "base64" in modifiers:
+        return [base64.b64encode(raw).decode("ascii")]
+    return [value]
+
+
+def expand_windash(value):
     """
-    Loads YAML rules using a caching mechanism.
-    If no YAML file has changed since the last load, the rules are loaded from a cache file.
-    Otherwise, the rules are reloaded from the YAML files and the cache is updated.
+    Returns the variants of a value with each dash that starts a word replaced
+    by every character Windows accepts as a dash.
+    """
+    positions = [i for i, ch in enumerate(value) if ch == "-" and (i == 0 or value[i - 1].isspace())]
+    if not positions:
+        return [value]
+    variants = []
+    for dash in WINDASH_CHARACTERS:
+        chars = list(value)
+        for i in positions:
+            chars[i] = dash
+        variants.append("".join(chars))
+    return variants
+
+
+def compile_field_test(key, values):
+    """
+    Compiles one "Field|modifier|...: values" entry of a search into a node.
+    Leaf nodes are tuples (operator, field, values, match_all, cased) where operator is
+    one of contains/startswith/endswith/equals/re, plus ("exists", field, expected)
+    and ("null", field). Values are lowercased unless the test is case-sensitive.
+    """
+    field, *modifiers = key.split("|")
+    field = field or None
+    unknown = set(modifiers) - SUPPORTED_MODIFIERS
+    if unknown:
+        raise RuleCompileError(f"unsupported modifier(s) {', '.join(sorted(unknown))} in '{key}'")
+
+    values = values if isinstance(values, list) else [values]
+    match_all = "all" in modifiers
+
+    if "exists" in modifiers:
+        return ("exists", field, bool(values[0]))
+
+    if "re" in modifiers:
+        flags = ""
+        flags += "i" if "i" in modifiers else ""
+        flags += "m" if "m" in modifiers else ""
+        flags += "s" if "s" in modifiers else ""
+        patterns = []
+        for value in values:
+            pattern = f"(?{flags}){value}" if flags else str(value)
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                raise RuleCompileError(f"invalid regex in '{key}': {e}")
+            patterns.append(pattern)
+        return ("re", field, tuple(patterns), match_all, True)
+
+    operator = next((op for op in STRING_OPERATORS if op in modifiers), "equals")
+    encoded = "base64" in modifiers or "base64offset" in modifiers
+    # Sigma string matching is case-insensitive unless cased, while base64 text is not.
+    cased = "cased" in modifiers or encoded
+
+    tests = []
+    for value in values:
+        if value is None:
+            tests.append(("null", field))
+            continue
+        value = str(value)
+        variants = []
+        for variant in encode_value(value, modifiers) if encoded else [value]:
+            variants.extend(expand_windash(variant) if "windash" in modifiers else [variant])
+
+        literals = []
+        alternatives = []
+        for variant in variants:
+            parts = [variant] if encoded else split_wildcards(variant)
+            if all(isinstance(part, str) for part in parts):
+                literals.append("".join(parts))
+                continue
+            # Wildcards turn the value into a regex; the longest literal part is kept as a
+            # needle so the rule can still be skipped cheaply when it is not present.
+            regex = ("re", field, (wildcard_to_regex(parts, operator, cased),), False, True)
+            longest = max((part for part in parts if isinstance(part, str)), key=len, default="")
+            if longest:
+                needle = longest if cased else longest.lower()
+                regex = ("and", (("contains", field, (needle,), False, cased), regex))
+            alternatives.append(regex)
+
+        if literals:
+            if not cased:
+                literals = [literal.lower() for literal in literals]
+            alternatives.append((operator, field, tuple(literals), False, cased))
+        tests.append(alternatives[0] if len(alternatives) == 1 else ("or", tuple(alternatives)))
+
+    if len(tests) == 1:
+        return tests[0]
+    if match_all:
+        return merge_and(tests)
+    # Merge the plain alternatives of the same operator into one leaf where possible.
+    return merge_or(tests)
+
+
+def merge_and(nodes):
+    """
+    Builds an AND node, merging single-value leaves that share operator, field and case
+    sensitivity into a single match-all leaf. A leaf with several values holds the
+    alternatives of one value (windash or base64offset variants), of which any one must
+    match, so it stays a child of its own.
+    """
+    merged = {}
+    others = []
+    for node in nodes:
+        if node[0] in ("contains", "startswith", "endswith", "equals") and not node[3] and len(node[2]) == 1:
+            key = (node[0], node[1], node[4])
+            merged.setdefault(key, []).extend(node[2])
+        else:
+            others.append(node)
+    children = [(op, field, tuple(values), True, cased) for (op, field, cased), values in merged.items()]
+    children.extend(others)
+    return children[0] if len(children) == 1 else ("and", tuple(children))
+
+
+def merge_or(nodes):
+    """
+    Builds an OR node, merging leaves that share operator, field and case sensitivity
+    into a single leaf with all their values.
+    """
+    merged = {}
+    others = []
+    for node in nodes:
+        if node[0] in ("contains", "startswith", "endswith", "equals") and not node[3]:
+            key = (node[0], node[1], node[4])
+            merged.setdefault(key, []).extend(node[2])
+        else:
+            others.append(node)
+    children = [(op, field, tuple(values), False, cased) for (op, field, cased), values in merged.items()]
+    children.extend(others)
+    return children[0] if len(children) == 1 else ("or", tuple(children))
+
+
+def compile_search(definition):
     """
-    latest_mod_time = get_latest_mod_time(RULES_DIR)
+    Compiles a search identifier definition:
+      - a map: all field tests must match (AND),
+      - a list of maps: any of the maps must match (OR),
+      - a list of plain values (keywords): any must be contained in the event text.
+    """
+    if isinstance(definition, dict):
+        tests = tuple(compile_field_test(key, values) for key, values in definition.items())
+        return tests[0] if len(tests) == 1 else ("and", tests)
+    if isinstance(definition, list):
+        if all(isinstance(item, dict) for item in definition):
+            return ("or", tuple(compile_search(item) for item in definition))
+        if not any(isinstance(item, (dict, list)) for item in definition):
+            return compile_field_test("|contains", definition)
+    if isinstance(definition, (str, int)):
+        return compile_field_test("|contains", [definition])
+    raise RuleCompileError(f"unsupported search definition: {definition!r}")
+
+
+CONDITION_TOKEN = re.compile(r"\s*(\(|\)|[^\s()]+)")
+
+
+def tokenize_condition(condition):
+    """
+    Splits a condition string into tokens (parentheses, keywords and identifiers).
+    """
+    tokens = []
+    position = 0
+    condition = condition.strip()
+    while position < len(condition):
+        match = CONDITION_TOKEN.match(condition, position)
+        if not match:
+            break
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+
+class ConditionParser:
+    """
+    Recursive-descent parser for Sigma condition strings.
+    Grammar (lowest to highest precedence):
+        expr    := and_expr ("or" and_expr)*
+        and_expr:= not_expr ("and" not_expr)*
+        not_expr:= "not" not_expr | atom
+        atom    := "(" expr ")" | ("1" | "any" | "all") "of" (pattern | "them") | identifier
+    Produces a node tree referencing search identifiers as ("search", name).
+    """
+
+    def __init__(self, condition, search_names):
+        self.tokens = tokenize_condition(condition)
+        self.position = 0
+        self.search_names = search_names
+
+    def parse(self):
+        if not self.tokens:
+            raise RuleCompileError("empty condition")
+        node = self._expr()
+        if self.position != len(self.tokens):
+            raise RuleCompileError(f"unexpected token '{self.tokens[self.position]}' in condition")
+        return node
+
+    def _peek(self):
+        return self.tokens[self.position].lower() if self.position < len(self.tokens) else None
+
+    def _next(self):
+        token = self.tokens[self.position] if self.position < len(self.tokens) else None
+        if token is None:
+            raise RuleCompileError("unexpected end of condition")
+        self.position += 1
+        return token
+
+    def _expr(self):
+        children = [self._and()]
+        while self._peek() == "or":
+            self._next()
+            children.append(self._and())
+        return children[0] if len(children) == 1 else ("or", tuple(children))
+
+    def _and(self):
+        children = [self._not()]
+        while self._peek() == "and":
+            self._next()
+            children.append(self._not())
+        return children[0] if len(children) == 1 else ("and", tuple(children))
+
+    def _not(self):
+        if self._peek() == "not":
+            self._next()
+            return ("not", self._not())
+        return self._atom()
+
+    def _atom(self):
+        token = self._next()
+        lowered = token.lower()
+        if token == "(":
+            node = self._expr()
+            if self._next() != ")":
+                raise RuleCompileError("missing ')' in condition")
+            return node
+        if token == "|":
+            raise RuleCompileError("aggregation conditions are not supported")
+        if lowered in ("1", "any", "all") and self._peek() == "of":
+            self._next()
+            pattern = self._next()
+            if pattern.lower() == "them":
+                names = [name for name in self.search_names if not name.startswith("_")]
+            else:
+                names = [name for name in self.search_names if fnmatch.fnmatchcase(name, pattern)]
+            if not names:
+                raise RuleCompileError(f"'{token} of {pattern}' matches no search identifier")
+            children = tuple(("search", name) for name in names)
+            if len(children) == 1:
+                return children[0]
+            return ("and" if lowered == "all" else "or", children)
+        if token not in self.search_names:
+            raise RuleCompileError(f"unknown search identifier '{token}' in condition")
+        return ("search", token)
+
+
+def resolve_searches(node, searches):
+    """
+    Replaces ("search", name) references in a condition tree with the compiled searches.
+    """
+    op = node[0]
+    if op == "search":
+        return searches[node[1]]
+    if op in ("and", "or"):
+        return (op, tuple(resolve_searches(child, searches) for child in node[1]))
+    if op == "not":
+        return ("not", resolve_searches(node[1], searches))
+    return node
+
+
+class CompiledRule:
+    """
+    A single Sigma rule compiled from its detection block.
+    The tree is made of plain tuples (see compile_field_test), so it can be cached;
+    a RuleSet links it into a predicate against its shared needle automaton.
+    Compiled rules are never modified by linking, so several rule sets (e.g. the one in
+    use and a freshly reloaded one) can share them.
+    """
+
+    __slots__ = ("rule", "tree")
+
+    def __init__(self, rule, tree):
+        self.rule = rule
+        self.tree = tree
+
+    def __getstate__(self):
+        return {"rule": self.rule, "tree": self.tree}
+
+    def __setstate__(self, state):
+        self.rule = state["rule"]
+        self.tree = state["tree"]
+
+
+def compile_rule(rule):
+    """
+    Compiles a rule's detection block: every search identifier is compiled and the
+    condition (a string or a list of strings, OR-ed) is parsed into a tree over them.
+    Raises RuleCompileError for unsupported syntax.
+    """
+    detection = rule.get("detection")
+    if not isinstance(detection, dict):
+        raise RuleCompileError("missing detection block")
+    condition = detection.get("condition")
+    if condition is None:
+        raise RuleCompileError("missing condition")
+
+    names = [name for name in detection if name != "condition"]
+    conditions = condition if isinstance(condition, list) else [condition]
+    trees = [ConditionParser(str(item), names).parse() for item in conditions]
+    tree = trees[0] if len(trees) == 1 else ("or", tuple(trees))
+
+    # Only compile the searches the condition actually references.
+    used = set()
+    collect_search_names(tree, used)
+    searches = {name: compile_search(detection[name]) for name in used}
+    return CompiledRule(rule, resolve_searches(tree, searches))
+
+
+def collect_search_names(node, names):
+    """
+    Collects the search identifiers referenced by a condition tree.
+    """
+    if node[0] == "search":
+        names.add(node[1])
+    elif node[0] in ("and", "or"):
+        for child in node[1]:
+            collect_search_names(child, names)
+    elif node[0] == "not":
+        collect_search_names(node[1], names)
+
+
+class FieldEvent:
+    """
+    An event whose fields map to texts; fields that are not present have no value (None).
+    Several fields may share one text, so lowercasing and the automaton scan are done
+    lazily and at most once per distinct text.
+    """
+
+    __slots__ = ("fields", "default", "automaton", "_lower", "_hits")
+
+    # The FieldSource the event comes from; None for events matched against every rule.
+    source = None
+
+    def __init__(self, fields, automaton, default=None):
+        self.fields = fields
+        self.default = default
+        self.automaton = automaton
+        self._lower = {}
+        self._hits = {}
+
+    def value(self, field):
+        # Keyword searches (field None) look at the default text.
+        return self.fields.get(field, self.default) if field is not None else self.default
+
+    def lower(self, field):
+        text = self.value(field)
+        if text is None:
+            return None
+        lowered = self._lower.get(text)
+        if lowered is None:
+            lowered = self._lower[text] = text.lower()
+        return lowered
+
+    def hits(self, field):
+        text = self.value(field)
+        if text is None:
+            return 0
+        hits = self._hits.get(text)
+        if hits is None:
+            hits = self._hits[text] = self.automaton.search(self.lower(field))
+        return hits
+
+    def all_hits(self, fields=None):
+        """
+        Returns the union of the needle hits over every text of the event, or only over
+        the texts of the given fields (None standing for the keyword text).
+        """
+        hits = 0
+        if fields is not None:
+            for field in fields:
+                hits |= self.hits(field)
+            return hits
+        for field in self.fields:
+            hits |= self.hits(field)
+        if self.default is not None:
+            hits |= self.hits(None)
+        return hits
+
+
+class TextEvent(FieldEvent):
+    """
+    An event consisting of one text (e.g. a command line) that is the value of every field.
+    """
+
+    __slots__ = ()
 
-    # Check if a valid, up-to-date cache exists.
-    if os.path.exists(CACHE_FILE):
+    def __init__(self, text, automaton):
+        super().__init__({}, automaton, default=text)
+
+    def value(self, field):
+        return self.default
+
+
+class FieldSource:
+    """
+    Describes the events of one event source to the rule index: the logsource categories
+    its events stand for, and for every field it can supply a function extracting the
+    field's text from a raw event (default extracts the text of keyword searches).
+    Only rules of those logsources that reference at least one of trigger_fields (by
+    default, any supplied field) are evaluated against its events; see RuleSet.view.
+    """
+
+    def __init__(self, name, logsources, extractors, default=None, trigger_fields=None):
+        self.name = name
+        self.logsources = frozenset(logsources)
+        self.extractors = dict(extractors)
+        self.default = default
+        if trigger_fields is None:
+            trigger_fields = list(self.extractors) + ([None] if default is not None else [])
+        self.trigger_fields = frozenset(trigger_fields)
+
+    def supplies(self, field):
+        return self.default is not None if field is None else field in self.extractors
+
+
+class SourceEvent(FieldEvent):
+    """
+    An event of a FieldSource. Each field is extracted from the raw event on first use,
+    so fields that no applicable rule reads are never computed. Events built from the
+    same raw data (e.g. a command line and its decoded payload) can share the lowercase
+    and automaton caches, which are keyed by text.
+    """
+
+    __slots__ = ("source", "raw", "_values")
+
+    def __init__(self, source, raw, automaton, shared=None):
+        super().__init__(source.extractors, automaton)
+        self.source = source
+        self.raw = raw
+        self._values = {}
+        if shared is not None:
+            self._lower = shared._lower
+            self._hits = shared._hits
+
+    def value(self, field):
         try:
-            with open(CACHE_FILE, "rb") as f:
-                cache_data = pickle.load(f)
-                # If the modification time in the cache matches the latest, return cached rules.
-                if cache_data.get("mod_time") == latest_mod_time:
-                    logger.info("Loaded rules from cache")
-                    return cache_data.get("rules", [])
-        except (pickle.UnpicklingError, EOFError) as e:
-            # If cache is corrupted or unreadable, log a warning and proceed to reload rules.
-            logger.warning("Cache file corrupted, reloading rules from YAML: %s", e)
-
-    # Otherwise, load rules from all YAML files in the directory.
-    rules = []
-    for root, _, files in os.walk(RULES_DIR):
-        for filename in files:
-            if filename.endswith((".yml", ".yaml")):
-                filepath = os.path.join(root, filename)
-                try:
-                    # Load each YAML file safely.
-                    with open(filepath, "r", encoding="utf-8") as file:
-                        rule = yaml.safe_load(file)
-                        if rule is not None:
-                            rules.append(rule)
-                except yaml.YAMLError as e:
-                    logger.error("Error loading YAML file: %s - %s", filepath, e)
-
-    # Build cache data with the loaded rules and latest modification time.
-    cache_data = {"rules": rules, "mod_time": latest_mod_time}
+            return self._values[field]
+        except KeyError:
+            pass
+        extractor = self.source.default if field is None else self.source.extractors.get(field)
+        text = self._values[field] = extractor(self.raw) if extractor is not None else None
+        return text
+
+
+def build_predicate(node, needle_ids):
+    """
+    Turns a compiled node tree into a predicate function taking an event.
+    Case-insensitive contains tests become bitmap checks against the automaton hits;
+    regexes are compiled once here.
+    """
+    op = node[0]
+    if op in ("and", "or"):
+        children = tuple(build_predicate(child, needle_ids) for child in node[1])
+        if op == "and":
+            def predicate(event):
+                for child in children:
+                    if not child(event):
+                        return False
+                return True
+        else:
+            def predicate(event):
+                for child in children:
+                    if child(event):
+                        return True
+                return False
+        return predicate
+    if op == "not":
+        child = build_predicate(node[1], needle_ids)
+        return lambda event: not child(event)
+    if op == "exists":
+        field, expected = node[1], node[2]
+        return lambda event: (event.value(field) is not None) == expected
+    if op == "null":
+        field = node[1]
+        return lambda event: not event.value(field)
+
+    _, field, values, match_all, cased = node
+    combine = all if match_all else any
+    if op == "contains" and not cased:
+        mask = 0
+        for value in values:
+            mask |= 1 << needle_ids[value]
+        if match_all:
+            return lambda event: event.hits(field) & mask == mask
+        return lambda event: event.hits(field) & mask != 0
+    if op == "re":
+        regexes = tuple(re.compile(pattern) for pattern in values)
+
+        def predicate(event):
+            text = event.value(field)
+            return text is not None and combine(regex.search(text) for regex in regexes)
+        return predicate
+
+    if op == "contains":
+        test = (lambda text: all(v in text for v in values)) if match_all else \
+            (lambda text: any(v in text for v in values))
+    elif op == "startswith":
+        test = (lambda text: all(text.startswith(v) for v in values)) if match_all else \
+            (lambda text: text.startswith(values))
+    elif op == "endswith":
+        test = (lambda text: all(text.endswith(v) for v in values)) if match_all else \
+            (lambda text: text.endswith(values))
+    elif op == "equals":
+        value_set = frozenset(values)
+        test = (lambda text: all(text == v for v in values)) if match_all else \
+            (lambda text: text in value_set)
+    else:
+        raise RuleCompileError(f"unknown node type '{op}'")
+
+    if cased:
+        def predicate(event):
+            text = event.value(field)
+            return text is not None and test(text)
+    else:
+        def predicate(event):
+            text = event.lower(field)
+            return text is not None and test(text)
+    return predicate
+
+
+def required_needles(node, needle_ids):
+    """
+    Returns a bitmap of needles of which at least one must be hit for the node to match,
+    or None if the node can match without any needle hit. Used to skip rules cheaply.
+    """
+    op = node[0]
+    if op == "contains" and not node[4]:
+        mask = 0
+        for value in node[2]:
+            mask |= 1 << needle_ids[value]
+        return mask
+    if op == "and":
+        for child in node[1]:
+            mask = required_needles(child, needle_ids)
+            if mask is not None:
+                return mask
+        return None
+    if op == "or":
+        combined = 0
+        for child in node[1]:
+            mask = required_needles(child, needle_ids)
+            if mask is None:
+                return None
+            combined |= mask
+        return combined
+    return None
+
+
+def collect_fields(node, fields):
+    """
+    Collects the fields referenced by a compiled node tree (None for keyword searches).
+    """
+    op = node[0]
+    if op in ("and", "or"):
+        for child in node[1]:
+            collect_fields(child, fields)
+    elif op == "not":
+        collect_fields(node[1], fields)
+    else:
+        fields.add(node[1])
+
+
+def rule_logsource(rule):
+    """
+    Returns the logsource category a rule is indexed under, or None if the rule does
+    not name one (it then applies to events of any source).
+    """
+    logsource = rule.get("logsource") or {}
+    if logsource.get("category"):
+        return str(logsource["category"])
+    return LOGSOURCE_SERVICES.get(logsource.get("service"))
+
+
+def collect_needles(node, needles):
+    """
+    Collects the lowercased needles of all case-insensitive contains leaves.
+    """
+    op = node[0]
+    if op in ("and", "or"):
+        for child in node[1]:
+            collect_needles(child, needles)
+    elif op == "not":
+        collect_needles(node[1], needles)
+    elif op == "contains" and not node[4]:
+        needles.extend(node[2])
+
+
+class RuleView:
+    """
+    The linked rules that apply to one kind of event, in rule order.
+    scan_fields are the fields whose texts are scanned for needle hits (None for all of
+    the event's texts).
+    """
+
+    def __init__(self, linked, scan_fields=None):
+        self.linked = linked
+        self.scan_fields = scan_fields
+        # (rule, predicate) for rules that must always be evaluated and
+        # (rule, required mask, predicate) for rules gated on needle hits.
+        self._always = [(compiled.rule, predicate) for compiled, mask, predicate in linked if mask is None]
+        self._gated = [(compiled.rule, mask, predicate) for compiled, mask, predicate in linked if mask is not None]
+        self._profiler = None
+        self._profiled = []
+
+    def __len__(self):
+        return len(self.linked)
+
+    def _link_profiled(self, profiler, needle_ids):
+        self._profiler = profiler
+        self._profiled = []
+        # Rules needing no needle hit come first, as in the unprofiled match order.
+        linked = sorted(self.linked, key=lambda entry: entry[1] is not None)
+        for compiled, required_mask, predicate in linked:
+            self._profiled.append((
+                compiled.rule, required_mask, predicate,
+                build_positive_predicate(compiled.tree, needle_ids),
+                profiler.stats(compiled.rule)
+            ))
+
+    def _match_profiled(self, event, profiler):
+        if profiler is not self._profiler:
+            self._link_profiled(profiler, event.automaton.needle_ids)
+        start = time.perf_counter()
+        hits = event.all_hits(self.scan_fields)
+        profiler.record_scan(time.perf_counter() - start)
+
+        matched = []
+        for rule, required_mask, predicate, positive, stats in self._profiled:
+            if required_mask is not None and not hits & required_mask:
+                stats[PROFILE_SKIPPED] += 1
+                continue
+            start = time.perf_counter()
+            result = predicate(event)
+            stats[PROFILE_SECONDS] += time.perf_counter() - start
+            stats[PROFILE_EVALUATIONS] += 1
+            if result:
+                stats[PROFILE_MATCHES] += 1
+                matched.append(rule)
+            elif positive is not None and positive(event):
+                # The selections matched, but a filter ("and not ...") vetoed the rule.
+                stats[PROFILE_SUPPRESSED] += 1
+        return matched
+
+    def match(self, event, profiler=None):
+        """
+        Returns the list of rules of the view matching the event.
+        """
+        if profiler is not None:
+            return self._match_profiled(event, profiler)
+        matched = [rule for rule, predicate in self._always if predicate(event)]
+        hits = event.all_hits(self.scan_fields)
+        if hits:
+            for rule, required_mask, predicate in self._gated:
+                if hits & required_mask and predicate(event):
+                    matched.append(rule)
+        return matched
+
+
+class RuleSet:
+    """
+    The compiled form of all loaded rules.
+    Every case-insensitive contains needle of every rule is lowercased once and fed into a
+    single Aho-Corasick automaton, so one pass over an event text yields all needle hits.
+    Each rule's condition is linked into a predicate over that hit bitmap (plus precompiled
+    regexes and string tests), and rules whose required needles were not hit are skipped.
+    Rules are also indexed by (logsource category, field), so that events of a FieldSource
+    are only evaluated against the rules that can apply to them.
+    """
+
+    def __init__(self, compiled_rules, automaton=None):
+        """
+        Links the compiled rules. A prebuilt automaton (e.g. from the rules cache) is reused
+        as long as it contains every needle of the rules; otherwise a new one is built.
+        """
+        self.compiled = list(compiled_rules)
+        self.rules = [compiled.rule for compiled in self.compiled]
+
+        needles = []
+        for compiled in self.compiled:
+            collect_needles(compiled.tree, needles)
+        if automaton is None or not all(needle in automaton.needle_ids for needle in needles):
+            automaton = Automaton()
+            for needle in needles:
+                automaton.add(needle)
+            automaton.build()
+        self.automaton = automaton
+        needle_ids = automaton.needle_ids
+
+        # Linked rules: (compiled rule, required needle mask or None, predicate).
+        self._linked = []
+        # Maps (logsource category, field) to the positions of the rules reading the field.
+        self.index = {}
+        for position, compiled in enumerate(self.compiled):
+            predicate = build_predicate(compiled.tree, needle_ids)
+            required_mask = required_needles(compiled.tree, needle_ids)
+            self._linked.append((compiled, required_mask, predicate))
+            fields = set()
+            collect_fields(compiled.tree, fields)
+            logsource = rule_logsource(compiled.rule)
+            for field in fields:
+                self.index.setdefault((logsource, field), []).append(position)
+        self._all = RuleView(self._linked)
+        # Views per FieldSource, built on first use.
+        self._views = {}
+        self.profiler = None
+
+        logger.info(
+            "Linked %d rules against an automaton with %d needles (%d rules need no needle hit)",
+            len(self.compiled), len(self.automaton), len(self._all._always)
+        )
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def view(self, source):
+        """
+        Returns the RuleView of the rules applicable to events of a FieldSource: rules of
+        one of its logsources (or of none) that read at least one of its trigger fields.
+        Only the supplied fields those rules read are scanned for needle hits.
+        """
+        view = self._views.get(source)
+        if view is not None:
+            return view
+        positions = set()
+        for (logsource, field), rule_positions in self.index.items():
+            if (logsource is None or logsource in source.logsources) and field in source.trigger_fields:
+                positions.update(rule_positions)
+        scan_fields = set()
+        for (logsource, field), rule_positions in self.index.items():
+            if source.supplies(field) and not positions.isdisjoint(rule_positions):
+                scan_fields.add(field)
+        view = self._views[source] = RuleView(
+            [self._linked[position] for position in sorted(positions)],
+            tuple(sorted(scan_fields, key=str))
+        )
+        logger.info("%d of %d rules apply to %s events", len(view), len(self), source.name)
+        return view
+
+    def set_profiler(self, profiler):
+        """
+        Enables (or, with None, disables) per-rule profiling into a RuleProfiler.
+        Profiled matching returns the same rules, but times every rule evaluation.
+        """
+        self.profiler = profiler
+        if profiler is not None:
+            # Rules that no event source can apply to show up in the report as well.
+            for rule in self.rules:
+                profiler.stats(rule)
+
+    def match_event(self, event):
+        """
+        Returns the list of rules matching the event. Events of a FieldSource are only
+        evaluated against the rules applicable to that source.
+        """
+        view = self._all if event.source is None else self.view(event.source)
+        return view.match(event, self.profiler)
+
+    def match(self, text):
+        """
+        Returns the list of rules matching the given text (e.g. a command line),
+        treating it as the value of every field.
+        """
+        return self.match_event(TextEvent(text, self.automaton))
+
+    def match_fields(self, fields, default=None):
+        """
+        Returns the list of rules matching an event given as a field -> text mapping.
+        Fields missing from the mapping fall back to default (None means "not present").
+        """
+        return self.match_event(FieldEvent(fields, self.automaton, default))
+
+    def match_source(self, source, raw, shared=None):
+        """
+        Returns the list of rules matching a raw event of a FieldSource, together with the
+        SourceEvent, whose caches a further event of the same data can share.
+        """
+        event = SourceEvent(source, raw, self.automaton, shared)
+        return self.match_event(event), event
+
+
+def build_positive_predicate(tree, needle_ids):
+    """
+    For a condition of the form "selection and not filter", returns a predicate of the
+    selections alone, telling whether a filter suppressed a match. Returns None if the
+    condition has no top-level "not" terms.
+    """
+    if tree[0] != "and" or not any(child[0] == "not" for child in tree[1]):
+        return None
+    positives = tuple(child for child in tree[1] if child[0] != "not")
+    if not positives:
+        return lambda event: True
+    return build_predicate(("and", positives), needle_ids)
+
+
+# Indexes of the per-rule statistics kept by RuleProfiler.
+PROFILE_EVALUATIONS, PROFILE_SECONDS, PROFILE_MATCHES, PROFILE_SUPPRESSED, PROFILE_SKIPPED = range(5)
+PROFILE_FIELDS = ("evaluations", "seconds", "matches", "suppressed", "skipped")
+
+
+def rule_profile_key(rule):
+    """
+    Identifies a rule across reloads and restarts: its id, or its title without one.
+    """
+    return str(rule.get("id") or rule.get("title", "Unknown"))
+
+
+class RuleProfiler:
+    """
+    Accumulates the cost of each rule while profiling is enabled (see RuleSet.set_profiler):
+    evaluations, time spent in the rule's predicate, matches, matches suppressed by a
+    filter and evaluations skipped by the needle prefilter. Statistics are keyed by rule
+    id, so they carry over hot reloads, and can be saved to and merged from a JSON file.
+    """
+
+    def __init__(self):
+        # Maps each rule key to [evaluations, seconds, matches, suppressed, skipped].
+        self._stats = {}
+        self.titles = {}
+        self.events = 0
+        self.automaton_seconds = 0.0
+
+    def stats(self, rule):
+        """
+        Returns the mutable statistics list of a rule, creating it if needed.
+        """
+        key = rule_profile_key(rule)
+        self.titles[key] = rule.get("title", "Unknown")
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = [0, 0.0, 0, 0, 0]
+        return stats
+
+    def record_event(self):
+        """
+        Counts one profiled event. An event may be matched several times (e.g. a process
+        and its decoded payload), so this is called by the event source, not per match.
+        """
+        self.events += 1
+
+    def record_scan(self, automaton_seconds):
+        self.automaton_seconds += automaton_seconds
+
+    def rows(self):
+        """
+        Returns one dict per rule with its key, title and statistics.
+        """
+        return [
+            dict(zip(PROFILE_FIELDS, stats), id=key, title=self.titles.get(key, "Unknown"))
+            for key, stats in self._stats.items()
+        ]
+
+    def to_dict(self):
+        return {"events": self.events, "automaton_seconds": self.automaton_seconds, "rules": self.rows()}
+
+    def merge(self, data):
+        """
+        Adds statistics previously produced by to_dict (e.g. from an earlier run).
+        """
+        self.events += data.get("events", 0)
+        self.automaton_seconds += data.get("automaton_seconds", 0.0)
+        for row in data.get("rules", []):
+            stats = self.stats({"id": row.get("id"), "title": row.get("title", "Unknown")})
+            for index, field in enumerate(PROFILE_FIELDS):
+                stats[index] += row.get(field, 0)
+
+    def save(self, path):
+        """
+        Writes the statistics to a JSON file atomically.
+        """
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", delete=False, dir=directory) as tmp_file:
+            json.dump(self.to_dict(), tmp_file, indent=1)
+            temp_name = tmp_file.name
+        os.replace(temp_name, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns a profiler holding the statistics saved in path (empty if it does not exist).
+        """
+        profiler = cls()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                profiler.merge(json.load(f))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read rule profile %s, starting a new one: %s", path, e)
+        return profiler
+
+
+def compile_rules(rules):
+    """
+    Compiles raw rule dicts into a RuleSet, skipping (and logging) rules that use
+    unsupported syntax.
+    """
+    compiled = []
+    for rule in rules:
+        try:
+            compiled.append(compile_rule(rule))
+        except RuleCompileError as e:
+            logger.warning("Skipping rule '%s': %s", rule.get("title", "Unknown"), e)
+    return RuleSet(compiled)
+
+
+def load_rule_file(filepath):
+    """
+    Loads one YAML rule file and compiles its rule.
+    Returns a list with the compiled rule, or an empty list if the file is empty,
+    invalid YAML or uses unsupported detection syntax.
+    """
+    try:
+        # Load each YAML file safely.
+        with open(filepath, "r", encoding="utf-8") as file:
+            rule = yaml.safe_load(file)
+    except yaml.YAMLError as e:
+        logger.error("Error loading YAML file: %s - %s", filepath, e)
+        return []
+    if not isinstance(rule, dict):
+        return []
+    try:
+        return [compile_rule(rule)]
+    except RuleCompileError as e:
+        logger.warning("Skipping rule '%s' (%s): %s", rule.get("title", "Unknown"), filepath, e)
+        return []
+
+
+def update_rule_files(file_hashes, cached_files):
+    """
+    Returns the per-file compiled rules ({relpath: (hash, [CompiledRule])}) for the given
+    rule file hashes, reusing cached entries whose hash is unchanged and compiling the rest.
+    Also returns the list of recompiled rule files.
+    """
+    files = {}
+    recompiled = []
+    for relpath, file_hash in file_hashes.items():
+        cached = cached_files.get(relpath)
+        if cached and cached[0] == file_hash:
+            files[relpath] = cached
+        else:
+            files[relpath] = (file_hash, load_rule_file(os.path.join(RULES_DIR, relpath)))
+            recompiled.append(relpath)
+    return files, recompiled
+
+
+def refresh_rules(files=None, automaton=None):
+    """
+    Brings the compiled rules up to date with the rules directory.
+    files is the per-file state returned by a previous call; when None (first load) it is
+    taken from the compiled rules cache, which is used as-is if nothing changed, so even the
+    needle automaton is reused. Otherwise only the rule files whose content changed are
+    recompiled, the given automaton is reused if it still covers every needle, and the cache
+    is rewritten.
+    Returns (ruleset, files, recompiled), where ruleset is None if files is already current.
+    """
+    file_hashes = hash_rule_files(RULES_DIR)
+
+    if files is None:
+        key = ruleset_key(file_hashes)
+        stored_key, cache_data = load_cache(CACHE_FILE)
+        files = cache_data.get("files", {}) if cache_data else {}
+        if cache_data and stored_key == key:
+            ruleset = RuleSet(
+                [compiled for relpath in file_hashes for compiled in files[relpath][1]],
+                cache_data.get("automaton")
+            )
+            logger.info("Loaded %d compiled rules from cache", len(ruleset))
+            return ruleset, files, []
+    elif {relpath: entry[0] for relpath, entry in files.items()} == file_hashes:
+        return None, files, []
+    else:
+        key = ruleset_key(file_hashes)
+
+    files, recompiled = update_rule_files(file_hashes, files)
+    ruleset = RuleSet(
+        [compiled for _, compiled_rules in files.values() for compiled in compiled_rules],
+        automaton
+    )
     # Save the new cache data safely.
-    save_cache(cache_data, CACHE_FILE)
-    logger.info("Loaded %d rules (fresh load)", len(rules))
-    return rules
+    save_cache({"files": files, "automaton": ruleset.automaton}, key, CACHE_FILE)
+    logger.info("Loaded %d rules (%d rule files compiled)", len(ruleset), len(recompiled))
+    return ruleset, files, recompiled
+
+
+def load_rules():
+    """
+    Loads the compiled rules, using the compiled rules cache when possible
+    (see refresh_rules).
+    """
+    return refresh_rules()[0]
@@ -0,0 +1,286 @@
+import os
+import sys
+import time
+import errno
+import ctypes
+import select
+import struct
+import logging
+
+from rules_loader import RULES_DIR, list_rule_files, refresh_rules
+from server_config import load_config
+
+# Configure basic logging to output messages with level INFO or higher.
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Editors and "git checkout" touch a file several times in a row; a reload waits until
+# the rules directory has been quiet for DEBOUNCE_SECONDS (but at most MAX_DEBOUNCE_SECONDS).
+DEBOUNCE_SECONDS = 0.2
+MAX_DEBOUNCE_SECONDS = 2.0
+
+RULE_FILE_SUFFIXES = (".yml", ".yaml")
+
+# inotify constants (see linux/inotify.h).
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF)
+
+# struct inotify_event: wd, mask, cookie, len (followed by len bytes of name).
+INOTIFY_EVENT = struct.Struct("=iIII")
+
+
+class RuleChangeSource:
+    """
+    Base class for sources reporting changes under the rules directory.
+    wait() blocks for at most timeout seconds (or until stop_event is set) and
+    returns True if a rule file may have been added, changed or removed.
+    """
+
+    name = "base"
+
+    def wait(self, stop_event, timeout):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PollingRuleChangeSource(RuleChangeSource):
+    """
+    Fallback source that compares the size and modification time of every rule file
+    once per interval. Only stat() is called; file contents are hashed by the reload.
+    """
+
+    name = "poll"
+
+    def __init__(self, directory=RULES_DIR, interval=2.0):
+        self.directory = directory
+        self.interval = interval
+        self._signature = self._scan()
+        self._next_scan = time.monotonic() + interval
+
+    def _scan(self):
+        signature = {}
+        for relpath in list_rule_files(self.directory):
+            try:
+                stat = os.stat(os.path.join(self.directory, relpath))
+            except OSError:
+                continue
+            signature[relpath] = (stat.st_mtime_ns, stat.st_size)
+        return signature
+
+    def wait(self, stop_event, timeout):
+        deadline = time.monotonic() + timeout
+        # Sleep in short 0.1-second steps to more frequently check if stop_event is set.
+        while not stop_event.is_set() and time.monotonic() < deadline:
+            time.sleep(min(0.1, max(0.0, deadline - time.monotonic())))
+        if stop_event.is_set() or time.monotonic() < self._next_scan:
+            return False
+        self._next_scan = time.monotonic() + self.interval
+        signature = self._scan()
+        changed = signature != self._signature
+        self._signature = signature
+        return changed
+
+
+class InotifyRuleChangeSource(RuleChangeSource):
+    """
+    Linux source driven by inotify (through libc via ctypes, no extra dependency).
+    Every directory of the rules tree is watched, so a rule edit is seen as soon as the
+    file is closed or renamed into place. Directories created later are watched as well.
+    Raises OSError if inotify is unavailable.
+    """
+
+    name = "inotify"
+
+    def __init__(self, directory=RULES_DIR):
+        self.directory = directory
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        try:
+            self._watch_tree()
+        except OSError:
+            os.close(self._fd)
+            raise
+
+    def _watch(self, path):
+        if self._add_watch(self._fd, os.fsencode(path), WATCH_MASK) < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+
+    def _watch_tree(self):
+        """
+        Adds a watch for the rules directory and all its subdirectories.
+        Adding a watch for an already watched directory is a no-op.
+        """
+        for root, _, _ in os.walk(self.directory):
+            self._watch(root)
+
+    def _read_events(self):
+        """
+        Drains pending inotify events and returns True if any of them concerns a rule file
+        or a directory (or the kernel queue overflowed).
+        """
+        changed = False
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset + INOTIFY_EVENT.size <= len(data):
+                _, mask, _, name_len = INOTIFY_EVENT.unpack_from(data, offset)
+                name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + name_len]
+                offset += INOTIFY_EVENT.size + name_len
+                name = name.rstrip(b"\0").decode("utf-8", errors="replace")
+                if mask & IN_Q_OVERFLOW:
+                    changed = True
+                elif mask & IN_ISDIR:
+                    changed = True
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        try:
+                            self._watch_tree()
+                        except OSError as e:
+                            logger.warning("Could not watch new rules directory: %s", e)
+                elif mask & (IN_DELETE_SELF | IN_MOVE_SELF) or name.endswith(RULE_FILE_SUFFIXES):
+                    changed = True
+
+    def wait(self, stop_event, timeout):
+        deadline = time.monotonic() + timeout
+        while not stop_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                readable, _, _ = select.select([self._fd], [], [], min(0.1, remaining))
+            except InterruptedError:
+                continue
+            if readable and self._read_events():
+                return True
+        return False
+
+    def close(self):
+        try:
+            os.close(self._fd)
+        except OSError as e:
+            if e.errno != errno.EBADF:
+                raise
+
+
+def create_rule_change_source(preferred="auto", directory=RULES_DIR, poll_interval=2.0):
+    """
+    Creates the rule change source used by RulesWatcher.
+    preferred is one of "auto", "inotify" or "poll". With "auto" inotify is used on Linux
+    when available, otherwise rule files are polled every poll_interval seconds.
+    """
+    if preferred in ("auto", "inotify") and sys.platform.startswith("linux"):
+        try:
+            source = InotifyRuleChangeSource(directory)
+            logger.info("Watching rules directory with inotify")
+            return source
+        except (OSError, AttributeError) as e:
+            logger.warning("inotify unavailable, falling back to polling the rules directory: %s", e)
+    elif preferred == "inotify":
+        logger.warning("inotify is only available on Linux, falling back to polling the rules directory")
+
+    logger.info("Polling rules directory every %.1f seconds", poll_interval)
+    return PollingRuleChangeSource(directory, poll_interval)
+
+
+class RulesWatcher:
+    """
+    Keeps the compiled rule set in sync with the rules directory while the agent runs.
+    On a change only the rule files whose content changed are recompiled (see
+    rules_loader.refresh_rules), and the new RuleSet is published by replacing the
+    ruleset attribute in one assignment. monitor_system picks it up between ticks, so a
+    batch of processes is always evaluated against a single, complete rule set, and the
+    agent (with its notification dedupe state) keeps running.
+    """
+
+    def __init__(self, ruleset, files, source=None):
+        self.ruleset = ruleset
+        self._files = files
+        self.source = source
+        # Reload statistics of the last successful reload (seconds).
+        self.reloads = 0
+        self.last_compile_time = None
+        self.last_reload_latency = None
+
+    def reload(self, detected_at=None):
+        """
+        Recompiles the changed rule files and swaps in the new rule set.
+        detected_at is the time.monotonic() at which the change was first seen, used to
+        report the reload latency. Returns True if a new rule set was published.
+        """
+        compile_start = time.monotonic()
+        try:
+            ruleset, files, recompiled = refresh_rules(self._files, self.ruleset.automaton)
+        except Exception as e:
+            # Keep running with the previous rules; the next change triggers another attempt.
+            logger.error("Failed to reload rules, keeping the previous rule set: %s", e, exc_info=True)
+            return False
+        if ruleset is None:
+            logger.debug("Rules directory changed but no rule file content did")
+            return False
+
+        removed = len(set(self._files) - set(files))
+        self._files = files
+        self.ruleset = ruleset
+        swapped_at = time.monotonic()
+
+        self.reloads += 1
+        self.last_compile_time = swapped_at - compile_start
+        self.last_reload_latency = swapped_at - (detected_at if detected_at is not None else compile_start)
+        if not ruleset:
+            logger.warning("Rules reload left no rules loaded; nothing will be detected until rules are added")
+        logger.info(
+            "Reloaded rules: %d rules active, %d rule files recompiled, %d removed; "
+            "compile time %.1f ms, reload latency %.1f ms",
+            len(ruleset), len(recompiled), removed,
+            self.last_compile_time * 1000, self.last_reload_latency * 1000
+        )
+        return True
+
+    def run(self, stop_event):
+        """
+        Watches the rules directory until stop_event is set, reloading after each burst of
+        changes. Intended to run in its own thread.
+        """
+        if self.source is None:
+            config = load_config()
+            self.source = create_rule_change_source(
+                config.get("rules_watcher", "auto"),
+                poll_interval=float(config.get("rules_poll_interval", 2.0))
+            )
+        try:
+            while not stop_event.is_set():
+                if not self.source.wait(stop_event, 1.0):
+                    continue
+                detected_at = time.monotonic()
+                # Wait for the burst of changes to settle before recompiling.
+                while (self.source.wait(stop_event, DEBOUNCE_SECONDS)
+                       and time.monotonic() - detected_at < MAX_DEBOUNCE_SECONDS):
+                    pass
+                if not stop_event.is_set():
+                    self.reload(detected_at)
+        except Exception as e:
+            logger.error("Exception in rules watcher: %s", e, exc_info=True)
+        finally:
+            self.source.close()
+        logger.info("Rules watcher exiting gracefully due to stop_event.")
@@ -0,0 +1,192 @@
+import time
+import logging
+import threading
+
+import psutil
+
+from server_config import load_config
+from metrics import counter, gauge
+
+# Configure basic logging to output messages with level INFO or higher.
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Process scan interval bounds (seconds), overridable in server_config.json.
+DEFAULT_SCAN_INTERVAL = 1.0
+DEFAULT_SCAN_MIN_INTERVAL = 0.25
+DEFAULT_SCAN_MAX_INTERVAL = 5.0
+# Each idle scan (or scan under CPU pressure) stretches the interval by this factor.
+SCAN_BACKOFF = 1.5
+# System-wide CPU usage (percent) above which scanning backs off.
+DEFAULT_CPU_THRESHOLD = 85.0
+
+# Upload interval bounds (seconds) and the backlog that triggers an early upload.
+DEFAULT_UPLOAD_MIN_INTERVAL = 5.0
+DEFAULT_UPLOAD_MAX_INTERVAL = 30.0
+DEFAULT_UPLOAD_BACKLOG_BYTES = 256 * 1024
+# Detections of these levels are uploaded right away (after upload_min_interval).
+DEFAULT_URGENT_LEVELS = ("critical",)
+
+SCAN_INTERVAL = gauge("scan_interval_seconds", "Current interval between process table scans")
+EARLY_UPLOADS = counter("early_uploads_total", "Uploads started before the maximum upload interval, for a backlog or an urgent detection")
+
+
+class AdaptiveInterval:
+    """
+    Interval between process table scans, adapted to the load of the host.
+    When new target processes appear, scanning speeds up to min_interval, so a burst of
+    PowerShell activity is followed closely. Every idle scan stretches the interval by
+    SCAN_BACKOFF up to max_interval, and while the CPU is busier than cpu_threshold the
+    interval does not drop below the base interval.
+    """
+
+    def __init__(self, interval=DEFAULT_SCAN_INTERVAL, min_interval=DEFAULT_SCAN_MIN_INTERVAL,
+                 max_interval=DEFAULT_SCAN_MAX_INTERVAL, cpu_threshold=DEFAULT_CPU_THRESHOLD):
+        self.min_interval = min(min_interval, max_interval)
+        self.max_interval = max_interval
+        self.base_interval = max(self.min_interval, min(interval, max_interval))
+        self.cpu_threshold = cpu_threshold
+        self.interval = self.base_interval
+        # The first call only starts psutil's CPU usage measurement.
+        psutil.cpu_percent(interval=None)
+        SCAN_INTERVAL.set(self.interval)
+
+    def update(self, new_processes):
+        """
+        Returns the interval until the next scan, given the number of new target
+        processes found by the last one.
+        """
+        busy = self.cpu_threshold and psutil.cpu_percent(interval=None) >= self.cpu_threshold
+        if new_processes and not busy:
+            interval = self.min_interval
+        elif new_processes:
+            interval = self.base_interval
+        else:
+            interval = self.interval * SCAN_BACKOFF
+            if busy:
+                interval = max(interval, self.base_interval)
+        self.interval = max(self.min_interval, min(interval, self.max_interval))
+        SCAN_INTERVAL.set(self.interval)
+        return self.interval
+
+
+def create_scan_interval(config):
+    """
+    Creates the scan interval from server_config.json settings: "scan_interval" (the
+    base interval), "scan_min_interval", "scan_max_interval" and "scan_cpu_threshold"
+    (0 disables the CPU check).
+    """
+    return AdaptiveInterval(
+        float(config.get("scan_interval", DEFAULT_SCAN_INTERVAL)),
+        float(config.get("scan_min_interval", DEFAULT_SCAN_MIN_INTERVAL)),
+        float(config.get("scan_max_interval", DEFAULT_SCAN_MAX_INTERVAL)),
+        float(config.get("scan_cpu_threshold", DEFAULT_CPU_THRESHOLD)),
+    )
+
+
+class UploadScheduler:
+    """
+    Decides when the uploader runs next. An upload is due max_interval seconds after the
+    previous one, or as soon as min_interval has passed if the unshipped bytes reached
+    backlog_bytes or a detection of an urgent level was written (see request()).
+    The backlog is read from a callback, set with set_backlog_function.
+    """
+
+    def __init__(self, min_interval=DEFAULT_UPLOAD_MIN_INTERVAL, max_interval=DEFAULT_UPLOAD_MAX_INTERVAL,
+                 backlog_bytes=DEFAULT_UPLOAD_BACKLOG_BYTES, urgent_levels=DEFAULT_URGENT_LEVELS):
+        self.min_interval = min(min_interval, max_interval)
+        self.max_interval = max_interval
+        self.backlog_bytes = backlog_bytes
+        self.urgent_levels = frozenset(level.lower() for level in urgent_levels)
+        self._backlog_function = None
+        self._urgent = threading.Event()
+        self._last_upload = time.monotonic()
+
+    def set_backlog_function(self, function):
+        self._backlog_function = function
+
+    def request(self, reason="urgent detection"):
+        """
+        Asks for an upload as soon as min_interval allows. Thread-safe.
+        """
+        if not self._urgent.is_set():
+            logger.debug("Early upload requested: %s", reason)
+        self._urgent.set()
+
+    def notify_written(self, entries):
+        """
+        Called with the log entries just written; requests an upload if one of them
+        is a detection of an urgent level.
+        """
+        for entry in entries:
+            if isinstance(entry, dict) and str(entry.get("rule", {}).get("level", "")).lower() in self.urgent_levels:
+                self.request(f"{entry['rule']['level']} detection")
+                return
+
+    def _backlog(self):
+        if self._backlog_function is None:
+            return 0
+        try:
+            return self._backlog_function()
+        except Exception as e:
+            logger.debug("Could not determine the upload backlog: %s", e)
+            return 0
+
+    def _due(self, elapsed):
+        if elapsed >= self.max_interval:
+            return True
+        if elapsed < self.min_interval:
+            return False
+        if self._urgent.is_set():
+            logger.info("Uploading early for an urgent detection")
+        elif self.backlog_bytes and self._backlog() >= self.backlog_bytes:
+            logger.info("Uploading early, the upload backlog reached %d bytes", self.backlog_bytes)
+        else:
+            return False
+        EARLY_UPLOADS.inc()
+        return True
+
+    def wait(self, stop_event, step=1.0):
+        """
+        Blocks until the next upload is due. Returns False if stop_event was set instead.
+        """
+        while not stop_event.is_set():
+            elapsed = time.monotonic() - self._last_upload
+            if self._due(elapsed):
+                self._urgent.clear()
+                return True
+            if elapsed < self.min_interval:
+                stop_event.wait(min(step, self.min_interval - elapsed))
+            else:
+                # Wake up right away for an urgent request.
+                self._urgent.wait(min(step, self.max_interval - elapsed))
+        return False
+
+    def uploaded(self):
+        """
+        Records that an upload cycle has just finished.
+        """
+        self._last_upload = time.monotonic()
+
+
+_upload_scheduler = None
+_upload_scheduler_lock = threading.Lock()
+
+
+def get_upload_scheduler():
+    """
+    Returns the shared upload scheduler, created from server_config.json settings on
+    first use: "upload_min_interval", "upload_max_interval", "upload_backlog_bytes"
+    (0 disables backlog-triggered uploads) and "upload_urgent_levels".
+    """
+    global _upload_scheduler
+    with _upload_scheduler_lock:
+        if _upload_scheduler is None:
+            config = load_config()
+            _upload_scheduler = UploadScheduler(
+                float(config.get("upload_min_interval", DEFAULT_UPLOAD_MIN_INTERVAL)),
+                float(config.get("upload_max_interval", DEFAULT_UPLOAD_MAX_INTERVAL)),
+                int(config.get("upload_backlog_bytes", DEFAULT_UPLOAD_BACKLOG_BYTES)),
+                config.get("upload_urgent_levels", DEFAULT_URGENT_LEVELS),
+            )
+        return _upload_scheduler
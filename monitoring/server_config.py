@@ -97,3 +97,47 @@ def get_server_ip_and_port():
 
     save_config(config)
     return ip, int(port)
+
+
+def parse_endpoint(value, default_port=22):
+    """
+    Parses a logsink endpoint given as "ip", "ip:port", "[ipv6]:port" or
+    {"ip": ..., "port": ...}. Returns (ip, port), or None if it is not valid.
+    """
+    if isinstance(value, dict):
+        ip, port = value.get("ip"), value.get("port", default_port)
+    else:
+        text = str(value).strip()
+        if text.startswith("[") and "]" in text:
+            ip, _, port = text[1:].partition("]")
+            port = port.lstrip(":") or default_port
+        elif text.count(":") == 1:
+            ip, port = text.split(":")
+        else:
+            ip, port = text, default_port
+    if not (ip and is_valid_ip(str(ip))):
+        return None
+    if not (str(port).isdigit() and 1 <= int(port) <= 65535):
+        return None
+    return str(ip), int(port)
+
+
+def get_server_endpoints():
+    """
+    Retrieves the logsink endpoints as a list of (ip, port) tuples: the "servers" list
+    of the configuration file (e.g. ["10.0.0.5", "10.0.0.6:2222"]) when present,
+    otherwise the single server of get_server_ip_and_port.
+    """
+    servers = load_config().get("servers")
+    if servers:
+        endpoints = []
+        for server in servers:
+            endpoint = parse_endpoint(server)
+            if endpoint is None:
+                logger.warning("Ignoring invalid server in configuration: %s", server)
+            elif endpoint not in endpoints:
+                endpoints.append(endpoint)
+        if endpoints:
+            return endpoints
+        logger.info("No valid server in the configured servers list.")
+    return [get_server_ip_and_port()]
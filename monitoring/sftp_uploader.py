@@ -3,9 +3,22 @@ import getpass
 import time
 import logging
 import paramiko
-import tempfile
 import sys
 import uuid
+import gzip
+import json
+import socket
+import tempfile
+import threading
+
+from server_config import load_config
+from metrics import counter, gauge, histogram
+from upload_endpoints import ENDPOINT_FAILOVERS, endpoint_name
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # Determine base directory (this file’s folder) and project root (parent of BASE_DIR)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -20,8 +33,10 @@ UUID_FILE = os.path.join(BASE_DIR, "uuid.txt")
 
 # Define the path for the shared log file which is assumed to be generated by log_generator.py.
 SHARED_LOG_FILE = os.path.join(LOG_DIR, "threats.log")
-# Define the file that stores the last read offset of the shared log file to ensure incremental uploads.
+# Legacy file that stored the last read offset of the shared log file (migrated to the checkpoint).
 UPLOAD_OFFSET_FILE = os.path.join(LOG_DIR, "upload_offset.txt")
+# Checkpoint of the upload position: log file inode, byte offset and chunk sequence number.
+CHECKPOINT_FILE = os.path.join(LOG_DIR, "upload_checkpoint.json")
 
 # Define the SSH private key path using the current user's home directory.
 HOME_DIR = os.path.expanduser("~")
@@ -32,10 +47,35 @@ PORT = 22
 SFTP_USERNAME = "logsink"
 REMOTE_BASE_DIR = "PSWatchdog"
 
+# Seconds to wait for a TCP connection to a logsink server before failing over.
+CONNECT_TIMEOUT = 10
+# Size of the blocks read from the shared log file while streaming an upload.
+READ_CHUNK_SIZE = 64 * 1024
+# Remote file name suffix for each supported upload compression.
+COMPRESSION_SUFFIXES = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+# Defaults for "upload_chunk_bytes" and "upload_max_chunks" in server_config.json:
+# the largest chunk shipped as one remote file and how many chunks one upload cycle may ship.
+DEFAULT_CHUNK_BYTES = 4 * 1024 * 1024
+DEFAULT_MAX_CHUNKS = 16
+
 # Setup basic logging configuration for uploader operations.
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger("UploaderLogger")
 
+UPLOAD_CYCLE_SECONDS = histogram("upload_cycle_seconds", "Duration of one upload_files cycle")
+UPLOAD_CHUNK_SECONDS = histogram("upload_chunk_seconds", "Time to stream one log chunk to the server")
+UPLOADED_BYTES = counter("uploaded_bytes_total", "Log bytes shipped to the server (before compression)")
+UPLOADED_CHUNKS = counter("uploaded_chunks_total", "Log chunks shipped to the server")
+UPLOAD_FAILURES = counter("upload_failures_total", "Failed chunk uploads")
+UPLOAD_BACKLOG_BYTES = gauge("upload_backlog_bytes", "Log bytes written locally but not yet uploaded, after the last cycle")
+UPLOAD_LAST_SUCCESS = gauge("upload_last_success_timestamp_seconds", "Unix time of the last cycle that left no backlog")
+
+
+class LogRotatedError(Exception):
+    """
+    Raised when the local log file of a chunk was rotated away before it was uploaded.
+    """
+
 
 def load_last_offset():
     """
@@ -52,60 +92,370 @@ def load_last_offset():
         return 0
 
 
-def save_last_offset(offset):
+def load_checkpoint():
     """
-    Save the current log offset to UPLOAD_OFFSET_FILE to resume uploading from the correct position.
+    Load the upload checkpoint: the inode of the log file being shipped, the byte offset
+    shipped so far within it, and the sequence number of the last uploaded chunk, plus
+    the name of a chunk attempted but not yet confirmed ("pending").
+    Without a checkpoint, the legacy UPLOAD_OFFSET_FILE offset is applied to the current
+    shared log file; without either, shipping starts from the oldest rotated file.
     """
     try:
-        with open(UPLOAD_OFFSET_FILE, "w") as f:
-            f.write(str(offset))
-        logger.debug("Saved new offset: %d", offset)
+        with open(CHECKPOINT_FILE, "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
+            logger.debug("Loaded upload checkpoint: %s", checkpoint)
+            return checkpoint
+    except FileNotFoundError:
+        pass
     except Exception as e:
-        logger.error("Failed to save offset: %s", e)
+        logger.warning("Failed to load upload checkpoint, rebuilding it: %s", e)
+
+    checkpoint = {"inode": None, "offset": 0, "sequence": 0}
+    if os.path.exists(UPLOAD_OFFSET_FILE) and os.path.exists(SHARED_LOG_FILE):
+        checkpoint["inode"] = os.stat(SHARED_LOG_FILE).st_ino
+        checkpoint["offset"] = load_last_offset()
+        logger.info("Migrated legacy upload offset %d to a checkpoint", checkpoint["offset"])
+    return checkpoint
 
 
-def get_new_log_entries():
+def save_checkpoint(checkpoint):
     """
-    Read new entries from the shared log file starting from the last recorded offset.
-    Returns the new data and the updated offset.
+    Atomically save the upload checkpoint using a temporary file,
+    so a crash can never leave a partially written checkpoint behind.
     """
-    last_offset = load_last_offset()
-    if not os.path.exists(SHARED_LOG_FILE):
-        logger.warning("Shared log file not found at %s", SHARED_LOG_FILE)
-        return "", last_offset
     try:
-        with open(SHARED_LOG_FILE, "r", encoding="utf-8") as f:
-            f.seek(last_offset)
-            new_data = f.read()
-            new_offset = f.tell()
-        logger.debug("Read new log entries from offset %d to %d", last_offset, new_offset)
-        return new_data, new_offset
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", delete=False, dir=LOG_DIR) as tmp_file:
+            json.dump(checkpoint, tmp_file)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+            temp_name = tmp_file.name
+        os.replace(temp_name, CHECKPOINT_FILE)
+        logger.debug("Saved upload checkpoint: %s", checkpoint)
     except Exception as e:
-        logger.error("Error while reading log entries: %s", e)
-        return "", last_offset
+        logger.error("Failed to save upload checkpoint: %s", e)
+
+
+def find_next_line_end(f, start, end):
+    """
+    Returns the offset just past the first newline in f between start and end,
+    or start if there is none.
+    """
+    f.seek(start)
+    position = start
+    while position < end:
+        block = f.read(min(READ_CHUNK_SIZE, end - position))
+        if not block:
+            break
+        newline = block.find(b"\n")
+        if newline != -1:
+            return position + newline + 1
+        position += len(block)
+    return start
+
+
+def list_log_files():
+    """
+    Returns the shared log file and its rotated backups (threats.log.N, written by the
+    RotatingFileHandler in log_generator) as (path, inode, size) tuples, oldest first.
+    """
+    backups = []
+    for filename in os.listdir(LOG_DIR):
+        prefix = os.path.basename(SHARED_LOG_FILE) + "."
+        if filename.startswith(prefix) and filename[len(prefix):].isdigit():
+            backups.append((int(filename[len(prefix):]), os.path.join(LOG_DIR, filename)))
+    # Higher numbers are older: threats.log.5 was rotated out before threats.log.1.
+    paths = [path for _, path in sorted(backups, reverse=True)] + [SHARED_LOG_FILE]
+
+    files = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            # Rotated away while we were listing.
+            continue
+        files.append((path, stat.st_ino, stat.st_size))
+    return files
+
+
+def find_last_line_end(f, start, end):
+    """
+    Returns the offset just past the last newline in f between start and end,
+    scanning backwards in small blocks, or start if there is no complete line.
+    This keeps a record that is still being written out of the upload.
+    """
+    position = end
+    while position > start:
+        block_start = max(start, position - READ_CHUNK_SIZE)
+        f.seek(block_start)
+        block = f.read(position - block_start)
+        newline = block.rfind(b"\n")
+        if newline != -1:
+            return block_start + newline + 1
+        position = block_start
+    return start
+
+
+def plan_upload_chunks(checkpoint, max_chunk_bytes, max_chunks):
+    """
+    Plans the chunks to ship in this cycle, starting at the checkpoint.
+    The file holding the checkpoint inode is drained first, followed by every newer file,
+    so entries written right before a rotation are not lost or re-sent. Chunks end on line
+    boundaries and are at most max_chunk_bytes long (unless a single line is longer);
+    only the live file holds back a trailing incomplete line.
+    Returns a list of (path, inode, start, end) tuples; an empty range only moves the
+    checkpoint on to the next file.
+    """
+    files = list_log_files()
+    if not files:
+        logger.warning("Shared log file not found at %s", SHARED_LOG_FILE)
+        return []
+
+    inodes = [inode for _, inode, _ in files]
+    if checkpoint.get("inode") in inodes:
+        first = inodes.index(checkpoint["inode"])
+        offset = checkpoint.get("offset", 0)
+        if offset > files[first][2]:
+            logger.warning("Log file %s shrank below the checkpoint, reading it from the start", files[first][0])
+            offset = 0
+    else:
+        if checkpoint.get("inode") is not None:
+            logger.warning("Checkpointed log file was rotated out before it was shipped; some entries were lost")
+        first, offset = 0, 0
+
+    chunks = []
+    for index in range(first, len(files)):
+        path, inode, size = files[index]
+        start = offset if index == first else 0
+        if index > first:
+            # Move the checkpoint onto this file even if it has nothing complete yet.
+            chunks.append((path, inode, 0, 0))
+        try:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_ino != inode:
+                    # The file was rotated between listing and opening; retry next cycle.
+                    break
+                while start < size and len(chunks) < max_chunks:
+                    end = find_last_line_end(f, start, min(size, start + max_chunk_bytes))
+                    if end == start:
+                        # A single line longer than max_chunk_bytes; ship it whole.
+                        end = find_next_line_end(f, start, size)
+                        if end == start:
+                            if path == SHARED_LOG_FILE:
+                                break
+                            # Only the live file may still complete its last line; a rotated
+                            # file cut off mid-line (e.g. by a crash) is shipped as it is.
+                            logger.warning("Rotated log file %s ends in an incomplete line", path)
+                            end = size
+                    chunks.append((path, inode, start, end))
+                    start = end
+        except FileNotFoundError:
+            break
+        if len(chunks) >= max_chunks or start < size:
+            # Budget exhausted or the rest of this file is an incomplete line.
+            break
+    return chunks
+
+
+def open_compressor(remote_file, compression):
+    """
+    Wraps the remote file handle in a streaming compressor.
+    Returns a writable file object; closing it finishes the compressed stream
+    without closing the remote file.
+    """
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=remote_file, mode="wb", compresslevel=6)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=3).stream_writer(remote_file, closefd=False)
+    return None
+
+
+def get_upload_compression():
+    """
+    Returns the configured upload compression ("none", "gzip" or "zstd").
+    Falls back to gzip when zstd is requested but the zstandard package is missing.
+    """
+    compression = str(load_config().get("upload_compression", "none")).lower()
+    if compression == "zstd" and zstandard is None:
+        logger.warning("zstandard is not installed, using gzip compression instead")
+        return "gzip"
+    if compression not in COMPRESSION_SUFFIXES:
+        logger.warning("Unknown upload compression %r, uploading uncompressed", compression)
+        return "none"
+    return compression
+
+
+class SFTPConnectionManager:
+    """
+    Keeps one authenticated SFTP session to the logsink server alive across uploads.
+    The private key is loaded once, the transport is kept alive with SSH keepalives,
+    broken connections are re-established transparently (with exponential backoff
+    after failures), and remote directories known to exist are cached.
+    """
+
+    def __init__(self, server_ip, server_port=PORT, keepalive_interval=30,
+                 initial_backoff=5, max_backoff=300):
+        self.server_ip = server_ip
+        self.server_port = server_port
+        self.keepalive_interval = keepalive_interval
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.RLock()
+        self._private_key = None
+        self._transport = None
+        self._sftp = None
+        self._known_dirs = set()
+        self._failures = 0
+        self._next_attempt = 0.0
+
+    def _load_private_key(self):
+        if self._private_key is None:
+            if not os.path.exists(PRIVATE_KEY_PATH):
+                raise FileNotFoundError(f"Private key does not exist at {PRIVATE_KEY_PATH}")
+            self._private_key = paramiko.RSAKey(filename=PRIVATE_KEY_PATH)
+        return self._private_key
+
+    def _connect(self):
+        """
+        Opens a new transport and SFTP session, honoring the reconnect backoff.
+        """
+        now = time.monotonic()
+        if now < self._next_attempt:
+            raise ConnectionError(
+                f"Reconnect to {self.server_ip}:{self.server_port} deferred for "
+                f"{self._next_attempt - now:.0f}s after {self._failures} failed attempt(s)"
+            )
+        transport = None
+        try:
+            private_key = self._load_private_key()
+            # Connect with a timeout, so an unreachable server fails over quickly.
+            sock = socket.create_connection((self.server_ip, self.server_port), timeout=CONNECT_TIMEOUT)
+            transport = paramiko.Transport(sock)
+            transport.connect(username=SFTP_USERNAME, pkey=private_key)
+            transport.set_keepalive(self.keepalive_interval)
+            sftp = paramiko.SFTPClient.from_transport(transport)
+        except Exception:
+            if transport is not None:
+                transport.close()
+            self._failures += 1
+            backoff = min(self.initial_backoff * 2 ** (self._failures - 1), self.max_backoff)
+            self._next_attempt = time.monotonic() + backoff
+            raise
+        self._transport = transport
+        self._sftp = sftp
+        self._failures = 0
+        self._next_attempt = 0.0
+        logger.info("Established SFTP connection to %s:%s", self.server_ip, self.server_port)
+        return sftp
+
+    def _is_connected(self):
+        return self._sftp is not None and self._transport is not None and self._transport.is_active()
+
+    def get_sftp(self):
+        """
+        Returns a live SFTP client, reconnecting if the previous session was lost.
+        """
+        with self._lock:
+            if not self._is_connected():
+                self.invalidate()
+                self._connect()
+            return self._sftp
+
+    def run(self, operation):
+        """
+        Runs operation(sftp) on the shared session.
+        If it fails because the connection dropped, reconnects and retries once.
+        """
+        with self._lock:
+            sftp = self.get_sftp()
+            try:
+                return operation(sftp)
+            except (paramiko.SSHException, EOFError, OSError):
+                if self._is_connected():
+                    # The connection is fine; the operation itself failed.
+                    raise
+                logger.warning("SFTP connection lost, reconnecting and retrying")
+                self.invalidate()
+                return operation(self.get_sftp())
+
+    def ensure_dir(self, remote_dir):
+        """
+        Creates the remote directory if it does not exist.
+        Directories that are known to exist are not checked again.
+        """
+        with self._lock:
+            if remote_dir in self._known_dirs:
+                return
+
+            def _ensure(sftp):
+                try:
+                    sftp.stat(remote_dir)
+                    logger.debug("Remote directory already exists: %s", remote_dir)
+                except FileNotFoundError:
+                    sftp.mkdir(remote_dir)
+                    logger.info("Created remote directory: %s", remote_dir)
+
+            self.run(_ensure)
+            self._known_dirs.add(remote_dir)
+
+    def invalidate(self):
+        """
+        Closes the current session (if any) and forgets the cached directory state.
+        """
+        with self._lock:
+            for closable in (self._sftp, self._transport):
+                if closable is not None:
+                    try:
+                        closable.close()
+                    except Exception:
+                        pass
+            self._sftp = None
+            self._transport = None
+            self._known_dirs.clear()
+
+    def close(self):
+        self.invalidate()
+
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def get_connection(server_ip, server_port=PORT):
+    """
+    Returns the shared connection manager for the given server.
+    """
+    with _connections_lock:
+        key = (server_ip, server_port)
+        if key not in _connections:
+            _connections[key] = SFTPConnectionManager(server_ip, server_port)
+        return _connections[key]
+
+
+def close_connections():
+    """
+    Closes all shared SFTP connections.
+    """
+    with _connections_lock:
+        for connection in _connections.values():
+            connection.close()
+        _connections.clear()
+
 
 def get_or_create_uuid(server_ip, server_port=PORT):
     """
     Retrieve or generate a unique user UUID for SFTP uploads.
-    Reuses a locally stored UUID if available; otherwise connects to the remote host
+    Reuses a locally stored UUID if available; otherwise uses the shared SFTP connection
     to avoid collisions, saves it locally, and returns the UUID string.
     """
     # If a UUID has already been stored locally, reuse it
     if os.path.exists(UUID_FILE):
-        return open(UUID_FILE, "r").read().strip()
+        with open(UUID_FILE, "r") as f:
+            return f.read().strip()
 
-    # Load SSH key and establish SFTP connection to check existing remote directories
-    try:
-        private_key = paramiko.RSAKey(filename=PRIVATE_KEY_PATH)
-        transport = paramiko.Transport((server_ip, server_port))
-        transport.connect(username=SFTP_USERNAME, pkey=private_key)
-        sftp = paramiko.SFTPClient.from_transport(transport)
-    except Exception as e:
-        logger.exception("Failed to connect via SFTP for UUID generation: %s", e)
-        raise
+    connection = get_connection(server_ip, server_port)
+    user = getpass.getuser()
 
-    try:
-        user = getpass.getuser()
+    def _pick_candidate(sftp):
         # Attempt to generate a UUID4 that doesn't collide with existing remote dirs
         while True:
             candidate = str(uuid.uuid4())
@@ -114,134 +464,250 @@ def get_or_create_uuid(server_ip, server_port=PORT):
                 sftp.stat(remote_dir)
                 logger.warning("Collision detected for UUID %s, regenerating", candidate)
             except FileNotFoundError:
-                # No collision, break out
-                break
+                # No collision
+                return candidate
 
-        # Persist the chosen UUID locally for future runs
-        with open(UUID_FILE, "w") as f:
-            f.write(candidate)
-        logger.info("Generated and stored user UUID: %s", candidate)
-        return candidate
+    try:
+        candidate = connection.run(_pick_candidate)
+    except Exception as e:
+        logger.exception("Failed to connect via SFTP for UUID generation: %s", e)
+        raise
 
-    finally:
-        sftp.close()
-        transport.close()
+    # Persist the chosen UUID locally for future runs
+    with open(UUID_FILE, "w") as f:
+        f.write(candidate)
+    logger.info("Generated and stored user UUID: %s", candidate)
+    return candidate
 
 
-def init_sftp(user, server_ip, server_port=PORT):
+def with_failover(endpoints, operation):
     """
-    One-time SFTP initialization at startup:
-      1) Ensures UUID exists (or is generated).
-      2) Creates the remote user directory on the server if missing.
+    Runs operation(server_ip, server_port) on the first endpoint of the pool that succeeds,
+    recording each endpoint's failure or success. Raises the last error if all fail.
     """
-    uuid_str = get_or_create_uuid(server_ip, server_port)
-    remote_dir = f"{REMOTE_BASE_DIR}/{user}_{uuid_str}"
+    error = ConnectionError("No logsink endpoint is available")
+    for endpoint in endpoints.candidates():
+        try:
+            result = operation(*endpoint)
+        except Exception as e:
+            logger.warning("Logsink endpoint %s failed: %s", endpoint_name(endpoint), e)
+            endpoints.record_failure(endpoint, e)
+            error = e
+            continue
+        endpoints.record_success(endpoint)
+        return result
+    raise error
 
-    try:
-        private_key = paramiko.RSAKey(filename=PRIVATE_KEY_PATH)
-        transport = paramiko.Transport((server_ip, server_port))
-        transport.connect(username=SFTP_USERNAME, pkey=private_key)
-        sftp = paramiko.SFTPClient.from_transport(transport)
 
-        try:
-            sftp.stat(remote_dir)
-            logger.debug("Remote user directory already exists: %s", remote_dir)
-        except FileNotFoundError:
-            sftp.mkdir(remote_dir)
-            logger.info("Created remote user directory: %s", remote_dir)
+def init_sftp(user, endpoints):
+    """
+    One-time SFTP initialization at startup:
+      1) Ensures UUID exists (or is generated), via the first reachable endpoint.
+      2) Orders the endpoints by preference for this agent's UUID (see upload_endpoints).
+      3) Creates the remote user directory on the preferred reachable endpoint if missing.
+    Both steps share the same SFTP connection that later uploads reuse.
+    Other endpoints get the directory on their first upload.
+    """
+    try:
+        uuid_str = with_failover(endpoints, get_or_create_uuid)
+        endpoints.set_key(uuid_str)
+        remote_dir = f"{REMOTE_BASE_DIR}/{user}_{uuid_str}"
+        with_failover(endpoints, lambda server_ip, server_port: get_connection(server_ip, server_port).ensure_dir(remote_dir))
     except Exception as e:
         logger.error("Error during SFTP init: %s", e)
         raise
-    finally:
-        try:
-            sftp.close()
-            transport.close()
-        except:
-            pass
 
 
-def upload_data(data, remote_file_path, server_ip, server_port):
+def upload_log_range(local_path, start, end, remote_file_path, server_ip, server_port,
+                     compression="none", expected_inode=None):
     """
-    Upload the provided data to the remote server via SFTP.
-    The data is first written to a temporary file. If any step fails, the temporary file is removed.
+    Stream bytes [start, end) of the local log file to the remote server via SFTP.
+    If expected_inode is given, the upload fails when local_path no longer refers to
+    that file (it was rotated in the meantime).
+    The file is read in bounded chunks and written straight to the remote file handle
+    with pipelined writes, optionally compressed on the fly, so memory stays flat no
+    matter how large the backlog is. The data is written under a temporary name and
+    renamed once complete, so the server never sees a partial file; a failed upload
+    removes the temporary file again, and a retry replaces a file left by an earlier
+    attempt of the same chunk.
+    Returns True on success, False if the upload failed; raises LogRotatedError if
+    local_path was rotated, which is not the server's fault.
     """
-    if not data:
+    if end <= start:
         logger.info("No new log entries to upload.")
-        return
-    try:
-        with tempfile.NamedTemporaryFile("w", encoding="utf-8", delete=False, dir=LOG_DIR, suffix=".log") as tmp_file:
-            tmp_file.write(data)
-            tmp_file_path = tmp_file.name
-        logger.debug("Temporary file created at %s", tmp_file_path)
-    except Exception as e:
-        logger.error("Failed to create temporary file: %s", e)
-        return
+        return False
 
-    if not os.path.exists(PRIVATE_KEY_PATH):
-        logger.error("Private key does not exist at %s", PRIVATE_KEY_PATH)
-        os.remove(tmp_file_path)
-        return
-    try:
-        private_key = paramiko.RSAKey(filename=PRIVATE_KEY_PATH)
-    except Exception as e:
-        logger.exception("Failed to load the private key: %s", e)
-        os.remove(tmp_file_path)
-        return
+    partial_path = remote_file_path + ".part"
 
-    try:
-        transport = paramiko.Transport((server_ip, server_port))
-        transport.connect(username=SFTP_USERNAME, pkey=private_key)
-        sftp = paramiko.SFTPClient.from_transport(transport)
-    except Exception as e:
-        logger.exception("Failed to establish SFTP connection: %s", e)
-        os.remove(tmp_file_path)
-        return
-
-    user_dir = os.path.dirname(remote_file_path)
-    try:
-        sftp.stat(user_dir)
-    except FileNotFoundError:
+    def _stream(sftp):
+        with open(local_path, "rb") as local_file:
+            if expected_inode is not None and os.fstat(local_file.fileno()).st_ino != expected_inode:
+                raise LogRotatedError(f"{local_path} was rotated before it could be uploaded")
+            try:
+                _copy_range(sftp, local_file)
+            except Exception:
+                _remove_partial(sftp)
+                raise
+        # posix_rename replaces the chunk if an earlier attempt got as far as renaming it.
+        sftp.posix_rename(partial_path, remote_file_path)
+
+    def _remove_partial(sftp):
         try:
-            sftp.mkdir(user_dir)
-            logger.info("Created remote user directory: %s", user_dir)
+            sftp.remove(partial_path)
         except Exception as e:
-            logger.error("Failed to create remote directory %s: %s", user_dir, e)
-            sftp.close()
-            transport.close()
-            os.remove(tmp_file_path)
-            return
-
+            # The connection is likely gone; the next attempt reuses and truncates the name.
+            logger.debug("Could not remove partial upload %s: %s", partial_path, e)
+
+    def _copy_range(sftp, local_file):
+        with sftp.open(partial_path, "wb") as remote_file:
+            remote_file.set_pipelined(True)
+            compressor = open_compressor(remote_file, compression)
+            writer = compressor or remote_file
+            local_file.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = local_file.read(min(READ_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                writer.write(chunk)
+                remaining -= len(chunk)
+            if compressor is not None:
+                compressor.close()
+
+    connection = get_connection(server_ip, server_port)
     try:
-        sftp.put(tmp_file_path, remote_file_path)
-        logger.info("Uploaded logs to %s", remote_file_path)
+        with UPLOAD_CHUNK_SECONDS.time():
+            connection.ensure_dir(os.path.dirname(remote_file_path))
+            connection.run(_stream)
+        logger.info("Uploaded %d bytes of logs to %s", end - start, remote_file_path)
+        UPLOADED_BYTES.inc(end - start)
+        UPLOADED_CHUNKS.inc()
+        return True
+    except LogRotatedError:
+        raise
     except Exception as e:
         logger.error("Failed to upload file: %s", e)
-    finally:
-        sftp.close()
-        transport.close()
-        os.remove(tmp_file_path)
+        UPLOAD_FAILURES.inc()
+        return False
+
+
+def pending_upload_bytes(checkpoint):
+    """
+    Returns how many bytes of the shared log file and its rotated backups lie beyond
+    the checkpoint, i.e. how far the upload lags behind the writer.
+    """
+    files = list_log_files()
+    inodes = [inode for _, inode, _ in files]
+    if checkpoint.get("inode") not in inodes:
+        return sum(size for _, _, size in files)
+    first = inodes.index(checkpoint["inode"])
+    pending = max(0, files[first][2] - checkpoint.get("offset", 0))
+    return pending + sum(size for _, _, size in files[first + 1:])
 
 
-def upload_files(server_ip, server_port=PORT):
+def upload_files(endpoints):
     """
     Main function for the upload task.
-    Gathers new log entries, constructs a unique remote file name based on the current timestamp,
-    uploads the log entries, and then saves the new file offset.
+    Plans chunks of new log entries from the checkpoint onwards (draining rotated files
+    first), streams each chunk to a remote file named after its timestamp and sequence
+    number, and saves the checkpoint after every successful chunk.
+    Several chunks may be shipped per call, so a backlog is caught up quickly.
+    A chunk re-sent after a crash or a failed upload keeps its name (see chunk_name_parts),
+    so the server ends up with one file per sequence number.
+    Each chunk goes to the preferred endpoint of the pool (upload_endpoints.EndpointPool)
+    and fails over to the next one; the position is shared by all endpoints, so switching
+    neither skips nor re-sends entries.
     """
-    logger.info("Running upload job for server: %s", server_ip)
-    data, new_offset = get_new_log_entries()
+    logger.info("Running upload job for server: %s", endpoint_name(endpoints.preferred))
+    with UPLOAD_CYCLE_SECONDS.time():
+        checkpoint = _upload_chunks(endpoints)
+    backlog = pending_upload_bytes(checkpoint)
+    UPLOAD_BACKLOG_BYTES.set(backlog)
+    if backlog == 0:
+        UPLOAD_LAST_SUCCESS.set(time.time())
 
-    if data:
-        user = getpass.getuser()
-        uuid_str = get_or_create_uuid(server_ip, server_port)
-        remote_user_dir = f"{REMOTE_BASE_DIR}/{user}_{uuid_str}"
 
-        timestamp = time.strftime("%Y-%m-%dT%H:%M:%S")
+def chunk_name_parts(checkpoint, inode, start):
+    """
+    Returns the (sequence, timestamp) that name the chunk of the given log file starting
+    at start. A chunk that was attempted but not confirmed is recorded in the checkpoint
+    ("pending"); when it is retried it keeps that name instead of taking a new timestamp.
+    """
+    sequence = checkpoint.get("sequence", 0) + 1
+    pending = checkpoint.get("pending")
+    if pending and (pending.get("inode"), pending.get("start"), pending.get("sequence")) == (inode, start, sequence):
+        return sequence, pending["timestamp"]
+    return sequence, time.strftime("%Y-%m-%dT%H:%M:%S")
 
-        remote_file = f"{user}_{timestamp}_threats.log"
-        remote_file_path = f"{remote_user_dir}/{remote_file}"
 
-        upload_data(data, remote_file_path, server_ip, server_port)
-        save_last_offset(new_offset)
-    else:
+def _upload_chunk(endpoints, path, inode, start, end, remote_file, compression):
+    """
+    Uploads one chunk to the first endpoint that accepts it. Returns that endpoint,
+    or None if no endpoint did (the chunk is retried next cycle).
+    Raises LogRotatedError if the local file was rotated away.
+    """
+    candidates = endpoints.candidates()
+    if not candidates:
+        logger.warning("All logsink endpoints are unavailable, keeping the backlog for later: %s",
+                       ", ".join(f"{status['endpoint']} {status['state']}" for status in endpoints.status()))
+    user = getpass.getuser()
+    for server_ip, server_port in candidates:
+        try:
+            uuid_str = get_or_create_uuid(server_ip, server_port)
+        except Exception as e:
+            endpoints.record_failure((server_ip, server_port), e)
+            continue
+        remote_file_path = f"{REMOTE_BASE_DIR}/{user}_{uuid_str}/{remote_file}"
+        if upload_log_range(path, start, end, remote_file_path, server_ip, server_port,
+                            compression, expected_inode=inode):
+            endpoints.record_success((server_ip, server_port))
+            if (server_ip, server_port) != endpoints.preferred:
+                ENDPOINT_FAILOVERS.inc()
+            return server_ip, server_port
+        endpoints.record_failure((server_ip, server_port))
+    return None
+
+
+def _upload_chunks(endpoints):
+    """
+    Ships the planned chunks of one upload cycle and returns the resulting checkpoint.
+    """
+    config = load_config()
+    checkpoint = load_checkpoint()
+    chunks = plan_upload_chunks(
+        checkpoint,
+        int(config.get("upload_chunk_bytes", DEFAULT_CHUNK_BYTES)),
+        int(config.get("upload_max_chunks", DEFAULT_MAX_CHUNKS))
+    )
+    if not any(end > start for _, _, start, end in chunks):
         logger.debug("No new entries to upload at this time.")
+
+    user = getpass.getuser()
+    compression = get_upload_compression()
+    for path, inode, start, end in chunks:
+        if end > start:
+            sequence, timestamp = chunk_name_parts(checkpoint, inode, start)
+            pending = {"inode": inode, "start": start, "sequence": sequence, "timestamp": timestamp}
+            if checkpoint.get("pending") != pending:
+                # Record the name before the upload, so a retry after a crash reuses it.
+                checkpoint = dict(checkpoint, pending=pending)
+                save_checkpoint(checkpoint)
+
+            # Sequence numbers are shared by all endpoints, so a chunk keeps its number
+            # (and content) whichever endpoint it ends up on.
+            remote_file = f"{user}_{timestamp}_{sequence:010d}_threats.log{COMPRESSION_SUFFIXES[compression]}"
+
+            # Only advance the checkpoint once the data has reached a server.
+            try:
+                endpoint = _upload_chunk(endpoints, path, inode, start, end, remote_file, compression)
+            except LogRotatedError as e:
+                logger.error("Failed to upload file: %s", e)
+                UPLOAD_FAILURES.inc()
+                break
+            if endpoint is None:
+                break
+            checkpoint = {"inode": inode, "offset": end, "sequence": sequence}
+        else:
+            checkpoint = {"inode": inode, "offset": end, "sequence": checkpoint.get("sequence", 0)}
+        save_checkpoint(checkpoint)
+    return checkpoint
@@ -0,0 +1,163 @@
+import time
+import hashlib
+import logging
+import threading
+
+from metrics import counter, gauge
+
+# Configure basic logging to output messages with level INFO or higher.
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Consecutive failures after which an endpoint's circuit opens, and how long (seconds)
+# it then stays open before one trial upload; the time doubles every time the trial fails.
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_COOLDOWN = 30.0
+DEFAULT_MAX_COOLDOWN = 600.0
+
+ENDPOINTS_AVAILABLE = gauge("upload_endpoints_available", "Logsink endpoints whose circuit is closed")
+ENDPOINT_FAILOVERS = counter("upload_failovers_total", "Chunks shipped to another endpoint than the preferred one")
+CIRCUITS_OPENED = counter("upload_circuits_opened_total", "Times a logsink endpoint was taken out of rotation")
+
+
+def endpoint_name(endpoint):
+    """
+    Returns the "ip:port" name of an (ip, port) endpoint, bracketing IPv6 addresses.
+    """
+    ip, port = endpoint
+    return f"[{ip}]:{port}" if ":" in ip else f"{ip}:{port}"
+
+
+def rendezvous_rank(endpoints, key):
+    """
+    Orders the endpoints by preference for key (highest random weight hashing).
+    Every agent gets its own, stable order, so agents spread evenly over the endpoints;
+    adding or removing an endpoint only moves the agents that prefer it.
+    """
+    def weight(endpoint):
+        return hashlib.sha256(f"{key}\0{endpoint_name(endpoint)}".encode("utf-8")).digest()
+    return sorted(endpoints, key=weight, reverse=True)
+
+
+class EndpointHealth:
+    """
+    Circuit breaker state of one endpoint. The circuit opens after failure_threshold
+    consecutive failures; once the cooldown has passed one trial request is let through
+    (half-open), which closes the circuit on success and reopens it for twice the
+    cooldown (up to max_cooldown) on failure.
+    """
+
+    def __init__(self):
+        self.failures = 0
+        self.open_until = None
+        self.cooldown = None
+        self.last_error = None
+
+    def allows(self, now):
+        return self.open_until is None or now >= self.open_until
+
+    @property
+    def state(self):
+        if self.open_until is None:
+            return "closed"
+        return "half-open" if time.monotonic() >= self.open_until else "open"
+
+
+class EndpointPool:
+    """
+    The logsink endpoints of this agent, in its preference order, with their health.
+    Uploads go to the first endpoint whose circuit allows a request, so an agent returns
+    to its preferred endpoint as soon as that one recovers.
+    """
+
+    def __init__(self, endpoints, key=None, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 cooldown=DEFAULT_COOLDOWN, max_cooldown=DEFAULT_MAX_COOLDOWN):
+        if not endpoints:
+            raise ValueError("At least one logsink endpoint is required")
+        self.endpoints = list(endpoints)
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown = cooldown
+        self.max_cooldown = max(cooldown, max_cooldown)
+        self._health = {endpoint: EndpointHealth() for endpoint in self.endpoints}
+        self._lock = threading.Lock()
+        # Without a key (the agent UUID is not known yet) the configured order is used.
+        self.ordered = list(self.endpoints)
+        if key is not None:
+            self.set_key(key)
+        ENDPOINTS_AVAILABLE.set_function(self.available_count)
+
+    def set_key(self, key):
+        """
+        Orders the endpoints by preference for the agent key (its UUID).
+        """
+        self.ordered = rendezvous_rank(self.endpoints, key)
+        if len(self.ordered) > 1:
+            logger.info("Preferred logsink endpoint: %s (fallbacks: %s)", endpoint_name(self.ordered[0]),
+                        ", ".join(endpoint_name(endpoint) for endpoint in self.ordered[1:]))
+
+    @property
+    def preferred(self):
+        return self.ordered[0]
+
+    def candidates(self):
+        """
+        Returns the endpoints to try, in preference order, skipping those whose circuit is open.
+        """
+        now = time.monotonic()
+        with self._lock:
+            return [endpoint for endpoint in self.ordered if self._health[endpoint].allows(now)]
+
+    def available_count(self):
+        with self._lock:
+            return sum(1 for health in self._health.values() if health.open_until is None)
+
+    def record_success(self, endpoint):
+        with self._lock:
+            health = self._health[endpoint]
+            if health.open_until is not None:
+                logger.info("Logsink endpoint %s recovered", endpoint_name(endpoint))
+            health.failures = 0
+            health.open_until = None
+            health.cooldown = None
+            health.last_error = None
+
+    def record_failure(self, endpoint, error=None):
+        with self._lock:
+            health = self._health[endpoint]
+            health.failures += 1
+            health.last_error = str(error) if error is not None else None
+            if health.open_until is not None:
+                # The half-open trial failed.
+                health.cooldown = min(health.cooldown * 2, self.max_cooldown)
+            elif health.failures >= self.failure_threshold:
+                health.cooldown = self.cooldown
+                CIRCUITS_OPENED.inc()
+            else:
+                return
+            health.open_until = time.monotonic() + health.cooldown
+        logger.warning("Logsink endpoint %s is unavailable, retrying it in %.0f s%s",
+                       endpoint_name(endpoint), health.cooldown, f": {error}" if error is not None else "")
+
+    def status(self):
+        """
+        Returns the health of every endpoint, in preference order.
+        """
+        with self._lock:
+            return [
+                {"endpoint": endpoint_name(endpoint), "state": self._health[endpoint].state,
+                 "failures": self._health[endpoint].failures, "last_error": self._health[endpoint].last_error}
+                for endpoint in self.ordered
+            ]
+
+
+def create_endpoint_pool(endpoints, config, key=None):
+    """
+    Creates the endpoint pool from server_config.json settings: "upload_failure_threshold",
+    "upload_circuit_cooldown" and "upload_circuit_max_cooldown" (seconds).
+    """
+    return EndpointPool(
+        endpoints, key,
+        int(config.get("upload_failure_threshold", DEFAULT_FAILURE_THRESHOLD)),
+        float(config.get("upload_circuit_cooldown", DEFAULT_COOLDOWN)),
+        float(config.get("upload_circuit_max_cooldown", DEFAULT_MAX_COOLDOWN)),
+    )
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The agent's modules import each other without a package prefix.
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "monitoring"))
+sys.path.insert(0, os.path.join(ROOT_DIR, "collector"))
@@ -0,0 +1,48 @@
+import pytest
+
+from aho_corasick import Automaton
+
+
+def found(automaton, text):
+    hits = automaton.search(text)
+    return sorted(needle for needle, needle_id in automaton.needle_ids.items() if hits >> needle_id & 1)
+
+
+def build(*needles):
+    automaton = Automaton()
+    for needle in needles:
+        automaton.add(needle)
+    return automaton.build()
+
+
+def test_finds_overlapping_needles_through_failure_links():
+    automaton = build("he", "she", "his", "hers")
+    assert found(automaton, "ushers") == ["he", "hers", "she"]
+    assert found(automaton, "ahishers") == ["he", "hers", "his", "she"]
+    assert found(automaton, "xyz") == []
+
+
+def test_needle_inside_a_longer_one():
+    automaton = build("invoke-expression", "expression", "ex")
+    assert found(automaton, "Invoke-Expression".lower()) == ["ex", "expression", "invoke-expression"]
+    assert found(automaton, "invoke-expr") == ["ex"]
+
+
+def test_duplicate_needles_share_an_id():
+    automaton = Automaton()
+    assert automaton.add("iex") == 0
+    assert automaton.add("-enc") == 1
+    assert automaton.add("iex") == 0
+    assert len(automaton) == 2
+
+
+def test_needles_cannot_be_added_after_build():
+    automaton = build("iex")
+    assert automaton.add("iex") == 0
+    with pytest.raises(RuntimeError):
+        automaton.add("-enc")
+
+
+def test_empty_automaton_and_empty_needle():
+    assert Automaton().build().search("anything") == 0
+    assert found(build("", "x"), "abc") == [""]
@@ -0,0 +1,73 @@
+import gzip
+import json
+
+import pytest
+
+from collector import Collector
+
+AGENT = "alice_0f8b2c1e"
+
+
+def entry(number):
+    return {"timestamp": f"2026-01-01T00:00:{number:02d}", "user": "alice", "pid": number,
+            "cmdline": f"powershell -c step{number}", "rule": {"id": "r1", "title": "Rule", "level": "high"}}
+
+
+def write_chunk(root, name, entries, compress=False):
+    data = "".join(json.dumps(item) + "\n" for item in entries).encode("utf-8")
+    path = root / AGENT / name
+    path.parent.mkdir(exist_ok=True)
+    if compress:
+        with gzip.open(path, "wb") as f:
+            f.write(data)
+    else:
+        path.write_bytes(data)
+    return f"{AGENT}/{name}"
+
+
+@pytest.fixture
+def root(tmp_path):
+    root = tmp_path / "uploads"
+    root.mkdir()
+    return root
+
+
+@pytest.fixture
+def collector(root, tmp_path):
+    collector = Collector(str(root), str(tmp_path / "index.db"))
+    yield collector
+    collector.close()
+
+
+def test_same_file_ingested_twice(root, collector):
+    path = write_chunk(root, "alice_2026-01-01T00:00:00_0000000001_threats.log", [entry(1), entry(2)])
+    assert collector.ingest_file(AGENT, path, 1) == 2
+    assert collector.ingest_file(AGENT, path, 1) == 0
+    assert collector.duplicates == 1
+    assert len(collector.query()) == 2
+
+
+def test_resent_chunk_under_another_name_is_skipped(root, collector):
+    write_chunk(root, "alice_2026-01-01T00:00:00_0000000001_threats.log", [entry(1), entry(2)])
+    write_chunk(root, "alice_2026-01-01T00:05:00_0000000001_threats.log", [entry(1), entry(2)])
+    assert collector.scan() == 2
+    assert collector.duplicates == 1
+    assert len(collector.query()) == 2
+
+
+def test_changed_resend_only_adds_new_entries(root, collector):
+    first = write_chunk(root, "alice_2026-01-01T00:00:00_0000000001_threats.log", [entry(1), entry(2)])
+    second = write_chunk(root, "alice_2026-01-01T00:05:00_0000000001_threats.log.gz",
+                         [entry(1), entry(2), entry(3)], compress=True)
+    assert collector.ingest_file(AGENT, first, 1) == 2
+    assert collector.ingest_file(AGENT, second, 1) == 1
+    assert collector.duplicates == 0
+    assert sorted(hit["pid"] for hit in collector.query()) == [1, 2, 3]
+
+
+def test_files_without_sequence_dedupe_by_entry(root, collector):
+    write_chunk(root, "alice_2026-01-01T00:00:00_threats.log", [entry(1)])
+    write_chunk(root, "alice_2026-01-01T00:05:00_threats.log", [entry(1), entry(2)])
+    assert collector.scan() == 2
+    assert collector.duplicates == 0
+
@@ -0,0 +1,100 @@
+import pytest
+
+import dedupe_store
+from dedupe_store import DedupeStore, dedupe_key
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(dedupe_store.time, "time", clock.time)
+    return clock
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    return str(tmp_path / "dedupe.db")
+
+
+def alert(rule_id="r1", user="alice", cmdline="powershell -enc AAAA"):
+    return {"rule": {"id": rule_id}, "user": user, "cmdline": cmdline}
+
+
+def test_key_ignores_case_and_whitespace_of_the_command_line():
+    assert dedupe_key(alert(cmdline="PowerShell  -Enc\tAAAA")) == dedupe_key(alert(cmdline="powershell -enc aaaa"))
+    assert dedupe_key(alert(user="bob")) != dedupe_key(alert())
+    assert dedupe_key(alert(rule_id="r2")) != dedupe_key(alert())
+    assert dedupe_key(alert(), key_fields=("rule.id",)) == dedupe_key(alert(user="bob"), key_fields=("rule.id",))
+
+
+def test_key_tolerates_missing_fields():
+    assert dedupe_key({"rule": "not a dict"}) == dedupe_key({})
+
+
+def test_duplicates_are_suppressed_until_the_window_expires(clock, db_file):
+    store = DedupeStore(db_file, window=60)
+    assert not store.check(alert())
+    clock.now += 59
+    assert store.check(alert())
+    # The window starts at the sent alert, not at the last suppressed one.
+    clock.now += 1
+    assert not store.check(alert())
+    assert store.stats() == {"hits": 1, "misses": 2, "expired": 1, "evicted": 0, "entries": 1}
+    store.close()
+
+
+def test_least_recently_used_keys_are_evicted(clock, db_file):
+    store = DedupeStore(db_file, max_entries=2)
+    store.check(alert("r1"))
+    store.check(alert("r2"))
+    assert store.check(alert("r1"))
+    store.check(alert("r3"))
+    assert store.stats()["evicted"] == 1
+    assert store.check(alert("r1"))
+    assert not store.check(alert("r2"))
+    store.close()
+
+
+def test_unexpired_keys_survive_a_restart(clock, db_file):
+    store = DedupeStore(db_file, window=60)
+    store.check(alert("r1"))
+    clock.now += 30
+    store.check(alert("r2"))
+    store.close()
+
+    clock.now += 40
+    store = DedupeStore(db_file, window=60)
+    assert store.stats()["entries"] == 1
+    assert not store.check(alert("r1"))
+    assert store.check(alert("r2"))
+    store.close()
+
+
+def test_restart_loads_at_most_max_entries_most_recent_keys(clock, db_file):
+    store = DedupeStore(db_file)
+    for number in range(5):
+        clock.now += 1
+        store.check(alert(f"r{number}"))
+    store.close()
+
+    store = DedupeStore(db_file, max_entries=2)
+    assert store.check(alert("r4"))
+    assert store.check(alert("r3"))
+    assert not store.check(alert("r2"))
+    store.close()
+
+
+def test_unusable_database_falls_back_to_memory(clock, tmp_path):
+    store = DedupeStore(str(tmp_path / "missing" / "dedupe.db"))
+    assert store._db is None
+    assert not store.check(alert())
+    assert store.check(alert())
+    store.close()
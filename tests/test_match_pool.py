@@ -0,0 +1,102 @@
+import pytest
+
+import match_pool
+import process_events
+from match_pool import MatcherPool, create_matcher_pool
+from process_events import ProcessSnapshot
+from process_monitor import check_rule_conditions
+from rules_loader import compile_rules
+
+RULES = [
+    {
+        "title": title,
+        "logsource": {"product": "windows", "category": "ps_script"},
+        "detection": {"selection": {"ScriptBlockText|contains": needle}, "condition": "selection"},
+    }
+    for title, needle in [("Download cradle", "DownloadString"), ("Invoke-Expression", "IEX ")]
+]
+CMDLINES = [
+    "powershell -c IEX (New-Object Net.WebClient).DownloadString('x')",
+    "powershell -c Get-Service",
+    "powershell -c IEX $x",
+    "pwsh -c $w.DownloadString('y')",
+]
+
+
+def batch():
+    return [ProcessSnapshot({"cmdline": cmdline.split(), "pid": pid, "name": "pwsh"})
+            for pid, cmdline in enumerate(CMDLINES * 3)]
+
+
+def titles(results):
+    return [sorted(rule["title"] for rule in rules) for rules in results]
+
+
+@pytest.fixture(scope="module")
+def pool():
+    pool = MatcherPool(compile_rules(RULES), check_rule_conditions, workers=2, min_batch=4)
+    yield pool
+    pool.close()
+
+
+def test_pool_matches_like_the_calling_thread_in_batch_order(pool):
+    inline = [check_rule_conditions(pool.ruleset, proc) for proc in batch()]
+    results = pool.match(batch())
+    assert titles(results) == titles(inline)
+    # Workers report rule positions; the results are the rule dicts of the parent.
+    assert all(rule in pool.ruleset.rules for rules in results for rule in rules)
+
+
+def test_small_batches_and_a_broken_pool_match_inline(pool, monkeypatch):
+    def broken(*args):
+        raise RuntimeError("pool failed")
+    monkeypatch.setattr(pool._pool, "map", broken)
+    assert titles(pool.match(batch()[:2])) == [["Download cradle", "Invoke-Expression"], []]
+    assert titles(pool.match(batch())) == titles([check_rule_conditions(pool.ruleset, proc) for proc in batch()])
+
+
+def test_update_restarts_the_workers_only_for_a_new_rule_set(pool):
+    workers = pool._pool
+    pool.update(pool.ruleset)
+    assert pool._pool is workers
+    pool.update(compile_rules(RULES[:1]))
+    assert pool._pool is not workers
+    assert titles(pool.match(batch()))[:3] == [["Download cradle"], [], []]
+
+
+@pytest.mark.parametrize("workers", [0, "0", None, "many", -1])
+def test_pool_is_disabled_by_default_and_for_invalid_settings(workers):
+    assert create_matcher_pool(compile_rules(RULES), check_rule_conditions, workers) is None
+
+
+def test_auto_uses_one_worker_per_cpu(monkeypatch):
+    created = {}
+
+    class Pool:
+        def __init__(self, ruleset, match_function, workers, min_batch):
+            created.update(workers=workers, min_batch=min_batch)
+    monkeypatch.setattr(match_pool, "MatcherPool", Pool)
+    monkeypatch.setattr(match_pool.os, "cpu_count", lambda: 3)
+    create_matcher_pool(compile_rules(RULES), check_rule_conditions, "auto", 8)
+    assert created == {"workers": 3, "min_batch": 8}
+
+
+def test_monitor_reads_the_minimum_batch_from_the_config_as_a_number(monkeypatch):
+    import threading
+
+    import process_monitor
+
+    created = {}
+
+    def create_pool(ruleset, match_function, workers, min_batch):
+        created["min_batch"] = min_batch
+    monkeypatch.setattr(process_monitor, "load_config",
+                        lambda: {"match_workers": "2", "match_pool_min_batch": "32"})
+    monkeypatch.setattr(process_monitor, "create_matcher_pool", create_pool)
+
+    class Stopped(process_events.ProcessEventSource):
+        def poll(self, stop_event):
+            stop_event.set()
+            return [], []
+    process_monitor.monitor_system(compile_rules(RULES), threading.Event(), source=Stopped())
+    assert created["min_batch"] == 32
@@ -0,0 +1,160 @@
+import pytest
+import requests
+
+import notification_generator
+from notification_generator import (
+    MAX_MESSAGE_LENGTH, NotificationDispatcher, RateLimiter, format_digest, format_message,
+)
+
+
+class Clock:
+    """
+    Replaces time.monotonic and time.sleep; sleeping advances the clock.
+    """
+
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(notification_generator.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(notification_generator.time, "sleep", clock.sleep)
+    return clock
+
+
+def alert(number, **fields):
+    logs = {"user": "alice", "process": "pwsh", "pid": number, "cmdline": f"iex step{number}",
+            "rule": {"title": f"Rule {number}", "id": f"r{number}"}}
+    logs.update(fields)
+    return logs, "high"
+
+
+def test_rate_limiter_spaces_sends_per_chat_and_globally(clock):
+    limiter = RateLimiter(per_key_interval=1.0, global_interval=0.25)
+    limiter.wait("a")
+    limiter.wait("b")
+    limiter.wait("a")
+    assert clock.sleeps == [0.25, 0.75]
+
+
+def test_rate_limiter_delay_pushes_back_one_chat(clock):
+    limiter = RateLimiter(per_key_interval=1.0, global_interval=0.0)
+    limiter.delay("a", 5)
+    limiter.wait("b")
+    assert clock.sleeps == []
+    limiter.wait("a")
+    assert clock.sleeps == [5]
+
+
+def test_messages_escape_html():
+    logs, severity = alert(1, cmdline="iex <script> & x",
+                           ancestry=[{"name": "winword.exe", "pid": 42}, {"name": "explorer.exe", "pid": 7}])
+    message = format_message(logs, severity)
+    assert "iex &lt;script&gt; &amp; x" in message
+    assert "<b>Parent:</b> winword.exe (PID 42) &lt;- explorer.exe (PID 7)" in message
+
+
+def test_digest_is_split_at_the_message_length_limit():
+    alerts = [alert(number, cmdline="x" * 500) for number in range(40)]
+    messages = format_digest(alerts)
+    assert len(messages) > 1
+    assert all(len(message) <= MAX_MESSAGE_LENGTH for message in messages)
+    assert sum(message.count("Rule ") for message in messages) == 40
+    # Long command lines are cut short in digests.
+    assert "x" * 201 not in messages[0]
+
+
+class Response:
+    def __init__(self, status_code, payload=None):
+        self.status_code = status_code
+        self.payload = payload or {}
+        self.text = str(self.payload)
+
+    def json(self):
+        return self.payload
+
+    def raise_for_status(self):
+        if self.status_code >= 500:
+            raise requests.HTTPError(f"{self.status_code} Server Error")
+
+
+class Session:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.posts = []
+
+    def post(self, url, data=None, timeout=None):
+        self.posts.append(data)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def close(self):
+        pass
+
+
+def dispatcher_with(*responses, **kwargs):
+    dispatcher = NotificationDispatcher("token", ["1"], api_url="http://localhost", **kwargs)
+    dispatcher._session = Session(*responses)
+    return dispatcher
+
+
+def test_send_honors_retry_after(clock):
+    dispatcher = dispatcher_with(Response(429, {"parameters": {"retry_after": 7}}), Response(200))
+    assert dispatcher._send("1", "hello")
+    assert len(dispatcher._session.posts) == 2
+    assert clock.sleeps[-1] >= 7
+
+
+def test_send_retries_errors_but_not_client_rejections(clock):
+    dispatcher = dispatcher_with(requests.ConnectionError("down"), Response(502), Response(200))
+    assert dispatcher._send("1", "hello")
+    assert len(dispatcher._session.posts) == 3
+
+    dispatcher = dispatcher_with(Response(400, {"description": "chat not found"}))
+    assert not dispatcher._send("1", "hello")
+    assert len(dispatcher._session.posts) == 1
+
+
+def test_send_gives_up_after_max_retries(clock):
+    retries = notification_generator.MAX_RETRIES
+    dispatcher = dispatcher_with(*[Response(500)] * retries)
+    assert not dispatcher._send("1", "hello")
+    assert len(dispatcher._session.posts) == retries
+
+
+def test_burst_is_sent_as_one_digest():
+    dispatcher = dispatcher_with(Response(200), digest_window=0.05)
+    for number in range(3):
+        dispatcher.enqueue(*alert(number))
+    dispatcher.start()
+    dispatcher.stop(timeout=5)
+    assert len(dispatcher._session.posts) == 1
+    assert "(3 alerts)" in dispatcher._session.posts[0]["text"]
+
+
+def test_full_queue_drops_alerts():
+    dispatcher = dispatcher_with(queue_size=2)
+    assert dispatcher.enqueue(*alert(1))
+    assert dispatcher.enqueue(*alert(2))
+    assert not dispatcher.enqueue(*alert(3))
+    assert dispatcher.dropped == 1
+
+
+def test_entries_gauge_survives_closing_the_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(notification_generator, "DEDUPE_DB_FILE", str(tmp_path / "dedupe.db"))
+    store = notification_generator.get_dedupe_store()
+    store.check({"rule": {"id": "r1"}, "user": "alice", "cmdline": "powershell -enc AAAA"})
+    notification_generator.close_dedupe_store()
+    assert notification_generator.DEDUPE_ENTRIES.value == 1
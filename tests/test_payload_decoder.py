@@ -0,0 +1,93 @@
+import base64
+import os
+
+import pytest
+
+import payload_decoder
+from payload_decoder import decode_encoded_command, decode_payload, parse_powershell_arguments, read_script
+
+
+def encode(script):
+    return base64.b64encode(script.encode("utf-16le")).decode()
+
+
+@pytest.mark.parametrize("cmdline, expected", [
+    ("powershell -enc AAAA", {"encoded": "AAAA"}),
+    ("powershell -E AAAA", {"encoded": "AAAA"}),
+    ("powershell -ec AAAA", {"encoded": "AAAA"}),
+    ("powershell /EncodedCommand AAAA", {"encoded": "AAAA"}),
+    ("powershell –enc AAAA", {"encoded": "AAAA"}),
+    ("powershell -NoP -ExecutionPolicy Bypass -w hidden -enc AAAA", {"encoded": "AAAA"}),
+    ("powershell -ep -enc -enc AAAA", {"encoded": "AAAA"}),
+    ("powershell -c Write-Host -enc AAAA", {"command": "Write-Host -enc AAAA"}),
+    ("powershell -Com iex $x", {"command": "iex $x"}),
+    ("pwsh -f script.ps1 -enc AAAA", {"file": "script.ps1"}),
+    ("pwsh -File", {}),
+    ("powershell -enc", {}),
+    ("powershell Get-Date -enc AAAA", {}),
+])
+def test_parse_powershell_arguments(cmdline, expected):
+    arguments = {"command": None, "encoded": None, "file": None}
+    arguments.update(expected)
+    assert parse_powershell_arguments(cmdline.split(" ")) == arguments
+
+
+@pytest.mark.parametrize("wrap", [lambda value: value, lambda value: value.rstrip("="),
+                                  lambda value: f"'{value}'", lambda value: f' "{value}" '])
+def test_decode_encoded_command_tolerates_quotes_and_missing_padding(wrap):
+    assert decode_encoded_command(wrap(encode("IEX $x"))) == "IEX $x"
+
+
+@pytest.mark.parametrize("value", ["not base64!", base64.b64encode(b"\x00\xd8").decode()])
+def test_decode_encoded_command_rejects_invalid_values(value):
+    with pytest.raises(ValueError):
+        decode_encoded_command(value)
+
+
+def test_read_script_decodes_byte_order_marks(tmp_path):
+    utf16 = tmp_path / "utf16.ps1"
+    utf16.write_bytes(b"\xff\xfe" + "IEX $x".encode("utf-16-le"))
+    utf8 = tmp_path / "utf8.ps1"
+    utf8.write_bytes(b"\xef\xbb\xbfIEX $y")
+    assert read_script(str(utf16)) == "IEX $x"
+    assert read_script(str(utf8)) == "IEX $y"
+
+
+def test_read_script_rereads_a_changed_file(tmp_path):
+    script = tmp_path / "script.ps1"
+    script.write_text("Get-Date")
+    assert read_script(str(script)) == "Get-Date"
+    script.write_text("IEX $ab")
+    stat = script.stat()
+    os.utime(script, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert read_script(str(script)) == "IEX $ab"
+
+
+def test_read_script_reads_only_the_start_of_large_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(payload_decoder, "MAX_SCRIPT_BYTES", 8)
+    script = tmp_path / "large.ps1"
+    script.write_text("Get-Date; IEX $x")
+    assert read_script(str(script)) == "Get-Date"
+
+
+def test_read_script_rejects_missing_files_and_directories(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        read_script(str(tmp_path / "missing.ps1"))
+    with pytest.raises(FileNotFoundError):
+        read_script(str(tmp_path))
+
+
+def test_decode_payload_joins_the_encoded_command_and_script(tmp_path):
+    script = tmp_path / "run.ps1"
+    script.write_text("Invoke-Mimikatz")
+    cmdline = ["powershell", "-enc", encode("IEX $x"), "-File", str(script)]
+    assert decode_payload(cmdline) == "IEX $x\nInvoke-Mimikatz"
+
+
+@pytest.mark.parametrize("cmdline", [
+    ["powershell", "-c", "Get-Date"],
+    ["powershell", "-enc", "not base64!"],
+    ["powershell", "-File", "/nonexistent/run.ps1"],
+])
+def test_decode_payload_without_a_readable_payload(cmdline):
+    assert decode_payload(cmdline) is None
@@ -0,0 +1,101 @@
+from process_ancestry import AncestryCache
+from process_events import ProcessSnapshot
+
+
+class Processes:
+    """
+    Stands in for the OS process table; counts the processes read.
+    """
+
+    def __init__(self, processes):
+        self.processes = dict(processes)
+        self.reads = []
+
+    def add(self, pid, ppid, name, create_time):
+        self.processes[pid] = {"ppid": ppid, "name": name, "exe": f"/usr/bin/{name}",
+                               "username": "alice", "create_time": create_time}
+
+    def read(self, pid):
+        self.reads.append(pid)
+        return self.processes.get(pid)
+
+
+def table():
+    processes = Processes({})
+    processes.add(1, 0, "init", 1.0)
+    processes.add(10, 1, "sshd", 10.0)
+    processes.add(20, 10, "bash", 20.0)
+    return processes
+
+
+def names(chain):
+    return [ancestor["name"] for ancestor in chain]
+
+
+def test_ancestors_are_read_once():
+    processes = table()
+    cache = AncestryCache(depth=2, reader=processes.read)
+    assert cache.ancestry({"ppid": 20, "create_time": 30.0}) == [
+        {"pid": 20, "name": "bash", "exe": "/usr/bin/bash", "user": "alice"},
+        {"pid": 10, "name": "sshd", "exe": "/usr/bin/sshd", "user": "alice"},
+    ]
+    assert names(cache.ancestry({"ppid": 20, "create_time": 31.0})) == ["bash", "sshd"]
+    assert processes.reads == [20, 10]
+
+
+def test_deeper_ancestry_of_a_cached_grandparent_is_resolved_on_demand():
+    processes = table()
+    cache = AncestryCache(depth=2, reader=processes.read)
+    cache.ancestry({"ppid": 20, "create_time": 30.0})
+    assert names(cache.ancestry({"ppid": 10, "create_time": 30.0})) == ["sshd", "init"]
+    assert processes.reads == [20, 10, 1]
+
+
+def test_reused_parent_pid_is_not_reported_as_the_parent():
+    processes = table()
+    cache = AncestryCache(depth=2, reader=processes.read)
+    cache.ancestry({"ppid": 20, "create_time": 30.0})
+    # bash exited and its PID went to a newer process, while an older child still runs.
+    cache.evict([20])
+    processes.add(20, 1, "cron", 50.0)
+    assert names(cache.ancestry({"ppid": 20, "create_time": 55.0})) == ["cron", "init"]
+    assert cache.ancestry({"ppid": 20, "create_time": 40.0}) == []
+
+
+def test_cached_node_newer_than_the_process_is_read_again():
+    processes = table()
+    cache = AncestryCache(depth=1, reader=processes.read)
+    processes.add(20, 1, "cron", 50.0)
+    cache.ancestry({"ppid": 20, "create_time": 55.0})
+    # The exit of the cached process was missed and the PID now belongs to a third one.
+    processes.add(20, 1, "bash", 5.0)
+    assert names(cache.ancestry({"ppid": 20, "create_time": 8.0})) == ["bash"]
+    assert processes.reads == [20, 20]
+
+
+def test_exited_ancestors_stay_linked_to_their_descendants():
+    processes = table()
+    cache = AncestryCache(depth=2, reader=processes.read)
+    cache.ancestry({"ppid": 20, "create_time": 30.0})
+    cache.evict([10])
+    del processes.processes[10]
+    assert names(cache.ancestry({"ppid": 20, "create_time": 31.0})) == ["bash", "sshd"]
+    assert cache.ancestry({"ppid": 10, "create_time": 31.0}) == []
+
+
+def test_cache_is_bounded():
+    processes = table()
+    cache = AncestryCache(depth=1, max_entries=2, reader=processes.read)
+    for ppid in (1, 10, 20):
+        cache.ancestry({"ppid": ppid, "create_time": 30.0})
+    assert len(cache) == 2
+    cache.ancestry({"ppid": 1, "create_time": 30.0})
+    assert processes.reads == [1, 10, 20, 1]
+
+
+def test_enrich_stores_the_ancestry_unless_disabled():
+    processes = table()
+    proc = ProcessSnapshot({"pid": 30, "ppid": 20, "create_time": 30.0})
+    assert names(AncestryCache(depth=1, reader=processes.read).enrich(proc).info["ancestry"]) == ["bash"]
+    proc = ProcessSnapshot({"pid": 30, "ppid": 20, "create_time": 30.0})
+    assert "ancestry" not in AncestryCache(depth=0, reader=processes.read).enrich(proc).info
@@ -0,0 +1,179 @@
+import errno
+import threading
+
+import pytest
+
+import process_events
+from process_events import (
+    CN_MSG, NLMSGHDR, PROC_EVENT_EXEC, PROC_EVENT_EXIT, PROC_EVENT_HEADER, PROC_EVENT_IDS,
+    NetlinkProcessSource, ProcessSnapshot,
+)
+
+
+def proc_event(what, pid, tgid=None):
+    """
+    Builds one netlink proc connector message as the kernel sends it.
+    """
+    event = PROC_EVENT_HEADER.pack(what, 0, 0) + PROC_EVENT_IDS.pack(pid, pid if tgid is None else tgid)
+    cn_msg = CN_MSG.pack(1, 1, 0, 0, len(event), 0) + event
+    return NLMSGHDR.pack(NLMSGHDR.size + len(cn_msg), 3, 0, 0, 0) + cn_msg
+
+
+class FakeSocket:
+    """
+    Hands out queued datagrams; an exception in the queue is raised instead.
+    """
+
+    def __init__(self):
+        self.datagrams = []
+
+    def recv(self, size, flags=0):
+        if not self.datagrams:
+            raise BlockingIOError
+        item = self.datagrams.pop(0)
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+
+class FakeProcesses:
+    """
+    Stands in for /proc: maps each running PID to its name.
+    """
+
+    def __init__(self, processes):
+        self.processes = dict(processes)
+
+    def enumerate(self):
+        return {(pid, 1): name for pid, name in self.processes.items()}
+
+    def snapshot(self, pid, target_names=None):
+        name = self.processes.get(pid)
+        if name is None or (target_names is not None and not process_events.is_target_name(name, target_names)):
+            return None
+        return ProcessSnapshot({"pid": pid, "ppid": 1, "name": name, "cmdline": [name], "create_time": 0.0})
+
+
+@pytest.fixture
+def processes(monkeypatch):
+    processes = FakeProcesses({100: "bash", 200: "pwsh"})
+    monkeypatch.setattr(process_events, "enumerate_process_names", processes.enumerate)
+    monkeypatch.setattr(process_events, "snapshot_process", processes.snapshot)
+    return processes
+
+
+@pytest.fixture
+def source():
+    source = object.__new__(NetlinkProcessSource)
+    source.wait_step = 0.01
+    source.target_names = process_events.DEFAULT_TARGET_NAMES
+    source._sock = FakeSocket()
+    source._first_poll = True
+    source._known_pids = set()
+    return source
+
+
+def pids(snapshots):
+    return sorted(snapshot.info["pid"] for snapshot in snapshots)
+
+
+def test_netlink_reports_exec_of_targets_and_all_exits(source, processes):
+    assert pids(source.poll(threading.Event())[0]) == [200]
+
+    processes.processes[300] = "powershell"
+    processes.processes[301] = "ls"
+    source._sock.datagrams = [
+        proc_event(PROC_EVENT_EXEC, 300) + proc_event(PROC_EVENT_EXEC, 301),
+        proc_event(PROC_EVENT_EXEC, 302, tgid=300),
+        proc_event(PROC_EVENT_EXIT, 100),
+    ]
+    started, exited = [], []
+    source._read_events(started, exited)
+    assert pids(started) == [300]
+    assert exited == [100]
+
+
+def test_netlink_overrun_reports_lost_exits_after_resync(source, processes):
+    source.poll(threading.Event())
+    processes.processes[300] = "pwsh"
+    source._sock.datagrams = [proc_event(PROC_EVENT_EXEC, 300), OSError(errno.ENOBUFS, "overrun")]
+    started, exited = [], []
+    source._read_events(started, exited)
+    assert pids(started) == [300]
+
+    # Both exits were dropped with the overrun, while a new target started.
+    del processes.processes[200]
+    del processes.processes[300]
+    processes.processes[400] = "pwsh"
+    started, exited = source.poll(threading.Event())
+    assert pids(started) == [400]
+    assert sorted(exited) == [200, 300]
+
+
+def test_netlink_first_poll_reports_running_targets_without_exits(source, processes):
+    started, exited = source.poll(threading.Event())
+    assert pids(started) == [200]
+    assert exited == []
+
+
+def test_polling_source_reports_new_targets_and_exits(processes):
+    source = process_events.PollingProcessSource(interval=0)
+    assert pids(source.poll(threading.Event())[0]) == [200]
+
+    processes.processes[300] = "pwsh"
+    processes.processes[301] = "bash"
+    del processes.processes[100]
+    started, exited = source.poll(threading.Event())
+    assert pids(started) == [300]
+    assert exited == [100]
+
+    assert source.poll(threading.Event()) == ([], [])
+
+
+def test_polling_source_returns_nothing_once_stopped(processes):
+    source = process_events.PollingProcessSource(interval=5)
+    source.poll(threading.Event())
+    stop_event = threading.Event()
+    stop_event.set()
+    assert source.poll(stop_event) == ([], [])
+
+
+def test_polling_source_follows_the_adaptive_interval(processes):
+    class Interval:
+        interval = 0
+
+        def update(self, started):
+            self.started = started
+            return 0.5
+
+    interval = Interval()
+    source = process_events.PollingProcessSource(scan_interval=interval)
+    source.poll(threading.Event())
+    assert interval.started == 1
+    assert source.interval == 0.5
+
+
+def test_is_target_name():
+    targets = process_events.DEFAULT_TARGET_NAMES
+    assert process_events.is_target_name("PowerShell.exe", targets)
+    assert process_events.is_target_name("pwsh", targets)
+    assert not process_events.is_target_name("bash", targets)
+    assert not process_events.is_target_name(None, targets)
+
+
+def test_create_process_source_falls_back_to_polling(monkeypatch):
+    def unavailable(**kwargs):
+        raise PermissionError("CAP_NET_ADMIN required")
+    monkeypatch.setattr(process_events, "NetlinkProcessSource", unavailable)
+    source = process_events.create_process_source("auto", ["PWSH"])
+    assert isinstance(source, process_events.PollingProcessSource)
+    assert source.target_names == ("pwsh",)
+    assert isinstance(process_events.create_process_source("poll"), process_events.PollingProcessSource)
+
+
+def test_read_proc_stat_handles_names_with_parentheses(tmp_path, monkeypatch):
+    (tmp_path / "42").mkdir()
+    fields = ["S"] + ["0"] * 18 + ["12345"] + ["0"] * 10
+    (tmp_path / "42" / "stat").write_bytes(b"42 (my (odd) name) " + " ".join(fields).encode())
+    monkeypatch.setattr(process_events, "PROC_DIR", str(tmp_path))
+    assert process_events._read_proc_stat(42) == ("my (odd) name", 12345)
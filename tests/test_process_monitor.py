@@ -0,0 +1,96 @@
+import base64
+
+from rules_loader import RuleProfiler, compile_rules
+from process_events import ProcessEventSource, ProcessSnapshot
+from process_monitor import check_rule_conditions
+
+RULES = [
+    {
+        "title": "Download cradle",
+        "logsource": {"product": "windows", "category": "ps_script"},
+        "detection": {"selection": {"ScriptBlockText|contains": "DownloadString"}, "condition": "selection"},
+    },
+    {
+        "title": "Invoke-Expression",
+        "logsource": {"product": "windows", "category": "ps_script"},
+        "detection": {"selection": {"ScriptBlockText|contains": "IEX "}, "condition": "selection"},
+    },
+]
+
+
+def process(cmdline):
+    return ProcessSnapshot({"cmdline": cmdline.split(), "pid": 1, "name": "powershell.exe"})
+
+
+def titles(rules, proc):
+    return sorted(rule["title"] for rule in check_rule_conditions(rules, proc))
+
+
+def test_plain_command_line():
+    rules = compile_rules(RULES)
+    assert titles(rules, process("powershell -c IEX (New-Object Net.WebClient).DownloadString('x')")) == [
+        "Download cradle", "Invoke-Expression"]
+    assert titles(rules, process("powershell -c Get-Service")) == []
+
+
+def test_encoded_payload():
+    rules = compile_rules(RULES)
+    encoded = base64.b64encode("$w.DownloadString('x')".encode("utf-16le")).decode()
+    assert titles(rules, process(f"powershell -enc {encoded}")) == ["Download cradle"]
+
+
+def test_obfuscated_command_line():
+    rules = compile_rules(RULES)
+    assert titles(rules, process("powershell -c I`E`X $w.('Download'+'String')('x')")) == [
+        "Download cradle", "Invoke-Expression"]
+
+
+def test_profiler_counts_each_process_once():
+    rules = compile_rules(RULES)
+    profiler = RuleProfiler()
+    rules.set_profiler(profiler)
+    encoded = base64.b64encode("I`E`X $x".encode("utf-16le")).decode()
+    # Matched as the command line, its canonical form, the payload and its canonical form.
+    check_rule_conditions(rules, process(f"powershell -enc {encoded} I`E`X"))
+    check_rule_conditions(rules, process("powershell -c Get-Service"))
+    assert profiler.events == 2
+
+
+class ScriptedSource(ProcessEventSource):
+    """
+    A process source replaying a fixed list of (started, exited) polls, then stopping.
+    """
+
+    def __init__(self, polls):
+        self.polls = list(polls)
+
+    def poll(self, stop_event):
+        if not self.polls:
+            stop_event.set()
+            return [], []
+        return self.polls.pop(0)
+
+
+def test_reused_pid_keeps_its_verdict(monkeypatch):
+    import threading
+
+    import process_monitor
+
+    evaluated = []
+    monkeypatch.setattr(process_monitor, "load_config", lambda: {"process_ancestry_depth": 0})
+    monkeypatch.setattr(process_monitor, "check_rule_conditions",
+                        lambda rules, proc: evaluated.append(proc.info["create_time"]) or [])
+
+    def snapshot(create_time):
+        return ProcessSnapshot({"pid": 42, "create_time": create_time, "name": "powershell.exe",
+                                "cmdline": ["powershell", "-c", "Get-Date"]})
+
+    source = ScriptedSource([
+        ([snapshot(1.0)], []),
+        # PID 42 exited and was reused by a new process within one poll.
+        ([snapshot(2.0)], [42]),
+        # The new process is reported again, e.g. by a second exec event.
+        ([snapshot(2.0)], []),
+    ])
+    process_monitor.monitor_system(compile_rules(RULES), threading.Event(), source=source)
+    assert evaluated == [1.0, 2.0]
@@ -0,0 +1,31 @@
+from rule_report import format_report
+from rules_loader import RuleProfiler
+
+
+def profiler_with(**rules):
+    profiler = RuleProfiler()
+    profiler.merge({"rules": [dict(stats, id=key, title=key) for key, stats in rules.items()]})
+    return profiler
+
+
+def test_never_matched_lists_only_evaluated_rules():
+    profiler = profiler_with(
+        matching={"evaluations": 3, "matches": 1, "seconds": 0.003},
+        idle={"evaluations": 3, "matches": 0, "seconds": 0.002},
+        skipped={"evaluations": 0, "matches": 0, "skipped": 3},
+    )
+    report = format_report(profiler, never_matched=True)
+    assert "(idle)" in report
+    assert "(matching)" not in report
+    assert "(skipped)" not in report
+
+
+def test_report_ranks_by_sort_key():
+    profiler = profiler_with(
+        cheap={"evaluations": 10, "matches": 5, "seconds": 0.001},
+        costly={"evaluations": 10, "matches": 1, "seconds": 0.5},
+    )
+    lines = format_report(profiler).splitlines()[2:]
+    assert "(costly)" in lines[0]
+    lines = format_report(profiler, sort_key="matches", top=1).splitlines()[2:]
+    assert len(lines) == 1 and "(cheap)" in lines[0]
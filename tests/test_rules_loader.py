@@ -0,0 +1,355 @@
+import base64
+
+import pytest
+
+import rules_loader
+from rules_loader import RuleCompileError, compile_field_test, compile_rule, compile_rules
+
+
+def matches(selection, fields, condition="selection"):
+    """
+    Compiles a one-rule set from a selection and tells whether it matches the fields.
+    """
+    rules = compile_rules([{"title": "test", "detection": {"selection": selection, "condition": condition}}])
+    assert len(rules.rules) == 1
+    return bool(rules.match_fields(fields))
+
+
+def test_contains_is_case_insensitive():
+    assert matches({"CommandLine|contains": "Invoke-Expression"}, {"CommandLine": "iex; INVOKE-EXPRESSION $x"})
+    assert not matches({"CommandLine|contains": "Invoke-Expression"}, {"CommandLine": "Invoke-Command"})
+
+
+def test_cased_contains():
+    assert matches({"CommandLine|contains|cased": "IEX"}, {"CommandLine": "IEX $x"})
+    assert not matches({"CommandLine|contains|cased": "IEX"}, {"CommandLine": "iex $x"})
+
+
+def test_cased_wildcards():
+    assert matches({"CommandLine|contains|cased": "Foo*Bar"}, {"CommandLine": "Foo and Bar"})
+    assert not matches({"CommandLine|contains|cased": "Foo*Bar"}, {"CommandLine": "Foo and bar"})
+    assert matches({"CommandLine|contains": "Foo*Bar"}, {"CommandLine": "foo and bar"})
+
+
+def test_list_values_are_alternatives():
+    selection = {"CommandLine|contains": ["-nop", "-enc"]}
+    assert matches(selection, {"CommandLine": "powershell -enc AAAA"})
+    assert not matches(selection, {"CommandLine": "powershell -File x.ps1"})
+
+
+def test_contains_all_requires_every_value():
+    selection = {"CommandLine|contains|all": ["-nop", "-enc"]}
+    assert matches(selection, {"CommandLine": "powershell -nop -enc AAAA"})
+    assert not matches(selection, {"CommandLine": "powershell -enc AAAA"})
+
+
+def test_startswith_and_endswith():
+    assert matches({"CommandLine|startswith": "powershell"}, {"CommandLine": "PowerShell -c x"})
+    assert not matches({"CommandLine|startswith": "-c"}, {"CommandLine": "powershell -c x"})
+    assert matches({"CommandLine|endswith": ".ps1"}, {"CommandLine": "powershell -File a.PS1"})
+
+
+def test_equals_and_wildcards():
+    assert matches({"CommandLine": "powershell"}, {"CommandLine": "PowerShell"})
+    assert not matches({"CommandLine": "powershell"}, {"CommandLine": "powershell -c x"})
+    assert matches({"CommandLine": "*Download*String*"}, {"CommandLine": "$w.DownloadString('x')"})
+    assert not matches({"CommandLine": "*Download*String*"}, {"CommandLine": "$w.DownloadData('x')"})
+    assert matches({"CommandLine|contains": "Net.Web?lient"}, {"CommandLine": "New-Object Net.WebClient"})
+
+
+def test_windash_matches_any_dash():
+    selection = {"CommandLine|windash|contains": "-enc"}
+    for dash in ("-", "/", "–", "—", "―"):
+        assert matches(selection, {"CommandLine": f"powershell {dash}enc AAAA"})
+    assert not matches(selection, {"CommandLine": "powershell enc AAAA"})
+
+
+def test_windash_contains_all_needs_one_variant_of_each_value():
+    selection = {"CommandLine|windash|contains|all": ["-enc", "-nop"]}
+    assert matches(selection, {"CommandLine": "powershell /nop -enc AAAA"})
+    assert matches(selection, {"CommandLine": "powershell –nop –enc AAAA"})
+    assert not matches(selection, {"CommandLine": "powershell /enc AAAA"})
+
+
+def test_windash_contains_all_compiles_to_alternatives_per_value():
+    node = compile_field_test("CommandLine|windash|contains|all", ["-enc", "-nop"])
+    assert node[0] == "and"
+    assert [child[2][0] for child in node[1]] == ["-enc", "-nop"]
+    assert all(len(child[2]) == 5 and not child[3] for child in node[1])
+
+
+def test_base64offset_contains():
+    encoded = base64.b64encode(b"xxIEX (New-Object Net.WebClient)").decode()
+    assert matches({"CommandLine|base64offset|contains": "New-Object"}, {"CommandLine": f"-e {encoded}"})
+    assert not matches({"CommandLine|base64offset|contains": "Invoke-Mimikatz"}, {"CommandLine": f"-e {encoded}"})
+
+
+def test_base64offset_contains_all_needs_one_offset_of_each_value():
+    selection = {"CommandLine|base64offset|contains|all": ["New-Object", "WebClient"]}
+    encoded = base64.b64encode(b"xIEX (New-Object Net.WebClient)").decode()
+    assert matches(selection, {"CommandLine": encoded})
+    encoded = base64.b64encode(b"xIEX (New-Object Net.Sockets)").decode()
+    assert not matches(selection, {"CommandLine": encoded})
+
+
+def test_utf16le_base64():
+    encoded = base64.b64encode("IEX $x".encode("utf-16le")).decode()
+    assert matches({"CommandLine|utf16le|base64offset|contains": "IEX"}, {"CommandLine": encoded})
+
+
+def test_regex_and_flags():
+    assert matches({"CommandLine|re": r"-[eE]nc\s+[A-Za-z0-9+/=]{8,}"}, {"CommandLine": "pwsh -enc SQBFAFgAIAA="})
+    assert not matches({"CommandLine|re": "iex"}, {"CommandLine": "IEX $x"})
+    assert matches({"CommandLine|re|i": "iex"}, {"CommandLine": "IEX $x"})
+
+
+def test_exists_and_null():
+    assert matches({"ParentImage|exists": True}, {"CommandLine": "x", "ParentImage": "explorer.exe"})
+    assert not matches({"ParentImage|exists": True}, {"CommandLine": "x"})
+    assert matches({"ParentImage": None}, {"CommandLine": "x"})
+
+
+def test_selection_and_not_filter():
+    detection = {
+        "selection": {"CommandLine|contains": "Invoke-WebRequest"},
+        "filter": {"CommandLine|contains": "update.example.com"},
+        "condition": "selection and not filter",
+    }
+    rules = compile_rules([{"title": "test", "detection": detection}])
+    assert rules.match_fields({"CommandLine": "Invoke-WebRequest http://evil"})
+    assert not rules.match_fields({"CommandLine": "Invoke-WebRequest http://update.example.com/a"})
+
+
+def test_one_of_them():
+    detection = {
+        "sel_download": {"CommandLine|contains": "DownloadString"},
+        "sel_iex": {"CommandLine|contains": "IEX"},
+        "condition": "all of sel_*",
+    }
+    rules = compile_rules([{"title": "test", "detection": detection}])
+    assert rules.match_fields({"CommandLine": "IEX (x).DownloadString('y')"})
+    assert not rules.match_fields({"CommandLine": "IEX $x"})
+    detection["condition"] = "1 of sel_*"
+    rules = compile_rules([{"title": "test", "detection": detection}])
+    assert rules.match_fields({"CommandLine": "IEX $x"})
+
+
+def condition_matches(condition, text):
+    detection = {
+        "a": {"CommandLine|contains": "alpha"},
+        "b": {"CommandLine|contains": "beta"},
+        "c": {"CommandLine|contains": "gamma"},
+        "_helper": {"CommandLine|contains": "helper"},
+        "condition": condition,
+    }
+    rules = compile_rules([{"title": "test", "detection": detection}])
+    return bool(rules.match_fields({"CommandLine": text}))
+
+
+def test_and_binds_tighter_than_or():
+    assert condition_matches("a or b and c", "alpha")
+    assert not condition_matches("a or b and c", "beta")
+    assert condition_matches("a or b and c", "beta gamma")
+    assert not condition_matches("(a or b) and c", "alpha")
+
+
+def test_not_and_parentheses():
+    assert condition_matches("not a", "beta")
+    assert not condition_matches("not (a or b)", "beta")
+    assert condition_matches("not not a", "alpha")
+    assert condition_matches("a and not b and not c", "alpha")
+
+
+def test_them_skips_underscore_searches():
+    assert condition_matches("all of them", "alpha beta gamma")
+    assert condition_matches("1 of them", "gamma")
+    assert not condition_matches("1 of them", "helper")
+
+
+def test_condition_list_is_or_ed():
+    assert condition_matches(["a and b", "c"], "gamma")
+    assert not condition_matches(["a and b", "c"], "alpha")
+
+
+@pytest.mark.parametrize("condition", [
+    "", "a and", "(a or b", "a b", "unknown", "1 of x*", "a | count() > 5",
+])
+def test_invalid_conditions_are_rejected(condition):
+    detection = {"a": {"CommandLine|contains": "alpha"}, "b": {"CommandLine": "beta"}, "condition": condition}
+    with pytest.raises(RuleCompileError):
+        compile_rule({"title": "test", "detection": detection})
+
+
+def test_invalid_rules_are_skipped():
+    rules = compile_rules([
+        {"title": "broken", "detection": {"selection": {"CommandLine|contains": "x"}, "condition": "missing"}},
+        {"title": "ok", "detection": {"selection": {"CommandLine|contains": "x"}, "condition": "selection"}},
+    ])
+    assert [rule["title"] for rule in rules] == ["ok"]
+
+
+def test_rules_without_needle_hits_are_skipped():
+    detection = {
+        "selection": {"CommandLine|contains": "DownloadString"},
+        "condition": "selection",
+    }
+    negated = {"selection": {"CommandLine|contains": "powershell"}, "condition": "not selection"}
+    rules = compile_rules([{"title": "gated", "detection": detection}, {"title": "always", "detection": negated}])
+    assert [rule["title"] for rule in rules.match("cmd /c dir")] == ["always"]
+    assert [rule["title"] for rule in rules.match("iex (x).downloadstring('y')")] == ["always", "gated"]
+
+
+def test_unsupported_modifier_is_rejected():
+    with pytest.raises(RuleCompileError):
+        compile_field_test("CommandLine|expand", "%x%")
+
+
+RULE_TEMPLATE = """title: {title}
+id: {title}
+detection:
+    selection:
+        CommandLine|contains: {needle}
+    condition: selection
+"""
+
+
+@pytest.fixture
+def rules_dir(tmp_path, monkeypatch):
+    rules_dir = tmp_path / "rules"
+    rules_dir.mkdir()
+    monkeypatch.setattr(rules_loader, "RULES_DIR", str(rules_dir))
+    monkeypatch.setattr(rules_loader, "CACHE_FILE", str(tmp_path / "rules_cache.bin"))
+    (rules_dir / "iex.yml").write_text(RULE_TEMPLATE.format(title="iex", needle="Invoke-Expression"))
+    (rules_dir / "nested").mkdir()
+    (rules_dir / "nested" / "enc.yaml").write_text(RULE_TEMPLATE.format(title="enc", needle="-EncodedCommand"))
+    (rules_dir / "notes.txt").write_text("not a rule")
+    return rules_dir
+
+
+def titles(rules):
+    return sorted(rule["title"] for rule in rules)
+
+
+def test_rules_are_loaded_from_the_cache_when_unchanged(rules_dir):
+    ruleset, files, recompiled = rules_loader.refresh_rules()
+    assert sorted(recompiled) == ["iex.yml", "nested/enc.yaml"]
+    assert titles(ruleset) == ["enc", "iex"]
+
+    cached, _, recompiled = rules_loader.refresh_rules()
+    assert recompiled == []
+    assert titles(cached.match("powershell -EncodedCommand AAAA")) == ["enc"]
+
+
+def test_only_changed_rule_files_are_recompiled(rules_dir):
+    _, files, _ = rules_loader.refresh_rules()
+    assert rules_loader.refresh_rules(files)[0] is None
+
+    (rules_dir / "iex.yml").write_text(RULE_TEMPLATE.format(title="iex", needle="DownloadString"))
+    ruleset, files, recompiled = rules_loader.refresh_rules(files)
+    assert recompiled == ["iex.yml"]
+    assert titles(ruleset.match("(x).DownloadString('y')")) == ["iex"]
+    assert not ruleset.match("Invoke-Expression $x")
+
+    # The rewritten cache holds the edit.
+    assert rules_loader.refresh_rules()[2] == []
+    (rules_dir / "nested" / "enc.yaml").unlink()
+    assert titles(rules_loader.refresh_rules()[0]) == ["iex"]
+
+
+def test_invalid_rule_files_are_skipped(rules_dir):
+    (rules_dir / "broken.yml").write_text("title: [unclosed")
+    (rules_dir / "empty.yml").write_text("")
+    (rules_dir / "agg.yml").write_text(RULE_TEMPLATE.format(title="agg", needle="x").replace(
+        "condition: selection", "condition: selection | count() > 5"))
+    assert titles(rules_loader.load_rules()) == ["enc", "iex"]
+
+
+def test_cache_of_another_compiler_version_is_ignored(rules_dir, monkeypatch):
+    rules_loader.refresh_rules()
+    assert rules_loader.load_cache(rules_loader.CACHE_FILE)[0] is not None
+    monkeypatch.setattr(rules_loader, "COMPILER_VERSION", rules_loader.COMPILER_VERSION + 1)
+    assert rules_loader.load_cache(rules_loader.CACHE_FILE) == (None, None)
+    assert sorted(rules_loader.refresh_rules()[2]) == ["iex.yml", "nested/enc.yaml"]
+
+
+def test_corrupted_cache_is_rebuilt(rules_dir):
+    rules_loader.refresh_rules()
+    with open(rules_loader.CACHE_FILE, "r+b") as f:
+        f.seek(rules_loader.CACHE_HEADER.size)
+        f.write(b"garbage")
+    assert rules_loader.load_cache(rules_loader.CACHE_FILE) == (None, None)
+    assert titles(rules_loader.load_rules()) == ["enc", "iex"]
+
+
+def test_ruleset_key_covers_names_and_contents():
+    key = rules_loader.ruleset_key({"a.yml": "1", "b.yml": "2"})
+    assert key == rules_loader.ruleset_key({"b.yml": "2", "a.yml": "1"})
+    assert key != rules_loader.ruleset_key({"a.yml": "1", "b.yml": "3"})
+    assert key != rules_loader.ruleset_key({"a.yml": "1", "c.yml": "2"})
+
+
+def indexed_rule(title, category, selection, condition="selection"):
+    logsource = {"category": category} if category != "classic" else {"service": "powershell-classic"}
+    return {"title": title, "logsource": logsource,
+            "detection": {"selection": selection, "condition": condition}}
+
+
+INDEXED_RULES = [
+    indexed_rule("script", "ps_script", {"ScriptBlockText|contains": "iex"}),
+    indexed_rule("module", "ps_module", {"ContextInfo|contains": "-enc"}),
+    indexed_rule("classic", "classic", {"Data|contains": "-nop"}),
+    indexed_rule("registry", "registry_set", {"TargetObject|contains": "run"}),
+    indexed_rule("path", "ps_script", {"Path|endswith": ".ps1"}),
+    indexed_rule("keyword", None, ["mimikatz"], "selection"),
+]
+
+
+def test_rules_are_indexed_by_logsource_and_field():
+    rules = compile_rules(INDEXED_RULES)
+    assert rules.index[("ps_script", "ScriptBlockText")] == [0]
+    assert rules.index[("ps_classic_start", "Data")] == [2]
+    assert rules.index[(None, None)] == [5]
+
+
+def test_view_holds_only_the_rules_a_source_can_apply():
+    rules = compile_rules(INDEXED_RULES)
+    source = rules_loader.FieldSource(
+        "script blocks", ["ps_script", "ps_module"],
+        {"ScriptBlockText": lambda raw: raw, "ContextInfo": lambda raw: raw}, default=lambda raw: raw)
+    view = rules.view(source)
+    assert [compiled.rule["title"] for compiled, _, _ in view.linked] == ["script", "module", "keyword"]
+    assert set(view.scan_fields) == {"ContextInfo", "ScriptBlockText", None}
+    assert rules.view(source) is view
+
+
+def test_trigger_fields_limit_the_view():
+    rules = compile_rules(INDEXED_RULES)
+    source = rules_loader.FieldSource(
+        "payloads", ["ps_script", "ps_module"],
+        {"ScriptBlockText": lambda raw: raw, "ContextInfo": lambda raw: raw}, trigger_fields=["ScriptBlockText"])
+    assert [rule["title"] for rule in rules.match_source(source, "iex -enc mimikatz")[0]] == ["script"]
+
+
+def test_source_events_extract_only_the_fields_read():
+    rules = compile_rules(INDEXED_RULES[:1])
+    extracted = []
+
+    def extractor(field):
+        return lambda raw: extracted.append(field) or raw
+    source = rules_loader.FieldSource(
+        "process", ["ps_script", "ps_module"],
+        {"ScriptBlockText": extractor("ScriptBlockText"), "ContextInfo": extractor("ContextInfo")},
+        default=extractor(None))
+    matched, event = rules.match_source(source, "IEX $x")
+    assert [rule["title"] for rule in matched] == ["script"]
+    assert extracted == ["ScriptBlockText"]
+
+    # A second event of the same text reuses the lowercase and hit caches of the first.
+    shared = rules.match_source(source, "IEX $x", shared=event)[1]
+    assert shared._hits is event._hits
+
+
+def test_events_without_a_source_see_every_rule():
+    rules = compile_rules(INDEXED_RULES)
+    assert sorted(rule["title"] for rule in rules.match("iex -enc -nop run mimikatz x.ps1")) == [
+        "classic", "keyword", "module", "path", "registry", "script"]
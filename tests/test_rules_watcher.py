@@ -0,0 +1,138 @@
+import os
+import sys
+import threading
+
+import pytest
+
+import rules_loader
+import rules_watcher
+from rules_watcher import InotifyRuleChangeSource, PollingRuleChangeSource, RulesWatcher
+
+RULE_TEMPLATE = """title: {title}
+detection:
+    selection:
+        CommandLine|contains: {needle}
+    condition: selection
+"""
+
+
+@pytest.fixture
+def rules_dir(tmp_path, monkeypatch):
+    rules_dir = tmp_path / "rules"
+    rules_dir.mkdir()
+    monkeypatch.setattr(rules_loader, "RULES_DIR", str(rules_dir))
+    monkeypatch.setattr(rules_loader, "CACHE_FILE", str(tmp_path / "rules_cache.bin"))
+    (rules_dir / "iex.yml").write_text(RULE_TEMPLATE.format(title="iex", needle="Invoke-Expression"))
+    return rules_dir
+
+
+def touch(path, text):
+    path.write_text(text)
+    # Make the change visible to the mtime/size comparison even within one clock tick.
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def test_polling_source_reports_rule_file_changes(rules_dir):
+    source = PollingRuleChangeSource(str(rules_dir), interval=0)
+    stop_event = threading.Event()
+    assert not source.wait(stop_event, 0)
+
+    touch(rules_dir / "iex.yml", RULE_TEMPLATE.format(title="iex", needle="IEX"))
+    assert source.wait(stop_event, 0)
+    assert not source.wait(stop_event, 0)
+
+    touch(rules_dir / "readme.txt", "not a rule")
+    assert not source.wait(stop_event, 0)
+    (rules_dir / "iex.yml").unlink()
+    assert source.wait(stop_event, 0)
+
+
+def test_polling_source_returns_once_stopped(rules_dir):
+    source = PollingRuleChangeSource(str(rules_dir), interval=0)
+    touch(rules_dir / "iex.yml", "changed")
+    stop_event = threading.Event()
+    stop_event.set()
+    assert not source.wait(stop_event, 5)
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux only")
+def test_inotify_source_reports_rule_files_and_new_directories(rules_dir):
+    source = InotifyRuleChangeSource(str(rules_dir))
+    stop_event = threading.Event()
+    try:
+        (rules_dir / "notes.txt").write_text("not a rule")
+        assert not source.wait(stop_event, 0.2)
+
+        (rules_dir / "nested").mkdir()
+        assert source.wait(stop_event, 1)
+        (rules_dir / "nested" / "enc.yml").write_text(RULE_TEMPLATE.format(title="enc", needle="-enc"))
+        assert source.wait(stop_event, 1)
+    finally:
+        source.close()
+
+
+def test_reload_swaps_in_the_changed_rules(rules_dir):
+    ruleset, files, _ = rules_loader.refresh_rules()
+    watcher = RulesWatcher(ruleset, files)
+    assert not watcher.reload()
+
+    (rules_dir / "enc.yml").write_text(RULE_TEMPLATE.format(title="enc", needle="-EncodedCommand"))
+    assert watcher.reload()
+    assert watcher.reloads == 1
+    assert watcher.ruleset is not ruleset
+    assert [rule["title"] for rule in watcher.ruleset.match("powershell -EncodedCommand AAAA")] == ["enc"]
+
+
+def test_failed_reload_keeps_the_previous_rules(rules_dir, monkeypatch):
+    ruleset, files, _ = rules_loader.refresh_rules()
+    watcher = RulesWatcher(ruleset, files)
+
+    def broken(files, automaton):
+        raise OSError("rules directory unreadable")
+    monkeypatch.setattr(rules_watcher, "refresh_rules", broken)
+    assert not watcher.reload()
+    assert watcher.ruleset is ruleset
+
+
+class ScriptedChangeSource(rules_watcher.RuleChangeSource):
+    """
+    Reports the scripted wait() results, then stops the watcher.
+    """
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.closed = False
+
+    def wait(self, stop_event, timeout):
+        if not self.results:
+            stop_event.set()
+            return False
+        return self.results.pop(0)
+
+    def close(self):
+        self.closed = True
+
+
+def test_run_reloads_once_per_burst_of_changes(rules_dir, monkeypatch):
+    ruleset, files, _ = rules_loader.refresh_rules()
+    source = ScriptedChangeSource([False, True, True, True, False])
+    watcher = RulesWatcher(ruleset, files, source)
+    reloads = []
+    monkeypatch.setattr(watcher, "reload", lambda detected_at=None: reloads.append(detected_at))
+    watcher.run(threading.Event())
+    assert len(reloads) == 1
+    assert source.closed
+
+
+def test_run_reads_the_poll_interval_as_a_number(rules_dir, monkeypatch):
+    ruleset, files, _ = rules_loader.refresh_rules()
+    created = {}
+
+    def create_source(preferred, poll_interval):
+        created["poll_interval"] = poll_interval
+        return ScriptedChangeSource([])
+    monkeypatch.setattr(rules_watcher, "load_config", lambda: {"rules_watcher": "poll", "rules_poll_interval": "0.5"})
+    monkeypatch.setattr(rules_watcher, "create_rule_change_source", create_source)
+    RulesWatcher(ruleset, files).run(threading.Event())
+    assert created["poll_interval"] == 0.5
@@ -0,0 +1,137 @@
+import pytest
+
+import scheduler
+from scheduler import SCAN_BACKOFF, AdaptiveInterval, UploadScheduler
+
+
+class Clock:
+    """
+    Replaces time.monotonic; waiting on one of its events advances the clock.
+    """
+
+    def __init__(self):
+        self.now = 100.0
+        self.waits = []
+
+    def monotonic(self):
+        return self.now
+
+    def event(self):
+        clock = self
+
+        class Event:
+            def __init__(self):
+                self.flag = False
+
+            def is_set(self):
+                return self.flag
+
+            def set(self):
+                self.flag = True
+
+            def clear(self):
+                self.flag = False
+
+            def wait(self, timeout):
+                clock.waits.append(timeout)
+                clock.now += timeout
+                return self.flag
+        return Event()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(scheduler.time, "monotonic", clock.monotonic)
+    return clock
+
+
+@pytest.fixture
+def cpu(monkeypatch):
+    cpu = {"percent": 10.0}
+    monkeypatch.setattr(scheduler.psutil, "cpu_percent", lambda interval=None: cpu["percent"])
+    return cpu
+
+
+def test_scan_interval_speeds_up_for_new_processes_and_backs_off_when_idle(cpu):
+    interval = AdaptiveInterval(interval=1.0, min_interval=0.25, max_interval=2.0)
+    assert interval.update(3) == 0.25
+    assert interval.update(0) == 0.25 * SCAN_BACKOFF
+    for _ in range(10):
+        interval.update(0)
+    assert interval.interval == 2.0
+    assert scheduler.SCAN_INTERVAL.value == 2.0
+
+
+def test_scan_interval_stays_at_the_base_interval_under_cpu_pressure(cpu):
+    interval = AdaptiveInterval(interval=1.0, min_interval=0.25, max_interval=5.0, cpu_threshold=80)
+    interval.update(1)
+    cpu["percent"] = 95.0
+    assert interval.update(1) == 1.0
+    assert interval.update(0) == 1.0 * SCAN_BACKOFF
+    # A threshold of 0 disables the CPU check.
+    interval.cpu_threshold = 0
+    assert interval.update(1) == 0.25
+
+
+def test_scan_interval_bounds_are_consistent(cpu):
+    interval = AdaptiveInterval(interval=10.0, min_interval=8.0, max_interval=4.0)
+    assert (interval.min_interval, interval.base_interval, interval.max_interval) == (4.0, 4.0, 4.0)
+
+
+def test_scan_interval_settings_are_read_as_numbers(cpu):
+    interval = scheduler.create_scan_interval({"scan_interval": "2", "scan_min_interval": "0.5",
+                                               "scan_max_interval": "8", "scan_cpu_threshold": "0"})
+    assert (interval.base_interval, interval.min_interval, interval.max_interval) == (2.0, 0.5, 8.0)
+    assert interval.cpu_threshold == 0.0
+
+
+def upload_scheduler(clock, **kwargs):
+    upload_scheduler = UploadScheduler(**kwargs)
+    upload_scheduler._urgent = clock.event()
+    return upload_scheduler
+
+
+def test_upload_is_due_after_the_maximum_interval(clock):
+    uploads = upload_scheduler(clock, min_interval=5, max_interval=30)
+    assert uploads.wait(clock.event(), step=10)
+    assert clock.now == 130.0
+    uploads.uploaded()
+    assert uploads.wait(clock.event(), step=10)
+    assert clock.now == 160.0
+
+
+def test_urgent_detection_uploads_after_the_minimum_interval(clock):
+    uploads = upload_scheduler(clock, min_interval=5, max_interval=30, urgent_levels=("Critical",))
+    uploads.notify_written([{"rule": {"level": "high"}}, "not a detection"])
+    assert not uploads._urgent.is_set()
+    uploads.notify_written([{"rule": {"level": "CRITICAL"}}])
+    before = scheduler.EARLY_UPLOADS.value
+    assert uploads.wait(clock.event(), step=10)
+    assert clock.now == 105.0
+    assert scheduler.EARLY_UPLOADS.value == before + 1
+    assert not uploads._urgent.is_set()
+
+
+def test_backlog_triggers_an_early_upload(clock):
+    uploads = upload_scheduler(clock, min_interval=5, max_interval=30, backlog_bytes=1000)
+    backlog = iter([10, 500, 1000])
+    uploads.set_backlog_function(lambda: next(backlog))
+    assert uploads.wait(clock.event(), step=1)
+    assert clock.now == 107.0
+
+
+def test_failing_backlog_function_counts_as_no_backlog(clock):
+    uploads = upload_scheduler(clock, min_interval=5, max_interval=30, backlog_bytes=1)
+
+    def broken():
+        raise OSError("log file missing")
+    uploads.set_backlog_function(broken)
+    assert uploads.wait(clock.event(), step=10)
+    assert clock.now == 130.0
+
+
+def test_wait_returns_false_once_stopped(clock):
+    stop_event = clock.event()
+    stop_event.set()
+    assert not upload_scheduler(clock).wait(stop_event)
@@ -0,0 +1,88 @@
+import pytest
+
+import sftp_uploader
+
+
+@pytest.fixture
+def log_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(sftp_uploader, "LOG_DIR", str(tmp_path))
+    monkeypatch.setattr(sftp_uploader, "SHARED_LOG_FILE", str(tmp_path / "threats.log"))
+    monkeypatch.setattr(sftp_uploader, "CHECKPOINT_FILE", str(tmp_path / "upload_checkpoint.json"))
+    monkeypatch.setattr(sftp_uploader, "UPLOAD_OFFSET_FILE", str(tmp_path / "upload_offset.txt"))
+    (tmp_path / "threats.log").write_text('{"number": 1}\n{"number": 2}\n')
+    return tmp_path
+
+
+def test_retried_chunk_keeps_its_name(log_dir, monkeypatch):
+    attempts = []
+    results = iter([None, ("127.0.0.1", 22)])
+
+    def upload_chunk(endpoints, path, inode, start, end, remote_file, compression):
+        attempts.append(remote_file)
+        return next(results)
+
+    timestamps = iter(["2026-01-01T00:00:00", "2026-01-01T00:05:00"])
+    monkeypatch.setattr(sftp_uploader, "_upload_chunk", upload_chunk)
+    monkeypatch.setattr(sftp_uploader.time, "strftime", lambda fmt: next(timestamps))
+
+    assert sftp_uploader._upload_chunks(None)["sequence"] == 0
+    checkpoint = sftp_uploader._upload_chunks(None)
+
+    assert len(attempts) == 2
+    assert attempts[0] == attempts[1]
+    assert "_2026-01-01T00:00:00_0000000001_" in attempts[0]
+    assert checkpoint["sequence"] == 1
+    assert "pending" not in sftp_uploader.load_checkpoint()
+
+
+def test_next_chunk_gets_a_new_name(log_dir, monkeypatch):
+    checkpoint = {"inode": 1, "offset": 10, "sequence": 4,
+                  "pending": {"inode": 1, "start": 0, "sequence": 4, "timestamp": "2026-01-01T00:00:00"}}
+    monkeypatch.setattr(sftp_uploader.time, "strftime", lambda fmt: "2026-01-01T00:05:00")
+    assert sftp_uploader.chunk_name_parts(checkpoint, 1, 10) == (5, "2026-01-01T00:05:00")
+
+
+class FailingSFTP:
+    def __init__(self):
+        self.removed = []
+
+    def open(self, path, mode):
+        raise OSError("disk full")
+
+    def remove(self, path):
+        self.removed.append(path)
+
+
+class FakeConnection:
+    def __init__(self, sftp):
+        self.sftp = sftp
+
+    def ensure_dir(self, remote_dir):
+        pass
+
+    def run(self, operation):
+        return operation(self.sftp)
+
+
+def test_failed_upload_removes_partial_file(log_dir, monkeypatch):
+    sftp = FailingSFTP()
+    monkeypatch.setattr(sftp_uploader, "get_connection", lambda ip, port: FakeConnection(sftp))
+    path = str(log_dir / "threats.log")
+    assert not sftp_uploader.upload_log_range(path, 0, 10, "PSWatchdog/agent/chunk.log", "127.0.0.1", 22)
+    assert sftp.removed == ["PSWatchdog/agent/chunk.log.part"]
+
+
+def test_rotated_file_with_incomplete_last_line_is_drained(log_dir):
+    rotated = log_dir / "threats.log.1"
+    rotated.write_text('{"number": 0}\n{"numb')
+    live = log_dir / "threats.log"
+    live.write_text('{"number": 1}\n{"numb')
+
+    chunks = sftp_uploader.plan_upload_chunks({"inode": None, "offset": 0, "sequence": 0}, 1024, 16)
+
+    assert [(path, start, end) for path, _, start, end in chunks] == [
+        (str(rotated), 0, len('{"number": 0}\n')),
+        (str(rotated), len('{"number": 0}\n'), rotated.stat().st_size),
+        (str(live), 0, 0),
+        (str(live), 0, len('{"number": 1}\n')),
+    ]
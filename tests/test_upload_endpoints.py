@@ -0,0 +1,73 @@
+import pytest
+
+import upload_endpoints
+from server_config import parse_endpoint
+from upload_endpoints import EndpointPool, rendezvous_rank
+
+ENDPOINTS = [("10.0.0.1", 22), ("10.0.0.2", 22), ("10.0.0.3", 2222)]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(upload_endpoints.time, "monotonic", clock.monotonic)
+    return clock
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("10.0.0.1", ("10.0.0.1", 22)),
+    ("10.0.0.1:2222", ("10.0.0.1", 2222)),
+    ("[::1]:2222", ("::1", 2222)),
+    ("[::1]", ("::1", 22)),
+    ("::1", ("::1", 22)),
+    ({"ip": "10.0.0.1", "port": 2222}, ("10.0.0.1", 2222)),
+    ("10.0.0.1:0", None),
+    ("10.0.0.1:70000", None),
+    ("not-an-ip", None),
+    ({"port": 22}, None),
+])
+def test_parse_endpoint(value, expected):
+    assert parse_endpoint(value) == expected
+
+
+def test_rendezvous_rank_is_stable_and_spreads_agents():
+    assert rendezvous_rank(ENDPOINTS, "agent") == rendezvous_rank(list(reversed(ENDPOINTS)), "agent")
+    preferred = [rendezvous_rank(ENDPOINTS, f"agent-{number}")[0] for number in range(300)]
+    assert all(preferred.count(endpoint) > 50 for endpoint in ENDPOINTS)
+
+
+def test_removing_an_endpoint_only_moves_its_agents():
+    remaining = ENDPOINTS[:2]
+    for number in range(100):
+        key = f"agent-{number}"
+        before = rendezvous_rank(ENDPOINTS, key)[0]
+        if before in remaining:
+            assert rendezvous_rank(remaining, key)[0] == before
+
+
+def test_circuit_opens_after_threshold_and_half_opens_after_cooldown(clock):
+    pool = EndpointPool(ENDPOINTS, failure_threshold=2, cooldown=30, max_cooldown=100)
+    first = pool.preferred
+    pool.record_failure(first)
+    assert first in pool.candidates()
+    pool.record_failure(first)
+    assert first not in pool.candidates()
+    assert pool.available_count() == 2
+
+    clock.now += 30
+    assert pool.candidates()[0] == first
+    pool.record_failure(first)
+    clock.now += 30
+    assert first not in pool.candidates()
+    clock.now += 30
+    pool.record_success(first)
+    assert pool.candidates()[0] == first
+    assert pool.available_count() == 3